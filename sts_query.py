@@ -10,22 +10,152 @@
 # Source: https://github.com/semenko/sts-risk-calculator-cli
 
 import argparse
+import asyncio
+import bisect
+import collections
+import contextlib
 import csv
 import datetime
+import functools
+import hashlib
+import html
+import http
+import importlib.util
+import io
+import itertools
+import json
 import os
+import random
+import re
 import sys
+import threading
 import time
-
-import asyncio
-import websockets
-import tqdm
-import json
+import timeit
 
 # Modern python please (esp for | operator, https://peps.python.org/pep-0584/)
 assert sys.version_info >= (3, 9)
 
+
+def lazy_import(name):
+    """
+    Import a module when one of its attributes is first used, not at startup.
+    Keeps --help and --dry-run fast: they never need the network, progress bar or cache modules.
+    Input: module name
+    Output: the module (a missing module still raises ModuleNotFoundError right away)
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError(f"No module named {name!r}", name=name)
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+websockets = lazy_import("websockets")
+tqdm = lazy_import("tqdm")
+sqlite3 = lazy_import("sqlite3")
+
+# Modules only needed to query: importing sts_query, --help and --dry-run must not load them
+QUERY_ONLY_MODULES = ("websockets", "tqdm", "sqlite3")
+
+# `sts-query serve`: its endpoints, and the largest request body it accepts
+SERVE_ENDPOINTS = ("/score", "/metrics", "/metrics.json", "/health")
+SERVE_MAX_BODY_BYTES = 16 * 1024 * 1024
+
+# `sts-query work`: jobs leased at a time (per unit of --concurrency), how long a lease lasts before
+# other workers may take the job over (renewed every QUEUE_RENEW_FRACTION of it while the job is in
+# flight), how many leases a job gets before it's marked failed, and how often to check back while
+# other workers hold the remaining jobs
+QUEUE_LEASE_BATCH = 2
+QUEUE_LEASE_SECONDS = 300
+QUEUE_RENEW_FRACTION = 1 / 3
+QUEUE_MAX_ATTEMPTS = 3
+QUEUE_POLL_SECONDS = 5
+
+# `python -X importtime -c "import sts_query"` must stay under this (see `sts-query bench --startup`)
+STARTUP_BUDGET_MS = 150
+
 WS_API_URL = "wss://acsdriskcalc.research.sts.org/websocket/"
 
+WS_HEADERS = [
+    ("Origin", "https://acsdriskcalc.research.sts.org"),
+    ("Referer", "https://acsdriskcalc.research.sts.org/"),
+    ("User-Agent", "Mozilla/5.0"),
+]
+
+
+@functools.cache
+def transient_errors():
+    """Network errors worth retrying (handshake timeout or rejection, connection closed, socket error)."""
+    return (
+        asyncio.TimeoutError,
+        TimeoutError,
+        OSError,
+        websockets.ConnectionClosed,
+        websockets.InvalidStatus,
+    )
+
+
+# Keepalive for pooled sessions, and how long to wait for trailing frames after a result
+SESSION_PING_INTERVAL = 20
+SESSION_DRAIN_TIMEOUT = 0.5
+
+# Adaptive request rate (requests/second, across all workers). The initial rate
+# per worker matches the old fixed 0.3 s pause between requests.
+RATE_INITIAL_PER_WORKER = 1 / 0.3
+RATE_MIN = 0.1
+RATE_INCREASE = 0.05  # Added to the rate after each healthy request
+RATE_DECREASE = 0.5  # Multiplies the rate after a transient error
+LATENCY_TARGET = 5.0  # Seconds; slower requests count as a sign of server load
+RETRY_DELAY_MAX = 60.0
+
+# Circuit breaker (see CircuitBreaker): after this many transient errors in a row, pause all
+# queries for a cooldown (seconds), which doubles after each failed probe, up to the max. A run
+# gives up once its queries have been paused for BREAKER_GIVE_UP seconds in total
+BREAKER_FAILURES = 5
+BREAKER_COOLDOWN = 30.0
+BREAKER_COOLDOWN_MAX = 300.0
+BREAKER_GIVE_UP = 1800.0
+
+# How many recent results the streaming engine remembers, to skip repeated payloads
+STREAM_RECENT_RESULTS = 10000
+
+# How many recent row IDs --stream remembers, to catch repeated IDs with bounded memory
+STREAM_RECENT_IDS = 100000
+
+# Results are written out in groups of this many rows (one Parquet row group each), and
+# .csv/.jsonl output is also flushed once this many seconds have passed (see ResultWriter)
+OUTPUT_ROW_GROUP_ROWS = 1000
+OUTPUT_FLUSH_SECONDS = 2.0
+
+# Phases of a query that are timed (see QueryTrace), in the order they happen
+QUERY_PHASES = (
+    "rate_wait",  # Paced by the RateController
+    "breaker_wait",  # Paused by the CircuitBreaker, while the server looks down
+    "connect",  # TCP/TLS/websocket handshake (new sessions only)
+    "init",  # Init message sent, until the session is ready (new sessions only)
+    "update_sent",  # Sending the patient's update message
+    "first_frame",  # Update sent, until the first frame back
+    "result_frame",  # Update sent, until the frame with the risk table (server compute)
+    "parse",  # Decoding and parsing the risk table
+    "drain",  # Trailing frames, until the session is idle (reused sessions only)
+    "total",  # Everything after rate_wait, including retries
+)
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Rows per chunk handed to each --workers process
+PREPARE_CHUNK_ROWS = 1000
+
+# Upper bound on the wait for a new session to become ready after init.
+# (This used to be a fixed 1 second sleep.)
+INIT_READY_TIMEOUT = 1.0
+
 # The required API parameters
 STS_PARAMS_REQUIRED = [
     "age",
@@ -149,6 +279,25 @@ STS_EXPECTED_RESULTS = [
     "pred6d",
 ]
 
+# Labels in the STS risk table (text2 output), and the result each one holds
+STS_RESULT_LABELS = {
+    "Operative Mortality": "predmort",
+    "Morbidity & Mortality": "predmm",
+    "Stroke": "predstro",
+    "Renal Failure": "predrenf",
+    "Reoperation": "predreop",
+    "Prolonged Ventilation": "predvent",
+    "Deep Sternal Wound Infection": "preddeep",
+    "Long Hospital Stay (>14 days)": "pred14d",
+    "Short Hospital Stay (<6 days)": "pred6d",
+}
+
+# Compiled once for parse_sts_html_response()
+TD_CELL_RE = re.compile(r"<td[^>]*>(.*?)</td>", re.DOTALL)
+HTML_TAG_RE = re.compile(r"<[^>]+>")
+PERCENT_RE = re.compile(r"([\d.]+)\s*%")
+RESULT_LABEL_RE = re.compile("|".join(re.escape(label) for label in STS_RESULT_LABELS))
+
 # Field mapping configurations
 PROCID_TO_PROC = {
     "1": "Isolated CABG",
@@ -422,265 +571,1167 @@ def create_websocket_init_data():
         ".clientdata_singletons": "add739c82ab207ed2c80be4b7e4b181525eb7a75",
     }
 
-def map_basic_fields(sts_query_dict, update_data):
-    """Map basic scalar fields."""
-    # Procedure
-    if "procid" in sts_query_dict and sts_query_dict["procid"] in PROCID_TO_PROC:
-        update_data["Proc"] = [PROCID_TO_PROC[sts_query_dict["procid"]]]
-
-    # Demographics
-    if "age" in sts_query_dict and sts_query_dict["age"]:
-        update_data["ageN:shiny.number"] = int(sts_query_dict["age"])
-    if "gender" in sts_query_dict and sts_query_dict["gender"]:
-        update_data["gender"] = [sts_query_dict["gender"]]
-    if "status" in sts_query_dict and sts_query_dict["status"]:
-        update_data["status"] = [sts_query_dict["status"]]
-    if "incidenc" in sts_query_dict and sts_query_dict["incidenc"]:
-        update_data["incidenc"] = [sts_query_dict["incidenc"]]
-
-def map_biometric_fields(sts_query_dict, update_data):
-    """Map height, weight, and BMI fields."""
-    if "heightcm" in sts_query_dict and sts_query_dict["heightcm"]:
-        update_data["heightN:shiny.number"] = float(sts_query_dict["heightcm"])
-    if "weightkg" in sts_query_dict and sts_query_dict["weightkg"]:
-        update_data["weightN:shiny.number"] = float(sts_query_dict["weightkg"])
-
-    # Calculate BMI if both height and weight are available
-    if ("weightkg" in sts_query_dict and "heightcm" in sts_query_dict and
-        sts_query_dict["weightkg"] and sts_query_dict["heightcm"]):
-        bmi = float(sts_query_dict["weightkg"]) / ((float(sts_query_dict["heightcm"]) / 100.0) ** 2)
-        update_data["BMI:shiny.number"] = round(bmi, 2)
-
-def map_lab_fields(sts_query_dict, update_data):
-    """Map laboratory values."""
-    lab_mappings = {
-        "creatlst": ("creatlstN:shiny.number", float),
-        "hct": ("hctN:shiny.number", int),
-        "wbc": ("wbcN:shiny.number", float),
-        "platelets": ("plateletsN:shiny.number", int),
-        "hdef": ("hdef:shiny.number", float),
-        "medadpidis": ("medadpidis:shiny.number", int),
-    }
 
-    for sts_field, (ws_field, converter) in lab_mappings.items():
-        if sts_field in sts_query_dict and sts_query_dict[sts_field]:
-            update_data[ws_field] = converter(sts_query_dict[sts_field])
+@functools.cache
+def init_message():
+    """The init message never changes, so serialize it once (on first use)."""
+    return '{"method":"init","data":' + json.dumps(create_websocket_init_data()) + '}'
+
+
+# Every patient input at its init value. Sent ahead of each patient on a reused
+# session, so no input leaks over from the previous patient.
+SESSION_RESET_DATA = {
+    key: value
+    for key, value in create_websocket_init_data().items()
+    if not key.startswith(".clientdata_") and not key.endswith(":shiny.action") and key != "tab"
+}
+
+LAB_FIELD_MAPPINGS = {
+    "creatlst": ("creatlstN:shiny.number", float),
+    "hct": ("hctN:shiny.number", int),
+    "wbc": ("wbcN:shiny.number", float),
+    "platelets": ("plateletsN:shiny.number", int),
+    "hdef": ("hdef:shiny.number", float),
+    "medadpidis": ("medadpidis:shiny.number", int),
+}
+
+
+def in_list(value):
+    """Shiny selectize inputs take a list of values."""
+    return [value]
+
 
-def map_boolean_fields(sts_query_dict, update_data):
-    """Map boolean fields."""
-    for field in BOOLEAN_FIELDS:
-        if field in sts_query_dict and sts_query_dict[field] == "Yes":
-            update_data[field] = True
+def calculate_bmi(weight_and_height):
+    """BMI, if both weight (kg) and height (cm) are available."""
+    weightkg, heightcm = weight_and_height
+    if weightkg and heightcm:
+        return round(float(weightkg) / ((float(heightcm) / 100.0) ** 2), 2)
+    return None
+
+
+def non_empty_values(values):
+    """The non-empty values, or None if there are none."""
+    return [value for value in values if value] or None
+
+
+def selected_races(values):
+    """The Shiny race names for the race/ethnicity fields set to Yes, or None."""
+    return [race for value, race in zip(values, RACE_MAPPINGS.values()) if value == "Yes"] or None
+
+
+def compile_update_plan():
+    """
+    Compile the field mappings (BOOLEAN_FIELDS, ARRAY_FIELD_MAPPINGS, RACE_MAPPINGS, the lab
+    table, ...) into one flat plan for prepare_update_data().
+
+    Output: a tuple of (Shiny input, source, encode) steps. The source is one (translated) CSV
+    field, or a tuple of fields whose values are passed to encode() together. A step sets the
+    Shiny input to encode(value), unless the value is empty or encode() returns None.
+
+    The order of the steps is the order of the update message keys.
+    """
+    plan = [
+        ## Basic fields
+        ("Proc", "procid", lambda procid: [PROCID_TO_PROC[procid]] if procid in PROCID_TO_PROC else None),
+        ("ageN:shiny.number", "age", int),
+        ("gender", "gender", in_list),
+        ("status", "status", in_list),
+        ("incidenc", "incidenc", in_list),
+        ## Biometrics
+        ("heightN:shiny.number", "heightcm", float),
+        ("weightN:shiny.number", "weightkg", float),
+        ("BMI:shiny.number", ("weightkg", "heightcm"), calculate_bmi),
+    ]
+    ## Labs
+    plan += [(ws_field, sts_field, converter) for sts_field, (ws_field, converter) in LAB_FIELD_MAPPINGS.items()]
+    ## Booleans
+    plan += [(field, field, {"Yes": True}.get) for field in BOOLEAN_FIELDS]
     # Presence-based booleans: any non-empty value means True
-    for field in PRESENCE_BOOLEAN_FIELDS:
-        if field in sts_query_dict and sts_query_dict[field]:
-            update_data[field] = True
-
-def map_array_fields(sts_query_dict, update_data):
-    """Map fields that should be arrays."""
-    for sts_field, ws_field in ARRAY_FIELD_MAPPINGS.items():
-        if sts_field in sts_query_dict and sts_query_dict[sts_field]:
-            update_data[ws_field] = [sts_query_dict[sts_field]]
-
-def map_procedure_fields(sts_query_dict, update_data):
-    """Map previous procedure fields."""
-    # Previous cardiovascular interventions (merged from prcab/prvalve/pocpci/poc)
-    if "_prcvint_items" in sts_query_dict and sts_query_dict["_prcvint_items"]:
-        update_data["prcvint"] = sts_query_dict["_prcvint_items"]
-
-    # PCI timing details
-    if sts_query_dict.get("pocpciwhen"):
-        update_data["pocpci"] = [sts_query_dict["pocpciwhen"]]
-
-    # Valve procedures
-    valve_procs = [sts_query_dict[f"prvalveproc{i}"]
-                   for i in range(1, 6)
-                   if f"prvalveproc{i}" in sts_query_dict and sts_query_dict[f"prvalveproc{i}"]]
-    if valve_procs:
-        update_data["prvalveproc"] = valve_procs
-
-    # Other cardiac interventions
-    poc_ints = [sts_query_dict[f"pocint{i}"]
-                for i in range(1, 8)
-                if f"pocint{i}" in sts_query_dict and sts_query_dict[f"pocint{i}"]]
-    if poc_ints:
-        update_data["pocint"] = poc_ints
-
-def map_race_ethnicity_fields(sts_query_dict, update_data):
-    """Map race and ethnicity fields."""
-    race_fields = [race_name 
-                   for sts_field, race_name in RACE_MAPPINGS.items() 
-                   if sts_query_dict.get(sts_field) == "Yes"]
-    if race_fields:
-        update_data["racemulti"] = race_fields
-
-def map_payor_fields(sts_query_dict, update_data):
-    """Map payor fields."""
-    payors = [payor for payor in [sts_query_dict.get("payorprim"), sts_query_dict.get("payorsecond")] 
-              if payor]
-    if payors:
-        update_data["payordata"] = payors
-
-def map_special_condition_fields(sts_query_dict, update_data):
-    """Map special condition fields that require multiple field checks."""
-    # CVD: merged from cvd/cva/cvawhen/cvdtia by translate_csv_to_shiny()
-    if "_cvd_items" in sts_query_dict and sts_query_dict["_cvd_items"]:
-        update_data["cvd"] = sts_query_dict["_cvd_items"]
-
-    # MCS: merged from iabpwhen/cathbasassistwhen/ecmowhen by translate_csv_to_shiny()
-    if "_mcs_items" in sts_query_dict and sts_query_dict["_mcs_items"]:
-        update_data["mcs"] = sts_query_dict["_mcs_items"]
+    plan += [(field, field, lambda value: True) for field in PRESENCE_BOOLEAN_FIELDS]
+    ## Arrays
+    plan += [(ws_field, sts_field, in_list) for sts_field, ws_field in ARRAY_FIELD_MAPPINGS.items()]
+    plan += [
+        ## Previous procedures
+        # Previous cardiovascular interventions (merged from prcab/prvalve/pocpci/poc)
+        ("prcvint", "_prcvint_items", list),
+        # PCI timing details
+        ("pocpci", "pocpciwhen", in_list),
+        ("prvalveproc", tuple(f"prvalveproc{i}" for i in range(1, 6)), non_empty_values),
+        # Other cardiac interventions
+        ("pocint", tuple(f"pocint{i}" for i in range(1, 8)), non_empty_values),
+        ## Race/ethnicity and payors
+        ("racemulti", tuple(RACE_MAPPINGS), selected_races),
+        ("payordata", ("payorprim", "payorsecond"), non_empty_values),
+        ## Special conditions, merged from multiple fields by translate_csv_to_shiny()
+        # CVD: from cvd/cva/cvawhen/cvdtia
+        ("cvd", "_cvd_items", list),
+        # MCS: from iabpwhen/cathbasassistwhen/ecmowhen
+        ("mcs", "_mcs_items", list),
+    ]
+    return tuple(plan)
 
-def prepare_websocket_messages(sts_query_dict):
-    """Prepare init and update messages for websocket communication."""
+
+UPDATE_PLAN = compile_update_plan()
+
+
+def prepare_update_data(sts_query_dict):
+    """Build the Shiny input values (the update message data) for one patient."""
     # Translate CSV values to Shiny-compatible values first
-    sts_query_dict = translate_csv_to_shiny(sts_query_dict)
+    get = translate_csv_to_shiny(sts_query_dict).get
 
-    init_data = create_websocket_init_data()
     update_data = {}
+    for ws_field, source, encode in UPDATE_PLAN:
+        if type(source) is tuple:
+            value = encode([get(field) for field in source])
+        else:
+            value = get(source)
+            if not value:
+                continue
+            value = encode(value)
+        if value is not None:
+            update_data[ws_field] = value
+    return update_data
 
-    # Apply all field mappings
-    map_basic_fields(sts_query_dict, update_data)
-    map_biometric_fields(sts_query_dict, update_data)
-    map_lab_fields(sts_query_dict, update_data)
-    map_boolean_fields(sts_query_dict, update_data)
-    map_array_fields(sts_query_dict, update_data)
-    map_procedure_fields(sts_query_dict, update_data)
-    map_race_ethnicity_fields(sts_query_dict, update_data)
-    map_payor_fields(sts_query_dict, update_data)
-    map_special_condition_fields(sts_query_dict, update_data)
-    
-    return (
-        '{"method":"init","data":' + json.dumps(init_data) + '}',
-        '{"method":"update","data":' + json.dumps(update_data) + '}'
-    )
+
+def encode_update_message(update_data):
+    """Serialize Shiny update data into an update message."""
+    return '{"method":"update","data":' + json.dumps(update_data) + '}'
+
+
+def prepare_websocket_messages(sts_query_dict):
+    """Prepare init and update messages for websocket communication."""
+    return init_message(), encode_update_message(prepare_update_data(sts_query_dict))
 
 def print_debug_info(init_msg, update_msg):
     """Print debugging information for websocket requests."""
-    ws_headers = [
-        ("Origin", "https://acsdriskcalc.research.sts.org"),
-        ("Referer", "https://acsdriskcalc.research.sts.org/"),
-        ("User-Agent", "Mozilla/5.0"),
-    ]
-    
     print("\nTo replicate the websocket requests with wscat or curl, use:")
     print("wscat example:")
     print("wscat -c wss://acsdriskcalc.research.sts.org/websocket/ " + 
-          " ".join(f'-H "{k}: {v}"' for k, v in ws_headers))
+          " ".join(f'-H "{k}: {v}"' for k, v in WS_HEADERS))
     print(init_msg)
     print(update_msg)
     print()
 
-async def query_sts_api_async(sts_query_dict, debug=False, max_retries=3):
+class QueryTrace:
+    """
+    How one patient's result was obtained, for the latency metrics and --trace.
+
+    `source` is "server", "cache" (from the ResultCache), "dedup" (shared with an
+    identical payload) or "in_flight" (shared with an identical query in flight, see SingleFlight). For server queries, `phases` holds the seconds spent in each of
+    QUERY_PHASES (in the last attempt that reached it), `attempts` counts the attempts, and
+    `errors` lists the error class of each failed attempt. `error` is the error class that
+    ended the query, if it failed.
+    """
+
+    def __init__(self, source="server"):
+        self.source = source
+        self.phases = {}
+        self.attempts = 0
+        self.errors = []
+        self.error = None
+
+    def timed(self, phase, start):
+        """Record a phase that began at `start` (a time.monotonic()) and ends now. Output: now"""
+        now = time.monotonic()
+        self.phases[phase] = now - start
+        return now
+
+    def as_dict(self):
+        """The trace as a JSON-friendly dict, with phases in milliseconds."""
+        return {
+            "source": self.source,
+            "attempts": self.attempts,
+            "errors": self.errors,
+            "error": self.error,
+            "phases_ms": {phase: round(1000 * seconds, 3) for phase, seconds in self.phases.items()},
+        }
+
+
+class LatencyHistogram:
+    """A latency histogram with fixed buckets (see LATENCY_BUCKETS), like Prometheus'."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # The last bucket is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def cumulative_counts(self):
+        """Output: [(upper bound, observations <= it), …], ending with +Inf."""
+        return list(zip(self.buckets + (float("inf"),), itertools.accumulate(self.counts)))
+
+    @staticmethod
+    def bucket_label(upper):
+        """A bucket's upper bound as Prometheus writes it (its "le" label)."""
+        return "+Inf" if upper == float("inf") else f"{upper:g}"
+
+    def quantile(self, q):
+        """Estimate a quantile (0-1), interpolating within its bucket like Prometheus' histogram_quantile()."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        lower, below = 0.0, 0
+        for upper, cumulative in self.cumulative_counts():
+            if cumulative >= rank:
+                if upper == float("inf"):
+                    return lower
+                return lower + (upper - lower) * (rank - below) / max(cumulative - below, 1)
+            lower, below = upper, cumulative
+        return lower
+
+
+class QueryStats:
+    """Counters collected while querying, reported at the end of a run."""
+
+    def __init__(self):
+        self.sessions_opened = 0
+        self.ready_total = 0.0
+        self.ready_max = 0.0
+        self.ready_fallbacks = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.rows = 0
+        self.unique_payloads = 0  # only counted where repeated payloads are deduplicated
+        self.phases = {phase: LatencyHistogram() for phase in QUERY_PHASES}
+        self.sources = collections.Counter()
+        self.attempts = collections.Counter()  # attempts per server query -> queries
+        self.errors = collections.Counter()  # error class -> failed attempts
+
+    def record_trace(self, trace):
+        """Add one patient's QueryTrace to the histograms and counters."""
+        self.sources[trace.source] += 1
+        if trace.source != "server":
+            return
+        self.attempts[trace.attempts] += 1
+        self.errors.update(trace.errors)
+        for phase, seconds in trace.phases.items():
+            self.phases[phase].observe(seconds)
+
+    def record_ready(self, seconds, fallback):
+        """Record how long a new session took to become ready after init."""
+        self.sessions_opened += 1
+        self.ready_total += seconds
+        self.ready_max = max(self.ready_max, seconds)
+        self.ready_fallbacks += fallback
+
+    def summary_lines(self):
+        """Human-readable summary of the run."""
+        lines = []
+        if self.sessions_opened:
+            mean_ms = 1000 * self.ready_total / self.sessions_opened
+            lines.append(
+                f"Sessions opened: {self.sessions_opened}, ready after init in "
+                f"{mean_ms:.0f} ms on average (max {1000 * self.ready_max:.0f} ms, "
+                f"{self.ready_fallbacks} hit the {INIT_READY_TIMEOUT:g} s cap)"
+            )
+        if self.unique_payloads:
+            lines.append(
+                f"Deduplicated {self.rows} rows to {self.unique_payloads} unique queries "
+                f"({self.rows / self.unique_payloads:.2f}x)"
+            )
+        if self.cache_hits or self.cache_misses:
+            lines.append(f"Result cache: {self.cache_hits} hits, {self.cache_misses} misses")
+        if self.sources["in_flight"]:
+            lines.append(f"Shared the result of an identical query in flight: {self.sources['in_flight']} rows")
+        timed_phases = [
+            f"{phase} {1000 * histogram.quantile(0.5):.0f}/{1000 * histogram.quantile(0.95):.0f}"
+            for phase, histogram in self.phases.items()
+            if histogram.count
+        ]
+        if timed_phases:
+            lines.append("Query phases, p50/p95 ms: " + ", ".join(timed_phases))
+        if self.errors:
+            errors = ", ".join(f"{error}: {count}" for error, count in self.errors.most_common())
+            lines.append(f"Failed attempts: {sum(self.errors.values())} ({errors})")
+        return lines
+
+    def metrics(self):
+        """All metrics of the run, as a JSON-friendly dict (--metrics)."""
+        return {
+            "rows": self.rows,
+            "unique_payloads": self.unique_payloads or None,
+            "sessions_opened": self.sessions_opened,
+            "session_ready_fallbacks": self.ready_fallbacks,
+            "cache_hits": self.cache_hits,
+            "cache_misses": self.cache_misses,
+            "sources": dict(self.sources),
+            "attempts": {str(attempts): count for attempts, count in sorted(self.attempts.items())},
+            "errors": dict(self.errors),
+            "phases": {
+                phase: {
+                    "count": histogram.count,
+                    "sum_seconds": histogram.sum,
+                    "p50_seconds": histogram.quantile(0.5),
+                    "p95_seconds": histogram.quantile(0.95),
+                    "p99_seconds": histogram.quantile(0.99),
+                    "buckets": {
+                        histogram.bucket_label(upper): count for upper, count in histogram.cumulative_counts()
+                    },
+                }
+                for phase, histogram in self.phases.items()
+            },
+        }
+
+    def prometheus_text(self):
+        """All metrics of the run, in the Prometheus text exposition format (--metrics)."""
+        lines = [
+            "# HELP sts_query_phase_seconds Time spent in each phase of an STS query.",
+            "# TYPE sts_query_phase_seconds histogram",
+        ]
+        for phase, histogram in self.phases.items():
+            for upper, count in histogram.cumulative_counts():
+                lines.append(
+                    f'sts_query_phase_seconds_bucket{{phase="{phase}",le="{histogram.bucket_label(upper)}"}} {count}'
+                )
+            lines.append(f'sts_query_phase_seconds_sum{{phase="{phase}"}} {histogram.sum}')
+            lines.append(f'sts_query_phase_seconds_count{{phase="{phase}"}} {histogram.count}')
+        lines += [
+            "# HELP sts_query_rows_total Patient rows, by where their result came from.",
+            "# TYPE sts_query_rows_total counter",
+        ]
+        lines += [f'sts_query_rows_total{{source="{source}"}} {count}' for source, count in self.sources.items()]
+        lines += [
+            "# HELP sts_query_attempts_total Server queries, by the number of attempts they took.",
+            "# TYPE sts_query_attempts_total counter",
+        ]
+        lines += [
+            f'sts_query_attempts_total{{attempts="{attempts}"}} {count}'
+            for attempts, count in sorted(self.attempts.items())
+        ]
+        lines += [
+            "# HELP sts_query_errors_total Failed query attempts, by error class.",
+            "# TYPE sts_query_errors_total counter",
+        ]
+        lines += [f'sts_query_errors_total{{error="{error}"}} {count}' for error, count in self.errors.items()]
+        lines += [
+            "# HELP sts_query_sessions_opened_total Shiny sessions opened.",
+            "# TYPE sts_query_sessions_opened_total counter",
+            f"sts_query_sessions_opened_total {self.sessions_opened}",
+            "# HELP sts_query_cache_hits_total Results found in the result cache.",
+            "# TYPE sts_query_cache_hits_total counter",
+            f"sts_query_cache_hits_total {self.cache_hits}",
+            "# HELP sts_query_cache_misses_total Results not found in the result cache.",
+            "# TYPE sts_query_cache_misses_total counter",
+            f"sts_query_cache_misses_total {self.cache_misses}",
+        ]
+        return "\n".join(lines) + "\n"
+
+    def write_metrics(self, path):
+        """
+        Write the metrics to a file: JSON if it ends with .json, otherwise the Prometheus text format
+        (e.g. for node_exporter's textfile collector). The file is replaced atomically.
+        """
+        if path.endswith(".json"):
+            content = json.dumps(self.metrics(), indent=2) + "\n"
+        else:
+            content = self.prometheus_text()
+        with open(path + ".tmp", "w") as metrics_file:
+            metrics_file.write(content)
+        os.replace(path + ".tmp", path)
+
+
+class TraceLog:
+    """Write one line of JSON per patient row: its labels and QueryTrace (--trace)."""
+
+    def __init__(self, path, append=False):
+        self.file = open(path, "a" if append else "w")
+
+    def write(self, labels, trace):
+        self.file.write(json.dumps(labels | trace.as_dict()) + "\n")
+
+    def close(self):
+        self.file.close()
+
+class RateController:
+    """
+    Adaptive (AIMD) pacing of requests to the STS server, shared by all workers.
+
+    Requests are spaced 1/rate seconds apart. While requests succeed within the
+    latency target the rate creeps up additively; a transient error (timeout,
+    closed connection) or a slow request cuts it multiplicatively. Cuts are
+    spaced at least one latency target apart, so one burst of failures only
+    halves the rate once. Retry delays grow as the rate falls.
+
+    If given, `log(message)` is told about every cut, e.g. tqdm.tqdm.write.
+    """
+
+    def __init__(
+        self, rate=RATE_INITIAL_PER_WORKER, min_rate=RATE_MIN, max_rate=None, latency_target=LATENCY_TARGET, log=None
+    ):
+        self.min_rate = min_rate
+        self.max_rate = max_rate if max_rate is not None else float("inf")
+        self.rate = min(max(rate, min_rate), self.max_rate)
+        self.latency_target = latency_target
+        self.slowest_rate = self.rate
+        self.fastest_rate = self.rate
+        self.decreases = 0
+        self.log = log
+        self._next_slot = 0.0
+        self._last_decrease = float("-inf")
+
+    async def wait(self):
+        """Wait until the next request may be sent."""
+        now = time.monotonic()
+        slot = max(now, self._next_slot)
+        self._next_slot = slot + 1 / self.rate
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    def record_success(self, latency):
+        """A request succeeded after `latency` seconds."""
+        if latency > self.latency_target:
+            self._decrease(0.8, f"a request took {latency:.1f} s, over the {self.latency_target:g} s latency target")
+        else:
+            self.rate = min(self.rate + RATE_INCREASE, self.max_rate)
+            self.fastest_rate = max(self.fastest_rate, self.rate)
+
+    def record_error(self):
+        """A request hit a transient network error."""
+        self._decrease(RATE_DECREASE, "transient network error")
+
+    def retry_delay(self, attempt):
+        """Seconds to wait before retry number `attempt` (0-based), with jitter."""
+        delay = min(2 ** attempt / self.rate, RETRY_DELAY_MAX)
+        return delay * random.uniform(0.5, 1.5)
+
+    def _decrease(self, factor, reason):
+        now = time.monotonic()
+        if now - self._last_decrease < self.latency_target:
+            return
+        self._last_decrease = now
+        previous_rate = self.rate
+        self.rate = max(self.rate * factor, self.min_rate)
+        if self.log is not None:
+            self.log(f"Slowing down from {previous_rate:.2f} to {self.rate:.2f} requests/s ({reason})")
+        self.slowest_rate = min(self.slowest_rate, self.rate)
+        self.decreases += 1
+        # Don't let requests scheduled at the old rate go out in a burst
+        self._next_slot = max(self._next_slot, now + 1 / self.rate)
+
+    def summary_lines(self):
+        """Human-readable summary of the rate over the run."""
+        return [
+            f"Request rate: ended at {self.rate:.2f}/s (ranged {self.slowest_rate:.2f}-{self.fastest_rate:.2f}/s, "
+            f"slowed down {self.decreases} times)"
+        ]
+
+class ServerDownError(Exception):
+    """The STS server stayed down for longer than the CircuitBreaker's `give_up` budget."""
+
+
+class CircuitBreaker:
+    """
+    Pauses every query while the STS server looks down, shared by all workers.
+
+    Closed (normal): attempts go out. After `failures` transient errors in a row (handshake
+    timeouts, closed connections, ...; see transient_errors()), it opens: every attempt waits
+    `cooldown` seconds, instead of burning its retries on a server that isn't answering.
+    Then it's half-open: one probe attempt goes out while the others keep waiting. If the probe
+    gets through, the breaker closes and everyone resumes; if not, it reopens for twice as
+    long (up to `max_cooldown`). `failures=0` disables the breaker.
+
+    If `give_up` is set, the breaker gives up for good once queries have been paused for that many
+    seconds in total: every waiting and later attempt then raises ServerDownError.
+
+    If given, `log(message)` is told about every change, e.g. tqdm.tqdm.write.
+    """
+
+    def __init__(
+        self,
+        failures=BREAKER_FAILURES,
+        cooldown=BREAKER_COOLDOWN,
+        max_cooldown=BREAKER_COOLDOWN_MAX,
+        give_up=None,
+        log=None,
+    ):
+        self.failures = failures
+        self.initial_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.give_up = give_up
+        self.gave_up = False
+        self.log = log
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.cooldown = cooldown
+        self.trips = 0
+        self.paused_seconds = 0.0
+        self._opened_at = None
+        self._retry_at = 0.0
+        self._waiters = []
+
+    @contextlib.asynccontextmanager
+    async def attempt(self):
+        """
+        Wrap one query attempt: wait while the breaker is open, then record how the attempt went.
+        Transient errors count as failures. Any other outcome shows that the server is answering.
+        Output: (yielded) True if this attempt is the half-open probe.
+        """
+        probe = await self.wait()
+        try:
+            yield probe
+        except transient_errors():
+            self.record_failure()
+            raise
+        except Exception:
+            self.record_success()
+            raise
+        except BaseException:
+            if probe and self.state == "half_open":
+                # The probe was cancelled: let the next attempt probe right away
+                self._open(0)
+            raise
+        else:
+            self.record_success()
+
+    async def wait(self):
+        """
+        Wait until an attempt may go out.
+        Output: True if this attempt is the half-open probe.
+        Raises ServerDownError once the breaker has given up.
+        """
+        self.check()
+        while self.state != "closed":
+            now = time.monotonic()
+            if self.state == "open" and now >= self._retry_at:
+                self.state = "half_open"
+                return True
+            timeout = self._retry_at - now if self.state == "open" else None
+            if self.give_up:
+                # Wake up when the budget runs out, even in the middle of a cooldown or probe
+                remaining = self.give_up - self.paused_total()
+                timeout = remaining if timeout is None else min(timeout, remaining)
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            await asyncio.wait([waiter], timeout=timeout)
+            self.check()
+        return False
+
+    def check(self):
+        """Raise ServerDownError if the breaker has given up, or its `give_up` budget just ran out."""
+        if not self.gave_up and self.give_up and self.state != "closed" and self.paused_total() >= self.give_up:
+            self.gave_up = True
+            self._wake()
+            self._notify(f"STS server has been down for {self.paused_total():.0f} s in total: giving up")
+        if self.gave_up:
+            raise ServerDownError(
+                f"Gave up: the STS server was down for more than {self.give_up:g} s in total (--breaker-give-up)"
+            )
+
+    def paused_total(self):
+        """Seconds queries have been paused over the run, including the ongoing pause."""
+        paused = self.paused_seconds
+        if self._opened_at is not None:
+            paused += time.monotonic() - self._opened_at
+        return paused
+
+    def record_success(self):
+        """An attempt got through to the server."""
+        self.consecutive_failures = 0
+        if self.state != "closed":
+            paused = time.monotonic() - self._opened_at
+            self.paused_seconds += paused
+            self.state = "closed"
+            self.cooldown = self.initial_cooldown
+            self._opened_at = None
+            self._wake()
+            self._notify(f"STS server is answering again: resuming queries after a {paused:.0f} s pause")
+
+    def record_failure(self):
+        """An attempt hit a transient network error."""
+        self.consecutive_failures += 1
+        if self.state == "half_open":
+            self.cooldown = min(2 * self.cooldown, self.max_cooldown)
+            self._open(self.cooldown)
+            self._notify(f"Probe query failed: pausing all queries for {self.cooldown:.0f} s")
+        elif self.state == "closed" and self.failures and self.consecutive_failures >= self.failures:
+            self.trips += 1
+            self._opened_at = time.monotonic()
+            self._open(self.cooldown)
+            self._notify(
+                f"STS server looks down ({self.consecutive_failures} transient errors in a row): "
+                + f"pausing all queries for {self.cooldown:.0f} s"
+            )
+
+    def _open(self, delay):
+        self.state = "open"
+        self._retry_at = time.monotonic() + delay
+        # Waiters wait until the new retry time
+        self._wake()
+
+    def _wake(self):
+        for waiter in self._waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        self._waiters.clear()
+
+    def _notify(self, message):
+        if self.log is not None:
+            self.log(message)
+
+    def summary_lines(self):
+        """Human-readable summary of the pauses over the run."""
+        if not self.trips:
+            return []
+        line = (
+            f"Circuit breaker: opened {self.trips} times, "
+            + f"pausing all queries for {self.paused_total():.0f} s in total"
+        )
+        if self.gave_up:
+            line += ", then gave up"
+        return [line]
+
+
+async def wait_until_ready(ws, timeout=INIT_READY_TIMEOUT):
+    """
+    Wait for a new Shiny session to finish processing the init message.
+    Output: (seconds waited, whether the timeout was hit)
+
+    The server answers init with a config frame, then the first values frame
+    (the "Selection Required" placeholder). Once that arrives, inputs can be
+    sent. If it never shows up, we fall back to waiting `timeout` seconds.
+    """
+    start = time.monotonic()
+    deadline = start + timeout
+    try:
+        while True:
+            msg = await asyncio.wait_for(ws.recv(), timeout=max(deadline - time.monotonic(), 0))
+            if '"values"' in msg:
+                return time.monotonic() - start, False
+            if '"busy"' in msg and json.loads(msg).get("busy") == "idle":
+                return time.monotonic() - start, False
+    except asyncio.TimeoutError:
+        return time.monotonic() - start, True
+
+def is_result_frame(msg):
+    """
+    Cheap pre-filter for Shiny frames: only frames that mention the text2
+    output can hold the risk table, so the rest (config, busy/idle,
+    progress, other outputs) are skipped without being JSON-decoded.
+    """
+    return isinstance(msg, str) and '"text2"' in msg
+
+async def read_sts_result(ws, trace=None):
+    """
+    Read frames from a Shiny session until the STS risk table arrives.
+    Output: the STS results dict.
+
+    If given, the QueryTrace gets the first_frame, result_frame and parse phases.
+    """
+    trace = trace or QueryTrace()
+    trace.phases.pop("first_frame", None)
+    start = time.monotonic()
+    # Wait for the actual results response (skip initial "Selection Required" etc.)
+    for _ in range(30):  # Try up to 30 messages
+        msg = await asyncio.wait_for(ws.recv(), timeout=15)
+        if "first_frame" not in trace.phases:
+            trace.timed("first_frame", start)
+        if not is_result_frame(msg):
+            continue
+        parse_start = trace.timed("result_frame", start)
+        try:
+            msg_data = json.loads(msg)
+            errors = msg_data.get("errors")
+            html_content = msg_data.get("values", {}).get("text2", {}).get("html")
+            if errors == {} and html_content:
+                result = parse_sts_html_response(html_content)
+                if result and any(k in result for k in STS_EXPECTED_RESULTS):
+                    trace.timed("parse", parse_start)
+                    return result
+        except (json.JSONDecodeError, AttributeError):
+            continue
+
+    raise Exception("No valid response from STS websocket API")
+
+class SingleFlight:
+    """
+    Registry of queries in flight, keyed by (server URL, payload key).
+
+    Concurrent identical queries, from async tasks, service requests, or threads each running
+    their own event loop, wait on one shared future: only the first (the leader) goes to
+    the server. Its result, or its error, is shared with the others. `leaders` and `shared`
+    count how many queries went to the server, and how many duplicates were absorbed.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight = {}  # key -> concurrent.futures.Future
+        self.leaders = 0
+        self.shared = 0
+
+    async def run(self, key, query):
+        """
+        Run `query()` (a coroutine function) for this key, unless an identical query is already
+        in flight: then wait for its result instead.
+        Output: (a copy of the STS results dict, True if it came from another query)
+        """
+        import concurrent.futures
+
+        while True:
+            with self.lock:
+                future = self.in_flight.get(key)
+                if future is None:
+                    future = self.in_flight[key] = concurrent.futures.Future()
+                    self.leaders += 1
+                    break
+                self.shared += 1
+            # Shielded, so a waiter that gets cancelled doesn't cancel the query for the others
+            result = await asyncio.shield(asyncio.wrap_future(future))
+            if result is not None:
+                return dict(result), True
+            # None: the leader was cancelled, so try again (perhaps as the leader)
+
+        try:
+            result = await query()
+        except Exception as error:
+            future.set_exception(error)
+            raise
+        except BaseException:
+            future.set_result(None)
+            raise
+        else:
+            future.set_result(result)
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+        return result, False
+
+
+@functools.cache
+def in_flight_registry():
+    """The SingleFlight registry shared by everything in this process (created on first use)."""
+    return SingleFlight()
+
+
+async def query_sts_api_async(
+    sts_query_dict, debug=False, max_retries=3, stats=None, rate=None, url=None, trace=None, breaker=None
+):
     """
     Query the STS API via websocket.
     Input: a dict of STS query parameters.
     Output: the STS results dict.
 
     Retries only on transient network errors (handshake timeout, connection
-    closed, socket error). Data/parsing errors are not retried.
+    closed, socket error). Data/parsing errors are not retried. If a
+    RateController is given, it is told about every attempt and sets the
+    retry delay; otherwise retries back off exponentially.
+    If given, the QueryTrace gets the timing of every phase, and the attempts.
+    If given, attempts wait while the (shared) CircuitBreaker is open.
+
+    If an identical query is already in flight (see SingleFlight), this waits for
+    its result instead of opening another websocket; the QueryTrace's source is then "in_flight".
     """
-    init_msg, update_msg = prepare_websocket_messages(sts_query_dict)
-    if debug:
-        print_debug_info(init_msg, update_msg)
+    payload = prepare_payload(sts_query_dict)
+    result, shared = await in_flight_registry().run(
+        (url or WS_API_URL, payload.key),
+        lambda: query_new_session_async(payload, debug, max_retries, stats, rate, url, trace, breaker),
+    )
+    if shared and trace is not None:
+        trace.source = "in_flight"
+    return result
 
-    ws_headers = [
-        ("Origin", "https://acsdriskcalc.research.sts.org"),
-        ("Referer", "https://acsdriskcalc.research.sts.org/"),
-        ("User-Agent", "Mozilla/5.0"),
-    ]
 
-    transient_errors = (
-        asyncio.TimeoutError,
-        TimeoutError,
-        OSError,
-        websockets.exceptions.ConnectionClosed,
-    )
+async def query_new_session_async(
+    sts_query_dict, debug=False, max_retries=3, stats=None, rate=None, url=None, trace=None, breaker=None
+):
+    """
+    query_sts_api_async() on a new websocket session, without checking for identical queries in flight.
+    `sts_query_dict` may also be a PreparedPayload, so its update data isn't prepared again.
+    """
+    trace = trace or QueryTrace()
+    breaker = breaker or CircuitBreaker(failures=0)
+    init_msg, update_msg = init_message(), encode_update_message(prepare_payload(sts_query_dict).update_data)
+    if debug:
+        print_debug_info(init_msg, update_msg)
 
     last_error = None
-    for attempt in range(max_retries):
+    attempt = 0
+    failed_probes = 0
+    while True:
+        trace.attempts += 1
         try:
-            async with websockets.connect(
-                WS_API_URL,
-                additional_headers=ws_headers,
-                open_timeout=30,
-            ) as ws:
-                await ws.send(init_msg)
-                await asyncio.sleep(1)  # Give the server time to process init
-                await ws.send(update_msg)
-
-                # Wait for the actual results response (skip initial "Selection Required" etc.)
-                for _ in range(30):  # Try up to 30 messages
-                    msg = await asyncio.wait_for(ws.recv(), timeout=15)
-                    try:
-                        msg_data = json.loads(msg)
-                        errors = msg_data.get("errors")
-                        html = msg_data.get("values", {}).get("text2", {}).get("html")
-                        if errors == {} and html:
-                            result = parse_sts_html_response(html)
-                            if result and any(k in result for k in STS_EXPECTED_RESULTS):
-                                return result
-                    except (json.JSONDecodeError, AttributeError):
-                        continue
-
-                raise Exception("No valid response from STS websocket API")
-        except transient_errors as e:
+            start = time.monotonic()
+            async with breaker.attempt() as probe:
+                start = trace.timed("breaker_wait", start)
+                async with websockets.connect(
+                    url or WS_API_URL,
+                    additional_headers=WS_HEADERS,
+                    open_timeout=30,
+                ) as ws:
+                    phase_start = trace.timed("connect", start)
+                    await ws.send(init_msg)
+                    ready_time, fallback = await wait_until_ready(ws)
+                    phase_start = trace.timed("init", phase_start)
+                    if stats is not None:
+                        stats.record_ready(ready_time, fallback)
+                    await ws.send(update_msg)
+                    trace.timed("update_sent", phase_start)
+                    result = await read_sts_result(ws, trace)
+            if rate is not None:
+                rate.record_success(time.monotonic() - start)
+            return result
+        except transient_errors() as e:
             last_error = e
+            trace.errors.append(type(e).__name__)
+            if rate is not None:
+                rate.record_error()
+            if probe and failed_probes < max_retries:
+                # A failed breaker probe doesn't use up this patient's retries (up to a point, in case
+                # it's this patient that fails): the breaker sets the pace
+                failed_probes += 1
+                continue
             if attempt == max_retries - 1:
                 break
-            backoff = 2 ** attempt
+            backoff = rate.retry_delay(attempt) if rate is not None else 2 ** attempt
             if debug:
-                print(f"Transient error on attempt {attempt + 1}/{max_retries}: {e!r}. Retrying in {backoff}s...")
+                print(f"Transient error on attempt {attempt + 1}/{max_retries}: {e!r}. Retrying in {backoff:.1f}s...")
+            attempt += 1
             await asyncio.sleep(backoff)
 
     raise Exception(
-        f"STS websocket request failed after {max_retries} attempts. Last error: {last_error!r}"
+        f"STS websocket request failed after {trace.attempts} attempts. Last error: {last_error!r}"
     )
 
+class ShinySession:
+    """
+    One warm websocket session with the STS Shiny app.
+
+    The app keeps its inputs as session state, so after the (large) init message
+    a session can score any number of patients: each patient is sent as a single
+    update that first resets every input to its init value. The connection is
+    (re)opened lazily, and websockets' ping/pong keeps idle sessions alive.
+    """
+
+    def __init__(self, url=None, debug=False, stats=None):
+        self.url = url or WS_API_URL
+        self.debug = debug
+        self.stats = stats
+        self.ws = None
+        # Shiny only recalculates when an input changes: remember what we last sent
+        self.last_update_msg = None
+        self.last_result = None
+        self.queries = 0
+
+    async def connect(self, trace=None):
+        """Open the websocket and initialize a fresh Shiny session."""
+        trace = trace or QueryTrace()
+        start = time.monotonic()
+        self.ws = await websockets.connect(
+            self.url,
+            additional_headers=WS_HEADERS,
+            open_timeout=30,
+            ping_interval=SESSION_PING_INTERVAL,
+            ping_timeout=SESSION_PING_INTERVAL,
+        )
+        start = trace.timed("connect", start)
+        self.last_update_msg = None
+        self.last_result = None
+        await self.ws.send(init_message())
+        ready_time, fallback = await wait_until_ready(self.ws)
+        trace.timed("init", start)
+        if self.stats is not None:
+            self.stats.record_ready(ready_time, fallback)
+
+    async def close(self):
+        """Close the websocket. The next query() reconnects."""
+        ws, self.ws = self.ws, None
+        if ws is not None:
+            try:
+                await ws.close()
+            except transient_errors():
+                pass
+
+    async def query(self, update_data, trace=None):
+        """
+        Score one patient on this session.
+        Input: the Shiny update data (see prepare_update_data()), and optionally a QueryTrace
+        Output: the STS results dict.
+        """
+        trace = trace or QueryTrace()
+        update_msg = encode_update_message(SESSION_RESET_DATA | update_data)
+        if update_msg == self.last_update_msg and self.ws is not None:
+            # Identical inputs would not trigger a new result frame from Shiny
+            return dict(self.last_result)
+        if self.ws is None:
+            await self.connect(trace)
+        if self.debug:
+            print_debug_info(init_message(), update_msg)
+
+        try:
+            start = time.monotonic()
+            await self.ws.send(update_msg)
+            trace.timed("update_sent", start)
+            result = await read_sts_result(self.ws, trace)
+            start = time.monotonic()
+            await self._drain()
+            trace.timed("drain", start)
+        except BaseException:
+            # The session state is unknown now, so don't reuse it
+            await self.close()
+            raise
+
+        self.last_update_msg = update_msg
+        self.last_result = result
+        self.queries += 1
+        return dict(result)
+
+    async def _drain(self):
+        """Consume trailing frames of the last recalculation, up to Shiny's idle marker."""
+        try:
+            while True:
+                msg = await asyncio.wait_for(self.ws.recv(), timeout=SESSION_DRAIN_TIMEOUT)
+                if '"busy"' in msg and json.loads(msg).get("busy") == "idle":
+                    return
+        except asyncio.TimeoutError:
+            return
+
+class ShinySessionPool:
+    """
+    A pool of up to `size` warm Shiny sessions shared by concurrent queries.
+
+    Sessions are reused across patients, so the TLS handshake, init message and
+    init wait are paid once per session rather than once per patient. A session
+    that fails is closed and transparently reconnected on its next use. While the
+    CircuitBreaker (`breaker`, or the pool's own) is open, queries wait instead of retrying.
+    """
+
+    def __init__(self, size=1, url=None, debug=False, max_retries=3, stats=None, rate=None, breaker=None):
+        assert size >= 1, "Session pool size must be at least 1"
+        self.size = size
+        self.debug = debug
+        self.max_retries = max_retries
+        self.rate = rate
+        self.breaker = breaker or CircuitBreaker()
+        self.sessions = [ShinySession(url=url, debug=debug, stats=stats) for _ in range(size)]
+        self._idle = asyncio.Queue()
+        for session in self.sessions:
+            self._idle.put_nowait(session)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        """Close every open session."""
+        await asyncio.gather(*(session.close() for session in self.sessions))
+
+    async def warm(self):
+        """
+        Connect every idle session ahead of the first query, so it doesn't pay for the handshake and init.
+        Output: how many sessions connected. Failed ones just connect on their first query.
+        """
+        idle = [self._idle.get_nowait() for _ in range(self._idle.qsize())]
+        try:
+            connecting = [session.connect() for session in idle if session.ws is None]
+            results = await asyncio.gather(*connecting, return_exceptions=True)
+        finally:
+            for session in idle:
+                self._idle.put_nowait(session)
+        return sum(not isinstance(result, BaseException) for result in results)
+
+    async def query(self, sts_query_dict):
+        """
+        Query the STS API on a pooled session.
+        Input: a dict of STS query parameters.
+        Output: the STS results dict.
+
+        Retries (on a reconnected session) only on transient network errors,
+        after a delay set by the pool's RateController (or exponential backoff).
+        """
+        return await self.query_update_data(prepare_update_data(sts_query_dict))
+
+    async def query_update_data(self, update_data, trace=None):
+        """Like query(), but for already prepared Shiny update data. Fills in the optional QueryTrace."""
+        trace = trace or QueryTrace()
+        last_error = None
+        attempt = 0
+        failed_probes = 0
+        while True:
+            trace.attempts += 1
+            try:
+                start = time.monotonic()
+                async with self.breaker.attempt() as probe:
+                    trace.timed("breaker_wait", start)
+                    session = await self._idle.get()
+                    start = time.monotonic()
+                    try:
+                        result = await session.query(update_data, trace)
+                    finally:
+                        self._idle.put_nowait(session)
+                if self.rate is not None:
+                    self.rate.record_success(time.monotonic() - start)
+                return result
+            except transient_errors() as e:
+                last_error = e
+                trace.errors.append(type(e).__name__)
+                if self.rate is not None:
+                    self.rate.record_error()
+
+            if probe and failed_probes < self.max_retries:
+                # A failed breaker probe doesn't use up this patient's retries (up to a point, in case
+                # it's this patient that fails): the breaker sets the pace
+                failed_probes += 1
+                continue
+            if attempt == self.max_retries - 1:
+                break
+            backoff = self.rate.retry_delay(attempt) if self.rate is not None else 2 ** attempt
+            if self.debug:
+                print(f"Transient error on attempt {attempt + 1}/{self.max_retries}: {last_error!r}. Retrying in {backoff:.1f}s...")
+            attempt += 1
+            await asyncio.sleep(backoff)
+
+        raise Exception(
+            f"STS websocket request failed after {trace.attempts} attempts. Last error: {last_error!r}"
+        )
+
+def payload_key(update_data):
+    """
+    Cache key for one patient: a hash of the canonical Shiny update data.
+
+    The update data fully determines the STS result, so patients (or reruns)
+    with the same key share a result.
+    """
+    canonical = json.dumps(update_data, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+# One patient's payload, ready to query: see prepare_payload()
+PreparedPayload = collections.namedtuple("PreparedPayload", ["entry", "update_data", "key"])
+
+
+def prepare_payload(entry):
+    """
+    Prepare one patient for querying.
+    Input: an STS query dict, or an already prepared payload (e.g. from --workers processes)
+    Output: a PreparedPayload of (STS query dict, Shiny update data, payload key)
+    """
+    if isinstance(entry, PreparedPayload):
+        return entry
+    update_data = prepare_update_data(entry)
+    return PreparedPayload(entry, update_data, payload_key(update_data))
+
+
+class ResultCache:
+    """
+    A persistent SQLite cache of STS results, keyed by payload_key().
+
+    Entries older than `ttl` seconds are ignored and evicted, and at most
+    `max_entries` of the most recent entries are kept.
+
+    Results are scoped to the STS `endpoint` they came from (default: WS_API_URL),
+    so results from e.g. a mock server never pass for real ones. Keys for the
+    real endpoint are plain payload keys, as in caches written before scoping.
+    """
+
+    COMMIT_EVERY = 100
+
+    def __init__(self, path, ttl=None, max_entries=None, endpoint=None):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.endpoint = endpoint or WS_API_URL
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS results "
+            "(key TEXT PRIMARY KEY, result TEXT NOT NULL, created REAL NOT NULL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS results_created ON results (created)")
+        self._uncommitted = 0
+        self.evict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def get(self, key):
+        """Return the cached results dict for `key`, or None on a miss."""
+        row = self.db.execute(
+            "SELECT result, created FROM results WHERE key = ?", (self.scoped_key(key),)
+        ).fetchone()
+        if row is None:
+            return None
+        result, created = row
+        if self.ttl is not None and created < time.time() - self.ttl:
+            return None
+        return json.loads(result)
+
+    def put(self, key, result):
+        """Store the results dict for `key`."""
+        self.db.execute(
+            "INSERT OR REPLACE INTO results (key, result, created) VALUES (?, ?, ?)",
+            (self.scoped_key(key), json.dumps(result), time.time()),
+        )
+        self._uncommitted += 1
+        if self._uncommitted >= self.COMMIT_EVERY:
+            self.db.commit()
+            self._uncommitted = 0
+
+    def scoped_key(self, key):
+        """The database key for payload `key` on this cache's endpoint."""
+        return key if self.endpoint == WS_API_URL else f"{self.endpoint} {key}"
+
+    def evict(self):
+        """Drop expired entries, then the oldest entries beyond `max_entries`."""
+        if self.ttl is not None:
+            self.db.execute("DELETE FROM results WHERE created < ?", (time.time() - self.ttl,))
+        if self.max_entries is not None:
+            self.db.execute(
+                "DELETE FROM results WHERE key NOT IN "
+                "(SELECT key FROM results ORDER BY created DESC LIMIT ?)",
+                (self.max_entries,),
+            )
+        self.db.commit()
+
+    def close(self):
+        """Evict, commit and close the database."""
+        self.evict()
+        self.db.close()
+
 def parse_sts_html_response(html_content):
     """
     Parse the HTML response from STS API to extract risk values.
 
     The HTML contains pairs of <td> elements: label then percentage value.
+    All cells are extracted with one precompiled regex and walked once,
+    stopping as soon as every result has been found.
     """
-    import html
-    import re
-
-    LABEL_TO_KEY = {
-        "Operative Mortality": "predmort",
-        "Morbidity & Mortality": "predmm",
-        "Stroke": "predstro",
-        "Renal Failure": "predrenf",
-        "Reoperation": "predreop",
-        "Prolonged Ventilation": "predvent",
-        "Deep Sternal Wound Infection": "preddeep",
-        "Long Hospital Stay (>14 days)": "pred14d",
-        "Short Hospital Stay (<6 days)": "pred6d",
-    }
-
     result = {}
 
     # Extract all <td> contents in order
-    td_contents = re.findall(r'<td[^>]*>(.*?)</td>', html_content, re.DOTALL)
+    td_contents = TD_CELL_RE.findall(html_content)
 
     # Walk through pairs: label td, then value td
     i = 0
     while i < len(td_contents) - 1:
-        label = td_contents[i].strip()
+        label = td_contents[i]
         # Strip any nested HTML tags and decode HTML entities from label
-        label = html.unescape(re.sub(r'<[^>]+>', '', label)).strip()
-
-        for known_label, key in LABEL_TO_KEY.items():
-            if known_label in label:
-                value_cell = td_contents[i + 1].strip()
-                value_cell = re.sub(r'<[^>]+>', '', value_cell).strip()
-                pct_match = re.search(r'([\d.]+)\s*%', value_cell)
-                if pct_match:
-                    result[key] = float(pct_match.group(1)) / 100.0
-                i += 2
-                break
-        else:
+        if "<" in label:
+            label = HTML_TAG_RE.sub("", label)
+        if "&" in label:
+            label = html.unescape(label)
+
+        label_match = RESULT_LABEL_RE.search(label)
+        if label_match is None:
             i += 1
+            continue
+
+        value_cell = td_contents[i + 1]
+        if "<" in value_cell:
+            value_cell = HTML_TAG_RE.sub("", value_cell)
+        pct_match = PERCENT_RE.search(value_cell)
+        if pct_match:
+            result[STS_RESULT_LABELS[label_match.group()]] = float(pct_match.group(1)) / 100.0
+            if len(result) == len(STS_RESULT_LABELS):
+                break
+        i += 2
 
     return result
 
@@ -691,155 +1742,774 @@ def query_sts_api(sts_query_dict):
     return asyncio.run(query_sts_api_async(sts_query_dict))
 
 
-def validate_and_return_csv_data(csv_entry):
+class PayloadQuerier:
     """
-    Extensively validate the dict we're about to pass to the STS API.
+    Get the result for one prepared patient payload: from the result cache if
+    possible, otherwise from the server (on a pooled or fresh session).
 
-    Note that we validate ~most fields, but not all prior procedures if those are entered.
+    Shared by the batch and streaming query engines.
+    """
 
-    (Please open a Github issue if you find a problem with your data validation.)
+    def __init__(
+        self,
+        concurrency=1,
+        reuse_sessions=True,
+        stats=None,
+        cache=None,
+        cache_only=False,
+        rate=None,
+        url=None,
+        in_flight=None,
+        breaker=None,
+    ):
+        self.rate = rate or RateController(rate=RATE_INITIAL_PER_WORKER * concurrency)
+        self.breaker = breaker or CircuitBreaker()
+        self.in_flight = in_flight or in_flight_registry()
+        self.pool = (
+            ShinySessionPool(size=concurrency, url=url, stats=stats, rate=self.rate, breaker=self.breaker)
+            if reuse_sessions
+            else None
+        )
+        self.url = url
+        self.stats = stats
+        self.cache = cache
+        self.cache_only = cache_only
+
+    async def close(self):
+        if self.pool is not None:
+            await self.pool.close()
+
+    def cached(self, key, trace):
+        """Return the cached result for this payload key, or None. A hit is recorded in the QueryTrace."""
+        if self.cache is None:
+            return None
+        result = self.cache.get(key)
+        if self.stats is not None:
+            if result is not None:
+                self.stats.cache_hits += 1
+            else:
+                self.stats.cache_misses += 1
+        if result is None and self.cache_only:
+            raise Exception("Patient not found in the result cache (--cache-only)")
+        if result is not None:
+            trace.source = "cache"
+            self.record(trace)
+        return result
+
+    async def query(self, entry, update_data, key, trace):
+        """
+        Query the server for this payload (paced by the RateController), and cache the result.
+        The QueryTrace gets the timing of every phase.
+
+        If an identical payload is already in flight, on any querier (see SingleFlight), this
+        waits for its result instead; the QueryTrace's source is then "in_flight".
+        """
+        start = time.monotonic()
+        result, shared = await self.in_flight.run(
+            (self.url or WS_API_URL, key), lambda: self.query_server(entry, update_data, key, trace)
+        )
+        if shared:
+            trace.source = "in_flight"
+            trace.timed("total", start)
+            self.record(trace)
+        return result
+
+    async def query_server(self, entry, update_data, key, trace):
+        """query() without checking for identical payloads in flight."""
+        start = time.monotonic()
+        # Once the breaker has given up, fail right away instead of pacing doomed queries
+        self.breaker.check()
+        await self.rate.wait()
+        start = trace.timed("rate_wait", start)
+        try:
+            if self.pool is not None:
+                result = await self.pool.query_update_data(update_data, trace)
+            else:
+                result = await query_new_session_async(
+                    PreparedPayload(entry, update_data, key),
+                    stats=self.stats,
+                    rate=self.rate,
+                    url=self.url,
+                    trace=trace,
+                    breaker=self.breaker,
+                )
+        except Exception as error:
+            trace.error = type(error).__name__
+            raise
+        finally:
+            trace.timed("total", start)
+            self.record(trace)
+        if self.cache is not None:
+            self.cache.put(key, result)
+        return result
+
+    def record(self, trace):
+        if self.stats is not None:
+            self.stats.record_trace(trace)
+
+async def query_sts_api_batch_async(
+    entries,
+    concurrency=1,
+    progress=None,
+    reuse_sessions=True,
+    stats=None,
+    cache=None,
+    cache_only=False,
+    on_result=None,
+    rate=None,
+    url=None,
+    on_trace=None,
+    breaker=None,
+    on_error=None,
+):
+    """
+    Query the STS API for many patients on a single event loop.
+    Input: a list of STS query dicts (or PreparedPayloads, see prepare_payload()).
+    Output: a list of STS results dicts, in the same order as the input.
+
+    At most `concurrency` websocket sessions are open at once, so the init wait
+    and network round trips of different patients overlap. With `reuse_sessions`,
+    those sessions are kept warm and shared across patients (see ShinySessionPool).
+    Requests are paced by a RateController (`rate`, or a default one), which
+    adapts to server latency and errors so we don't hammer the Shiny backend,
+    and paused while the server looks down by a CircuitBreaker (`breaker`, or a default one).
+    `url` overrides the STS websocket endpoint (e.g. for a local mock server).
+
+    Patients with identical update data are only queried once, and patients
+    found in the optional ResultCache are not sent to the server at all.
+    With `cache_only`, a cache miss is an error.
+
+    If given, `on_result(index, result)` is called as soon as each patient's
+    result is available (not necessarily in input order), after
+    `on_trace(index, QueryTrace)`.
+
+    A patient whose query fails (after retries) aborts the run, unless `on_error` is given:
+    then it's passed to `on_error(index, exception, QueryTrace of the query)` instead of
+    on_result, its result stays None, and the other patients carry on.
+    """
+    assert concurrency >= 1, "Concurrency must be at least 1"
+    results = [None] * len(entries)
+    querier = PayloadQuerier(concurrency, reuse_sessions, stats, cache, cache_only, rate, url, breaker=breaker)
+
+    # Identical payloads get identical results: group row indexes by payload
+    unique_payloads = {}  # payload key -> (entry, update data, [row indexes])
+    for index, entry in enumerate(entries):
+        entry, update_data, key = prepare_payload(entry)
+        if key not in unique_payloads:
+            unique_payloads[key] = (entry, update_data, [])
+        unique_payloads[key][2].append(index)
+    if stats is not None:
+        stats.rows += len(entries)
+        stats.unique_payloads += len(unique_payloads)
+    pending = iter(unique_payloads.items())
+
+    def fan_out(result, indexes, trace):
+        query_trace = trace
+        for position, index in enumerate(indexes):
+            if position:
+                # Later rows with this payload share its result
+                trace = QueryTrace("dedup")
+                if stats is not None:
+                    stats.record_trace(trace)
+            if on_trace is not None:
+                on_trace(index, trace)
+            if isinstance(result, Exception):
+                on_error(index, result, query_trace)
+                continue
+            results[index] = dict(result)
+            if on_result is not None:
+                on_result(index, results[index])
+        if progress is not None:
+            progress.set_postfix(rate=f"{querier.rate.rate:.2f}/s", refresh=False)
+            progress.update(len(indexes))
+
+    async def worker():
+        # The iterator is shared: each worker pulls the next unclaimed payload
+        for key, (entry, update_data, indexes) in pending:
+            trace = QueryTrace()
+            try:
+                result = querier.cached(key, trace)
+                if result is None:
+                    result = await querier.query(entry, update_data, key, trace)
+            except Exception as error:
+                if on_error is None:
+                    raise
+                result = error
+            fan_out(result, indexes, trace)
+
+    workers = [asyncio.ensure_future(worker()) for _ in range(min(concurrency, len(unique_payloads)))]
+    try:
+        await asyncio.gather(*workers)
+    except BaseException:
+        # One failed patient aborts the run: don't leave other sessions dangling
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        raise
+    finally:
+        await querier.close()
+    return results
+
+async def query_sts_api_stream_async(
+    entries,
+    concurrency=1,
+    progress=None,
+    reuse_sessions=True,
+    stats=None,
+    cache=None,
+    cache_only=False,
+    window=None,
+    rate=None,
+    url=None,
+    on_trace=None,
+    breaker=None,
+    on_error=None,
+):
+    """
+    Stream STS results for an iterable of patients, with bounded memory.
+    Input: an iterable of STS query dicts or PreparedPayloads (e.g. a generator reading a CSV).
+    Output: an async generator of (index, STS results dict), in input order.
+
+    Patients are read lazily and handed to `concurrency` query workers over a
+    bounded queue. At most `window` patients (default: 8 per worker) are in
+    flight between being read and being yielded, so memory use stays flat no
+    matter how long the input is, and the first results arrive right away.
+    Recently seen identical payloads are only queried once.
+    If given, `on_trace(index, QueryTrace)` is called just before each result is yielded.
+
+    A patient whose query fails (after retries) aborts the stream, unless `on_error` is given:
+    then `on_error(index, exception, QueryTrace)` is called in its turn, and None is yielded
+    in place of its result.
+    """
+    assert concurrency >= 1, "Concurrency must be at least 1"
+    window = window or 8 * concurrency
+    querier = PayloadQuerier(concurrency, reuse_sessions, stats, cache, cache_only, rate, url, breaker=breaker)
+    queue = asyncio.Queue(maxsize=2 * concurrency)
+    slots = asyncio.Semaphore(window)
+    finished = {}  # index -> result, until it's this index's turn to be yielded
+    recent = collections.OrderedDict()  # payload key -> result, for repeated payloads
+    new_result = asyncio.Event()
+
+    async def producer():
+        for index, entry in enumerate(entries):
+            await slots.acquire()
+            await queue.put((index, *prepare_payload(entry)))
+        for _ in range(concurrency):
+            await queue.put(None)
+
+    async def worker():
+        while (item := await queue.get()) is not None:
+            index, entry, update_data, key = item
+            if stats is not None:
+                stats.rows += 1
+            if key in recent:
+                recent.move_to_end(key)
+                result = recent[key]
+                trace = QueryTrace("dedup")
+                if stats is not None:
+                    stats.record_trace(trace)
+            else:
+                if stats is not None:
+                    stats.unique_payloads += 1
+                trace = QueryTrace()
+                try:
+                    result = querier.cached(key, trace)
+                    if result is None:
+                        result = await querier.query(entry, update_data, key, trace)
+                except Exception as error:
+                    if on_error is None:
+                        raise
+                    finished[index] = (error, trace)
+                    new_result.set()
+                    continue
+                recent[key] = result
+                if len(recent) > STREAM_RECENT_RESULTS:
+                    recent.popitem(last=False)
+            finished[index] = (dict(result), trace)
+            new_result.set()
+
+    tasks = [asyncio.ensure_future(producer())]
+    tasks += [asyncio.ensure_future(worker()) for _ in range(concurrency)]
+    next_index = 0
+    try:
+        while True:
+            while next_index in finished:
+                result, trace = finished.pop(next_index)
+                slots.release()
+                if on_trace is not None:
+                    on_trace(next_index, trace)
+                if isinstance(result, Exception):
+                    on_error(next_index, result, trace)
+                    result = None
+                if progress is not None:
+                    progress.set_postfix(rate=f"{querier.rate.rate:.2f}/s", refresh=False)
+                    progress.update(1)
+                yield next_index, result
+                next_index += 1
+            if all(task.done() for task in tasks):
+                break
+            # Wait for the next result, or for a stage to fail
+            new_result.clear()
+            waiter = asyncio.ensure_future(new_result.wait())
+            running = [task for task in tasks if not task.done()]
+            await asyncio.wait([waiter, *running], return_when=asyncio.FIRST_COMPLETED)
+            waiter.cancel()
+            for task in tasks:
+                if task.done() and task.exception() is not None:
+                    raise task.exception()
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await querier.close()
+
+
+async def query_many(
+    rows,
+    concurrency=4,
+    reuse_sessions=True,
+    stats=None,
+    cache=None,
+    cache_only=False,
+    rate=None,
+    url=None,
+    on_trace=None,
+    breaker=None,
+):
+    """
+    Score many patients from Python, e.g. in a service that embeds this module instead of running the CLI.
+    Input: an iterable or async iterable of patient dicts, with the same columns as the .csv
+    Output: an async iterator of (id, STS results dict or exception), as each patient finishes
+
+    The id is the row's "id" (or its position, if it has none). A row that fails validation
+    yields its ValidationError, and a query that still fails after retries yields its exception:
+    neither stops the other rows.
+
+    Queries share `concurrency` pooled sessions (see PayloadQuerier), paced by a RateController,
+    and paused by a CircuitBreaker while the server looks down.
+    Only a few rows per worker are read ahead, and finished results wait for the caller, so a
+    slow consumer slows down reading instead of buffering results.
+    """
+    assert concurrency >= 1, "Concurrency must be at least 1"
+    querier = PayloadQuerier(concurrency, reuse_sessions, stats, cache, cache_only, rate, url, breaker=breaker)
+    todo = asyncio.Queue(maxsize=2 * concurrency)
+    done = asyncio.Queue(maxsize=2 * concurrency)
+
+    async def read_rows():
+        if hasattr(rows, "__aiter__"):
+            async for row in rows:
+                yield row
+        else:
+            for row in rows:
+                yield row
 
-    Input: patient_data (dict)
-    Output: returns a dict that passed validation, union with the STS_QUERY_STUB
+    async def producer():
+        index = 0
+        read_error = None
+        try:
+            async for row in read_rows():
+                row_id = row.get("id", index)
+                index += 1
+                try:
+                    entry = validate_and_return_csv_data(row)
+                except ValidationError as error:
+                    await done.put((row_id, error))
+                    continue
+                entry.pop("id", None)
+                await todo.put((row_id, entry))
+        except Exception as error:
+            read_error = error
+        # Not in a finally: once cancelled, the queue may stay full forever
+        for _ in range(concurrency):
+            await todo.put(None)
+        if read_error is not None:
+            raise read_error
+
+    async def worker():
+        while (item := await todo.get()) is not None:
+            row_id, entry = item
+            if stats is not None:
+                stats.rows += 1
+            trace = QueryTrace()
+            try:
+                entry, update_data, key = prepare_payload(entry)
+                result = querier.cached(key, trace)
+                if result is None:
+                    result = await querier.query(entry, update_data, key, trace)
+            except Exception as error:
+                result = error
+            if on_trace is not None:
+                on_trace(row_id, trace)
+            await done.put((row_id, result))
+        await done.put(None)
+
+    reader = asyncio.ensure_future(producer())
+    tasks = [reader] + [asyncio.ensure_future(worker()) for _ in range(concurrency)]
+    try:
+        running = concurrency
+        while running:
+            item = await done.get()
+            if item is None:
+                running -= 1
+            else:
+                yield item
+        # Reading the rows failed: raise that, now the rows already read are all out
+        await reader
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await querier.close()
+
+
+def import_pyarrow():
+    """pyarrow is optional (it's needed for --output-format parquet): return the module, or None if it's not installed."""
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        return None
+    return pyarrow
+
+
+def output_columns(label_columns=("id",), carry_columns=()):
+    """The columns of a results file: the row labels, the carried input columns, then the STS results."""
+    return list(label_columns) + list(carry_columns) + STS_EXPECTED_RESULTS
+
+
+class CsvSink:
+    """Write result rows to a .csv (--output-format csv)."""
+
+    flush_seconds = OUTPUT_FLUSH_SECONDS
+
+    def __init__(self, path, columns, append=False):
+        self.file = open(path, "a" if append else "w", newline="")
+        self.writer = csv.DictWriter(self.file, fieldnames=columns)
+        if not append:
+            self.writer.writeheader()
+            self.file.flush()
+
+    def write_rows(self, rows):
+        self.writer.writerows(rows)
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class JsonlSink:
+    """Write result rows as JSON lines (--output-format jsonl): the STS results stay numbers."""
+
+    flush_seconds = OUTPUT_FLUSH_SECONDS
+
+    def __init__(self, path, columns, append=False):
+        self.columns = columns
+        self.file = open(path, "a" if append else "w")
+
+    def write_rows(self, rows):
+        self.file.write("".join(json.dumps({column: row.get(column) for column in self.columns}) + "\n" for row in rows))
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetSink:
     """
-    # Check the required parameters are present
-    # assert all(key in data.keys() for key in STS_PARAMS_REQUIRED)
+    Write result rows to a Parquet file (--output-format parquet), one row group per write.
+    Labels and carried columns are strings, and the STS results doubles. Needs pyarrow.
 
-    # Check the parameters are all allowable
-    provided_keys = csv_entry.keys()
-    valid_keys = STS_PARAMS_REQUIRED + STS_PARAMS_OPTIONAL
-    key_difference = set(provided_keys) - set(valid_keys)
-    assert (
-        len(key_difference) == 0
-    ), f"You have one or more columns that are not defined STS keys: {key_difference}"
+    The file is only readable once closed, and can't be appended to (no --resume).
+    """
 
-    # Union of these two dicts, overwriting keys from the user supplied CSV entries where able
-    data = STS_QUERY_STUB | csv_entry
+    flush_seconds = None  # Only full row groups are written
 
-    # Procedure
-    procedure_dict = {
-        "CAB": "1",
-        "AVR": "2",
-        "MVR": "3",
-        "AVR+CAB": "4",
-        "MVR+CAB": "5",
-        # There's no 6 ?!
-        "MVRepair": "7",
-        "MVRepair+CAB": "8",
-    }
-    assert data["procid"] in procedure_dict.values(), "Invalid procid"
+    def __init__(self, path, columns, append=False):
+        assert not append, "Parquet output can't be appended to"
+        self.pyarrow = import_pyarrow()
+        assert self.pyarrow is not None, "Parquet output needs pyarrow: pip install pyarrow"
+        pyarrow = self.pyarrow
+        self.schema = pyarrow.schema(
+            [(column, pyarrow.float64() if column in STS_EXPECTED_RESULTS else pyarrow.string()) for column in columns]
+        )
+        self.writer = self.pyarrow.parquet.ParquetWriter(path, self.schema)
+
+    def write_rows(self, rows):
+        self.writer.write_table(self.pyarrow.Table.from_pylist(rows, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+
+OUTPUT_SINKS = {"csv": CsvSink, "jsonl": JsonlSink, "parquet": ParquetSink}
+
+
+class ResultWriter:
+    """
+    Write results to the output file in input order, as soon as they arrive.
+
+    Results that complete out of order are held back until every earlier
+    patient is done. Rows are then buffered, and written out once `row_group`
+    of them are waiting; .csv and .jsonl output is also flushed at the next
+    result once OUTPUT_FLUSH_SECONDS have passed, and everything is flushed on
+    close, so an interrupted run leaves a valid partial output that --resume
+    can pick up.
+    """
+
+    def __init__(
+        self,
+        output_file,
+        append=False,
+        label_columns=("id",),
+        carry_columns=(),
+        output_format="csv",
+        row_group=OUTPUT_ROW_GROUP_ROWS,
+    ):
+        self.next_index = 0
+        self.waiting = {}  # index -> (row labels, result, STS query dict), for results that arrived early
+        self.written = 0  # Including rows still buffered: they're written by close() at the latest
+        self.carry_columns = list(carry_columns)
+        self.row_group = row_group
+        self.buffer = []
+        self.last_flush = time.monotonic()
+        self.sink = OUTPUT_SINKS[output_format](output_file, output_columns(label_columns, carry_columns), append)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def add(self, index, labels, result, entry=None):
+        """
+        Accept the result for row number `index`, labelled by e.g. {"id": ...}. A None result skips the row.
+        The carried columns are copied from `entry`, the row's STS query dict (or PreparedPayload).
+        """
+        self.waiting[index] = (labels, result, entry)
+        while self.next_index in self.waiting:
+            labels, patient_results, entry = self.waiting.pop(self.next_index)
+            self.next_index += 1
+            if patient_results is None:
+                continue
+            if self.carry_columns:
+                if isinstance(entry, PreparedPayload):
+                    entry = entry.entry
+                labels = labels | {column: entry[column] for column in self.carry_columns}
+            self.buffer.append(labels | patient_results)
+            self.written += 1
+        if len(self.buffer) >= self.row_group or (
+            self.buffer
+            and self.sink.flush_seconds is not None
+            and time.monotonic() - self.last_flush >= self.sink.flush_seconds
+        ):
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.sink.write_rows(self.buffer)
+            self.buffer = []
+        self.last_flush = time.monotonic()
+
+    def close(self):
+        self.flush()
+        self.sink.close()
+
+def read_completed_rows(output_csv_file, label_columns=("id",), carry_columns=(), output_format="csv"):
+    """
+    Return the rows already in a (possibly partial) results .csv or .jsonl, as
+    tuples of their label columns (e.g. (id,) or (id, scenario)).
+
+    A last line cut off by a crash is removed from the file first.
+    """
+    with open(output_csv_file, "rb+") as f:
+        end = f.seek(0, os.SEEK_END)
+        if end == 0:
+            return set()
+        # Walk back in chunks to the last newline
+        position = end
+        while position > 0:
+            chunk_start = max(position - 65536, 0)
+            f.seek(chunk_start)
+            chunk = f.read(position - chunk_start)
+            newline = chunk.rfind(b"\n")
+            if newline != -1:
+                if chunk_start + newline + 1 != end:
+                    f.truncate(chunk_start + newline + 1)
+                break
+            position = chunk_start
+        else:
+            f.truncate(0)
+            return set()
+
+    columns = output_columns(label_columns, carry_columns)
+    with open(output_csv_file, newline="") as f:
+        if output_format == "jsonl":
+            first_line = f.readline()
+            fieldnames = list(json.loads(first_line)) if first_line else columns
+            rows = map(json.loads, itertools.chain([first_line] if first_line else [], f))
+        else:
+            rows = csv.DictReader(f)
+            fieldnames = rows.fieldnames
+        assert fieldnames == columns, (
+            f"Can't resume, {output_csv_file} doesn't look like a results file for this run"
+        )
+        return {tuple(row[column] for column in label_columns) for row in rows}
+
+FailedRow = collections.namedtuple("FailedRow", ["labels", "entry", "error_type", "error", "attempts"])
+
+class DeadLetters:
+    """
+    Patients whose query failed, with --keep-going: they are set aside instead of aborting the run,
+    retried once more at the end, and the ones that still fail are written to a failures CSV:
+    their labels, the error class and message, and the number of attempts.
+    """
 
-    # Key Patient Data
-    assert int(data["age"]) in range(1, 111), "Invalid age"
-    assert data["gender"] in ["Male", "Female", ""], "Invalid gender"
+    def __init__(self, path, label_columns=("id",)):
+        self.path = path
+        self.label_columns = list(label_columns)
+        self.rows = []  # FailedRows
+
+    def add(self, labels, entry, error, trace, earlier_attempts=0):
+        """Set aside a failed patient."""
+        self.rows.append(self.failure(labels, entry, error, trace, earlier_attempts))
+
+    @staticmethod
+    def failure(labels, entry, error, trace, earlier_attempts=0):
+        """The FailedRow for a patient. Its error class is that of its last failed attempt, if it got that far."""
+        error_type = trace.errors[-1] if trace.errors else type(error).__name__
+        return FailedRow(labels, entry, error_type, str(error), earlier_attempts + trace.attempts)
+
+    def write(self):
+        """Write the failures CSV, if any patients failed."""
+        if not self.rows:
+            return
+        with open(self.path, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=self.label_columns + ["error_type", "error", "attempts"])
+            writer.writeheader()
+            for row in self.rows:
+                writer.writerow(row.labels | {"error_type": row.error_type, "error": row.error, "attempts": row.attempts})
+
+
+YES_OR_EMPTY = ["Yes", ""]
+
+PAYORS = [
+    "None / self",
+    "Medicare (includes commercially managed options)",
+    "Medicaid (includes commercially managed options)",
+    "Commercial Health Insurance",
+    "Health Maintenance Organization",
+    "Non-U.S. Plan",
+    "Other",
+    # New Shiny-style values
+    "Commercial",
+    "Medicare (any type)",
+    "Medicaid (any type)",
+    "HMO",
+    "",
+]
 
-    yes_or_empty = ["Yes", ""]
+STENOSIS_PCT = ["50% to 79%", "80% to 99%", "100%", "Not documented", ""]
+
+RHYTHM_ONSET = ["None", "Remote (> 30 days preop)", "Recent (<= 30 days preop)", "Remote", "Recent", ""]
+
+VALVE_SEVERITY = ["Trivial/Trace", "Mild", "Moderate", "Severe", "Not documented", ""]
+
+VALVE_INDICATIONS = [
+    "Bicuspid valve disease",
+    "Unicuspid valve disease",
+    "Quadricuspid valve disease",
+    "Congenital (other than Bicuspid, Unicuspid, or Quadricuspid)",
+    "Degenerative- Calcified",
+    "Degenerative- Leaflet prolapse with or without annular dilatation",
+    "Degenerative- Pure annular dilatation without leaflet prolapse",
+    "Degenerative - Commissural Rupture",
+    "Degenerative - Extensive Fenestration",
+    "Degenerative - Leaflet perforation / hole",
+    "Endocarditis, native valve with root abscess",
+    "Endocarditis, native valve without root abscess",
+    "Endocarditis, prosthetic valve with root abscess",
+    "Endocarditis, prosthetic valve without root abscess",
+    "LV Outflow Tract Pathology, HOCM",
+    "LV Outflow Tract Pathology, Sub-aortic membrane",
+    "LV Outflow Tract Pathology, Sub-aortic tunnel",
+    "LV Outflow Tract Pathology, Other",
+    "Primary Aortic Disease, Aortic Dissection",
+    "Primary Aortic Disease, Atherosclerotic Aneurysm",
+    "Primary Aortic Disease, Ehler-Danlos Syndrome",
+    "Primary Aortic Disease, Hypertensive Aneurysm",
+    "Primary Aortic Disease, Idiopathic Root dilatation",
+    "Primary Aortic Disease, Inflammatory",
+    "Primary Aortic Disease, Loeys-Dietz Syndrome",
+    "Primary Aortic Disease, Marfan Syndrome",
+    "Primary Aortic Disease, Other Connective tissue disorder",
+    "Radiation induced heart disease",
+    "Reoperation - Failure of previous AV repair or replacement",
+    "Rheumatic",
+    "Supravalvular Aortic Stenosis",
+    "Trauma",
+    "Carcinoid",
+    "Tumor, Myxoma",
+    "Tumor, Papillary Fibroelastoma",
+    "Tumor, Other",
+    "Mixed Etiology",
+    "Not documented",
+    "",
+]
 
+# The validation schema for patient data, one rule per field:
+#   a list of allowed values, or
+#   (converter, min, max) for a number, which may be empty unless listed in
+#   STS_REQUIRED_NUMBERS.
+# Note that we validate ~most fields, but not all prior procedures (prvalveproc*,
+# pocint*, pocpciwhen) or angina symptoms (cardsymptimeofadm) if those are entered.
+STS_FIELD_RULES = {
+    # Procedure. (There's no 6 ?!)
+    # {CAB: 1, AVR: 2, MVR: 3, AVR+CAB: 4, MVR+CAB: 5, MVRepair: 7, MVRepair+CAB: 8}
+    "procid": ["1", "2", "3", "4", "5", "7", "8"],
+    ## Key Patient Data
+    "age": (int, 1, 110),
+    "gender": ["Male", "Female", ""],
     ## Race/Ethnicity Parameters
-    assert data["raceasian"] in yes_or_empty, "Invalid raceasian"
-    assert data["raceblack"] in yes_or_empty, "Invalid raceblack"
-    assert data["racenativeam"] in yes_or_empty, "Invalid racenativeam"
+    "raceasian": YES_OR_EMPTY,
+    "raceblack": YES_OR_EMPTY,
+    "racenativeam": YES_OR_EMPTY,
     # Missing an "e" in race -- on STS's end.
-    assert data["racnativepacific"] in yes_or_empty, "Invalid racnativepacific"
+    "racnativepacific": YES_OR_EMPTY,
     # Hispanic/latino
-    assert data["ethnicity"] in yes_or_empty, "Invalid ethnicity"
-
+    "ethnicity": YES_OR_EMPTY,
     ## Patient Metadata
-    payors = [
-        "None / self",
-        "Medicare (includes commercially managed options)",
-        "Medicaid (includes commercially managed options)",
-        "Commercial Health Insurance",
-        "Health Maintenance Organization",
-        "Non-U.S. Plan",
-        "Other",
-        # New Shiny-style values
-        "Commercial",
-        "Medicare (any type)",
-        "Medicaid (any type)",
-        "HMO",
-        "",
-    ]
-    assert data["payorprim"] in payors, "Invalid payorprim"
-    assert data["payorsecond"] in payors, "Invalid payorsecond"
-    if data["payorsecond"] != "":
-        assert (
-            data["payorprim"] != ""
-        ), "If payorsecond is set, payorprim must also be set"
-
-    # TODO: Double check the STS API handles 0 padding
-    data["surgdt"] = datetime.datetime.strptime(data["surgdt"], "%m/%d/%Y").strftime(
-        "%m/%d/%Y"
-    )
-
+    "payorprim": PAYORS,
+    "payorsecond": PAYORS,
     ## Biometrics
-    assert (data["weightkg"] == "") or 10 <= float(data["weightkg"]) <= 250, "Invalid weightkg"
-    assert (data["heightcm"] == "") or 20 <= float(data["heightcm"]) <= 251, "Invalid heightcm"
-
+    "weightkg": (float, 10, 250),
+    "heightcm": (float, 20, 251),
     ## Labs
-    assert (data["hct"] == "") or (1 <= int(data["hct"]) <= 100), "Invalid hct"
-    assert (data["wbc"] == "") or (0.1 <= float(data["wbc"]) <= 100), "Invalid wbc"
-    assert (data["platelets"] == "") or (
-        int(data["platelets"]) in range(1000, 900001)
-    ), "Invalid platelets"
-    assert (data["creatlst"] == "") or (
-        0.10 <= float(data["creatlst"]) <= 30
-    ), "Invalid creatlst"
-
+    "hct": (int, 1, 100),
+    "wbc": (float, 0.1, 100),
+    "platelets": (int, 1000, 900000),
+    "creatlst": (float, 0.10, 30),
     ## Comorbidities
-    assert data["dialysis"] in yes_or_empty, "Invalid dialysis"
-    assert data["hypertn"] in yes_or_empty, "Invalid hypertn"
-    assert data["immsupp"] in yes_or_empty, "Invalid immsupp"
-    assert data["pvd"] in yes_or_empty, "Invalid pvd"
-
-    assert data["cvd"] in yes_or_empty, "Invalid cvd"
-    assert data["cvdtia"] in yes_or_empty, "Invalid cvdtia"
-    assert data["cvdpcarsurg"] in yes_or_empty, "Invalid cvdpcarsurg"
-
-    if data["cvdtia"] != "" or data["cvdpcarsurg"] != "":
-        assert (
-            data["cvd"] == "Yes"
-        ), "Invalid cvdpcarsurg, cvd must be set if a TIA or prior cartoid procedure is true."
-
-    assert data["cva"] in yes_or_empty, "Invalid cva"
-    assert data["cvawhen"] in ["<= 30 days", "> 30 days", ""], "Invalid when"
-    if data["cvawhen"] != "":
-        assert (
-            data["cva"] != ""
-        ), "Invalid cvawhen: cva must be set to Yes if cvdwhen is defined"
-
-    assert data["mediastrad"] in yes_or_empty, "Invalid mediastrad"
-    assert data["cancer"] in yes_or_empty, "Invalid cancer"
-    assert data["fhcad"] in yes_or_empty, "Invalid fhcad"
-    assert data["slpapn"] in yes_or_empty, "Invalid slpapn"
-    assert data["liverdis"] in yes_or_empty, "Invalid liverdis"
-    assert data["unrespstat"] in yes_or_empty, "Invalid unrespstat"
-    assert data["syncope"] in yes_or_empty, "Invalid syncope"
-
-    assert data["diabetes"] in yes_or_empty, "Invalid diabetes"
-    assert data["diabctrl"] in [
-        "None",
-        "Diet only",
-        "Oral",
-        "Insulin",
-        "Other SubQ",
-        "Other",
-        "Unknown",
-        "",
-    ], "Invalid diabctrl"
-    if data["diabctrl"] != "":
-        assert (
-            data["diabetes"] != ""
-        ), "Invalid diabctrl: diabetes must be set if diabctrl is set"
-
-    assert data["infendo"] in yes_or_empty, "Invalid infendo"
-    assert data["infendty"] in ["Treated", "Active", ""], "Invalid infendty"
-    if data["infendty"] != "":
-        assert (
-            data["infendo"] != ""
-        ), "Invalid infendty; infendo must be set if infendty is set"
-
-    assert data["chrlungd"] in [
+    "dialysis": YES_OR_EMPTY,
+    "hypertn": YES_OR_EMPTY,
+    "immsupp": YES_OR_EMPTY,
+    "pvd": YES_OR_EMPTY,
+    "cvd": YES_OR_EMPTY,
+    "cvdtia": YES_OR_EMPTY,
+    "cvdpcarsurg": YES_OR_EMPTY,
+    "cva": YES_OR_EMPTY,
+    "cvawhen": ["<= 30 days", "> 30 days", ""],
+    "mediastrad": YES_OR_EMPTY,
+    "cancer": YES_OR_EMPTY,
+    "fhcad": YES_OR_EMPTY,
+    "slpapn": YES_OR_EMPTY,
+    "liverdis": YES_OR_EMPTY,
+    "unrespstat": YES_OR_EMPTY,
+    "syncope": YES_OR_EMPTY,
+    "diabetes": YES_OR_EMPTY,
+    "diabctrl": ["None", "Diet only", "Oral", "Insulin", "Other SubQ", "Other", "Unknown", ""],
+    "infendo": YES_OR_EMPTY,
+    "infendty": ["Treated", "Active", ""],
+    "chrlungd": [
         "No",
         "Mild",
         "Moderate",
@@ -848,14 +2518,11 @@ def validate_and_return_csv_data(csv_entry):
         "Severity Unknown",
         "Unknown",
         "",
-    ], "Invalid chrlungd"
-
-    stenosis_pct = ["50% to 79%", "80% to 99%", "100%", "Not documented", ""]
-    assert data["cvdstenrt"] in stenosis_pct, "Invalid cvdstenrt"
-    assert data["cvdstenlft"] in stenosis_pct, "Invalid cvdstenlft"
-
-    assert data["ivdrugab"] in yes_or_empty, "Invalid ivdrugab"
-    assert data["alcohol"] in [
+    ],
+    "cvdstenrt": STENOSIS_PCT,
+    "cvdstenlft": STENOSIS_PCT,
+    "ivdrugab": YES_OR_EMPTY,
+    "alcohol": [
         "<= 1 drink/week",
         "2-7 drinks/week",
         ">= 8 drinks/week",
@@ -864,18 +2531,9 @@ def validate_and_return_csv_data(csv_entry):
         "None",
         "Unknown",
         "",
-    ], "Invalid alcohol"
-
-    assert data["pneumonia"] in [
-        "Recent",
-        "Remote",
-        "No",
-        "Unknown",
-        "Yes",
-        "",
-    ], "Invalid pneumonia"
-
-    assert data["tobaccouse"] in [
+    ],
+    "pneumonia": ["Recent", "Remote", "No", "Unknown", "Yes", ""],
+    "tobaccouse": [
         "Never smoker",
         "Current every day smoker",
         "Current some day smoker",
@@ -884,44 +2542,16 @@ def validate_and_return_csv_data(csv_entry):
         "Former smoker",
         "Smoking status unknown",
         "",
-    ], "Invalid tobaccouse"
-
-    assert data["hmo2"] in [
-        "Yes, PRN",
-        "Yes, oxygen dependent",
-        "No",
-        "Unknown",
-        "Yes",
-        "",
-    ], "Invalid hmo2"
-
+    ],
+    "hmo2": ["Yes, PRN", "Yes, oxygen dependent", "No", "Unknown", "Yes", ""],
     ## Previous interventions
-    assert data["prcvint"] in yes_or_empty, "Invalid prcvint"
-
-    assert data["prcab"] in yes_or_empty, "Invalid prcab"  # cabg
-    assert data["prvalve"] in yes_or_empty, "Invalid prvalve"  # valve
-    assert data["poc"] in yes_or_empty, "Invalid poc"  # other cardiac
-    assert data["pocpci"] in yes_or_empty, "Invalid pocpci"  # pci
-
-    ## Details of previous procedures are not validated yet
-    """
-    "prvalveproc1": "",
-    "prvalveproc2": "",
-    "prvalveproc3": "",
-    "prvalveproc4": "",
-    "prvalveproc5": "",
-    "pocint1": "",
-    "pocint2": "",
-    "pocint3": "",
-    "pocint4": "",
-    "pocint5": "",
-    "pocint6": "",
-    "pocint7": "",
-    "pocpciwhen": "",
-    """
-    assert data["pocpciin"] in ["<= 6 Hours", ">6 Hours", ""], "Invalid pocpciin"
-
-    assert data["miwhen"] in [
+    "prcvint": YES_OR_EMPTY,
+    "prcab": YES_OR_EMPTY,  # cabg
+    "prvalve": YES_OR_EMPTY,  # valve
+    "poc": YES_OR_EMPTY,  # other cardiac
+    "pocpci": YES_OR_EMPTY,  # pci
+    "pocpciin": ["<= 6 Hours", ">6 Hours", ""],
+    "miwhen": [
         "<=6 Hrs",
         "\u2264 6 Hrs",
         ">6 Hrs but <24 Hrs",
@@ -930,140 +2560,52 @@ def validate_and_return_csv_data(csv_entry):
         ">21 Days",
         "> 21 Days",
         "",
-    ], "Invalid miwhen"
-    assert data["heartfailtmg"] in [
-        "Acute",
-        "Chronic",
-        "Both",
-        "Yes - Acute",
-        "Yes - Chronic",
-        "Yes - Both",
-        "",
-    ], "Invalid heartfailtmg"
-
-    assert data["classnyh"] in [
-        "Class I",
-        "Class II",
-        "Class III",
-        "Class IV",
-        "Not documented",
-        "",
-    ], "Invalid classnyh"
-
-    # Angina sx not yet validated
-    #  "cardsymptimeofadm": "Stable Angina",
-
-    assert data["carshock"] in [
+    ],
+    "heartfailtmg": ["Acute", "Chronic", "Both", "Yes - Acute", "Yes - Chronic", "Yes - Both", ""],
+    "classnyh": ["Class I", "Class II", "Class III", "Class IV", "Not documented", ""],
+    "carshock": [
         "Yes - At the time of the procedure",
         "Yes, not at the time of the procedure but within prior 24 hours",
         "Yes",
         "",
-    ], "Invalid carshock"
-
-    rhythm_onset = ["None", "Remote (> 30 days preop)", "Recent (<= 30 days preop)",
-                     "Remote", "Recent", ""]
-    assert data["arrhythatrfib"] in rhythm_onset, "Invalid arrhythatrfib"
-    assert data["arrhythafib"] in ["Persistent", "Paroxysmal", ""], "Invalid arrhythafib"
-    assert data["arrhythaflutter"] in rhythm_onset, "Invalid arrhythaflutter"
-    assert data["arrhyththird"] in rhythm_onset, "Invalid arrhyththird"
-    assert data["arrhythsecond"] in rhythm_onset, "Invalid arrhythsecond"
-    assert data["arrhythsss"] in rhythm_onset, "Invalid arrhythsss"
-    assert data["arrhythvv"] in rhythm_onset, "Invalid arrhythvv"
-
+    ],
+    "arrhythatrfib": RHYTHM_ONSET,
+    "arrhythafib": ["Persistent", "Paroxysmal", ""],
+    "arrhythaflutter": RHYTHM_ONSET,
+    "arrhyththird": RHYTHM_ONSET,
+    "arrhythsecond": RHYTHM_ONSET,
+    "arrhythsss": RHYTHM_ONSET,
+    "arrhythvv": RHYTHM_ONSET,
     ## Medications
-    assert data["medinotr"] in yes_or_empty, "Invalid medinotr"  # Inotropes
-
+    "medinotr": YES_OR_EMPTY,  # Inotropes
     # NOTE: The API allows contraindicated & unknown, which we ignore.  Yes/No/Empty.
-    assert data["medadp5days"] in yes_or_empty, "Invalid medadp5days"  # ADPi
-    assert (data["medadpidis"] == "") or 0 <= int(
-        float(data["medadpidis"])
-    ) <= 5, "Invalid medadpidis"
-
-    assert data["medacei48"] in yes_or_empty, "Invalid medacei48"  # ACE
-    assert data["medbeta"] in yes_or_empty, "Invalid medbeta"  # BB
-    assert data["medster"] in yes_or_empty, "Invalid medster"  # Steroids
-    assert data["medgp"] in yes_or_empty, "Invalid medgp"  # GP2B3A
-
-    assert data["resusc"] in [
+    "medadp5days": YES_OR_EMPTY,  # ADPi
+    "medadpidis": (lambda value: int(float(value)), 0, 5),
+    "medacei48": YES_OR_EMPTY,  # ACE
+    "medbeta": YES_OR_EMPTY,  # BB
+    "medster": YES_OR_EMPTY,  # Steroids
+    "medgp": YES_OR_EMPTY,  # GP2B3A
+    "resusc": [
         "Yes - Within 1 hour of the start of the procedure",
         "Yes - More than 1 hour but less than 24 hours of the start of the procedure",
         "Yes",
         "",
-    ], "Invalid resusc"
-
+    ],
     # Why is this not an int?!!
-    assert data["numdisv"] in ["None", "One", "Two", "Three", ""], "Invalid numdisv"
-    assert data["stenleftmain"] in ["Yes", "No", "N/A", ""], "Invalid stenleftmain"
+    "numdisv": ["None", "One", "Two", "Three", ""],
+    "stenleftmain": ["Yes", "No", "N/A", ""],
     # Left main > 50%
-    assert data["laddiststenpercent"] in [
-        "50 - 69%",
-        ">=70%",
-        "",
-    ], "Invalid laddiststenpercent"
-
+    "laddiststenpercent": ["50 - 69%", ">=70%", ""],
     # EF
-    assert (data["hdef"] == "") or (1.0 <= float(data["hdef"]) <= 99.0), "Invalid hdef"
-
+    "hdef": (float, 1.0, 99.0),
     ## Valves
-    assert data["vdstena"] in yes_or_empty, "Invalid vdstena"  # AS
-    assert data["vdstenm"] in yes_or_empty, "Invalid vdstenm"  # MS
-
-    valve_severity = [
-        "Trivial/Trace",
-        "Mild",
-        "Moderate",
-        "Severe",
-        "Not documented",
-        "",
-    ]
-    assert data["vdinsufa"] in valve_severity, "Invalid vdinsufa"  # AI
-    assert data["vdinsufm"] in valve_severity, "Invalid vdinsufm"  # MR
-    assert data["vdinsuft"] in valve_severity, "Invalid vdinsuft"  # TR
-
-    valve_indications = [
-        "Bicuspid valve disease",
-        "Unicuspid valve disease",
-        "Quadricuspid valve disease",
-        "Congenital (other than Bicuspid, Unicuspid, or Quadricuspid)",
-        "Degenerative- Calcified",
-        "Degenerative- Leaflet prolapse with or without annular dilatation",
-        "Degenerative- Pure annular dilatation without leaflet prolapse",
-        "Degenerative - Commissural Rupture",
-        "Degenerative - Extensive Fenestration",
-        "Degenerative - Leaflet perforation / hole",
-        "Endocarditis, native valve with root abscess",
-        "Endocarditis, native valve without root abscess",
-        "Endocarditis, prosthetic valve with root abscess",
-        "Endocarditis, prosthetic valve without root abscess",
-        "LV Outflow Tract Pathology, HOCM",
-        "LV Outflow Tract Pathology, Sub-aortic membrane",
-        "LV Outflow Tract Pathology, Sub-aortic tunnel",
-        "LV Outflow Tract Pathology, Other",
-        "Primary Aortic Disease, Aortic Dissection",
-        "Primary Aortic Disease, Atherosclerotic Aneurysm",
-        "Primary Aortic Disease, Ehler-Danlos Syndrome",
-        "Primary Aortic Disease, Hypertensive Aneurysm",
-        "Primary Aortic Disease, Idiopathic Root dilatation",
-        "Primary Aortic Disease, Inflammatory",
-        "Primary Aortic Disease, Loeys-Dietz Syndrome",
-        "Primary Aortic Disease, Marfan Syndrome",
-        "Primary Aortic Disease, Other Connective tissue disorder",
-        "Radiation induced heart disease",
-        "Reoperation - Failure of previous AV repair or replacement",
-        "Rheumatic",
-        "Supravalvular Aortic Stenosis",
-        "Trauma",
-        "Carcinoid",
-        "Tumor, Myxoma",
-        "Tumor, Papillary Fibroelastoma",
-        "Tumor, Other",
-        "Mixed Etiology",
-        "Not documented",
-        "",
-    ]
-    assert data["vdaoprimet"] in valve_indications, "Invalid vdaoprimet"
-
-    assert data["incidenc"] in [
+    "vdstena": YES_OR_EMPTY,  # AS
+    "vdstenm": YES_OR_EMPTY,  # MS
+    "vdinsufa": VALVE_SEVERITY,  # AI
+    "vdinsufm": VALVE_SEVERITY,  # MR
+    "vdinsuft": VALVE_SEVERITY,  # TR
+    "vdaoprimet": VALVE_INDICATIONS,
+    "incidenc": [
         "First cardiovascular surgery",
         "First re-op cardiovascular surgery",
         "Second re-op cardiovascular surgery",
@@ -1078,34 +2620,2135 @@ def validate_and_return_csv_data(csv_entry):
         "ReOp#4+ CV surgery",
         "Not CV surgery",
         "",
-    ], "Invalid incidenc"
+    ],
+    "status": ["Elective", "Urgent", "Emergent", "Emergent Salvage", ""],
+    "iabpwhen": ["Preop", "Intraop", "Postop", ""],
+    "cathbasassistwhen": ["Preop", "Intraop", "Postop", ""],
+    "ecmowhen": ["Preop", "Intraop", "Postop", "Non-operative", ""],
+}
 
-    assert data["status"] in [
-        "Elective",
-        "Urgent",
-        "Emergent",
-        "Emergent Salvage",
-        "",
-    ], "Invalid status"
+# Numbers that must not be empty
+STS_REQUIRED_NUMBERS = {"age"}
+
+# Cross-field rules: if any of the fields is set, the other field must be set too
+STS_DEPENDENT_FIELD_RULES = [
+    (("payorsecond",), "payorprim", "If payorsecond is set, payorprim must also be set"),
+    (
+        ("cvdtia", "cvdpcarsurg"),
+        "cvd",
+        "Invalid cvdpcarsurg, cvd must be set if a TIA or prior cartoid procedure is true.",
+    ),
+    (("cvawhen",), "cva", "Invalid cvawhen: cva must be set to Yes if cvdwhen is defined"),
+    (("diabctrl",), "diabetes", "Invalid diabctrl: diabetes must be set if diabctrl is set"),
+    (("infendty",), "infendo", "Invalid infendty; infendo must be set if infendty is set"),
+]
 
-    assert data["iabpwhen"] in ["Preop", "Intraop", "Postop", ""], "Invalid iabpwhen"
-    assert data["cathbasassistwhen"] in [
-        "Preop",
-        "Intraop",
-        "Postop",
-        "",
-    ], "Invalid cathbasassistwhen"
+# Every column a patient .csv may have
+STS_VALID_KEYS = frozenset(STS_PARAMS_REQUIRED + STS_PARAMS_OPTIONAL)
 
-    assert data["ecmowhen"] in [
-        "Preop",
-        "Intraop",
-        "Postop",
-        "Non-operative",
-        "",
-    ], "Invalid ecmowhen"
 
+class ValidationError(ValueError):
+    """A patient row failed validation. `errors` lists every problem found."""
+
+    def __init__(self, errors):
+        super().__init__("; ".join(errors))
+        self.errors = errors
+
+
+def compile_number_check(converter, low, high, required):
+    """A check that a (string) value converts to a number within [low, high]."""
+
+    def check(value):
+        if value == "":
+            return not required
+        try:
+            return low <= converter(value) <= high
+        except (TypeError, ValueError, OverflowError):
+            # OverflowError: e.g. int(float("inf"))
+            return False
+
+    return check
+
+
+def compile_field_checks(rules):
+    """
+    Compile the validation schema (see STS_FIELD_RULES) into a tuple of
+    (field, check(value) -> bool, error message). Allowed values become
+    frozensets, and numeric ranges become closures.
+    """
+    checks = []
+    for field, rule in rules.items():
+        if isinstance(rule, tuple):
+            converter, low, high = rule
+            check = compile_number_check(converter, low, high, field in STS_REQUIRED_NUMBERS)
+        else:
+            check = frozenset(rule).__contains__
+        checks.append((field, check, f"Invalid {field}"))
+    return tuple(checks)
+
+
+STS_FIELD_CHECKS = compile_field_checks(STS_FIELD_RULES)
+
+
+def validation_errors(data):
+    """
+    Check a complete patient dict (see STS_QUERY_STUB) against the schema.
+    Output: a list of every error found (empty if the row is valid).
+    """
+    errors = [message for field, check, message in STS_FIELD_CHECKS if not check(data[field])]
+    for fields, required_field, message in STS_DEPENDENT_FIELD_RULES:
+        if data[required_field] == "" and any(data[field] != "" for field in fields):
+            errors.append(message)
+    return errors
+
+
+SURGDT_ERROR = "Invalid surgdt (must be MM/DD/YYYY)"
+
+
+def normalize_surgery_date(value):
+    """Parse a MM/DD/YYYY date, and return it 0-padded. Raises a ValueError if it's invalid."""
+    # TODO: Double check the STS API handles 0 padding
+    return datetime.datetime.strptime(value, "%m/%d/%Y").strftime("%m/%d/%Y")
+
+
+def validate_and_return_csv_data(csv_entry):
+    """
+    Extensively validate the dict we're about to pass to the STS API.
+
+    Note that we validate ~most fields, but not all prior procedures if those are entered.
+
+    (Please open a Github issue if you find a problem with your data validation.)
+
+    Input: patient_data (dict)
+    Output: returns a dict that passed validation, union with the STS_QUERY_STUB
+    Raises a ValidationError listing every problem in the row.
+    """
+    # Check the parameters are all allowable
+    key_difference = csv_entry.keys() - STS_VALID_KEYS
+    if key_difference:
+        raise ValidationError(
+            [f"You have one or more columns that are not defined STS keys: {key_difference}"]
+        )
+
+    # Union of these two dicts, overwriting keys from the user supplied CSV entries where able
+    data = STS_QUERY_STUB | csv_entry
+
+    errors = validation_errors(data)
+
+    try:
+        data["surgdt"] = normalize_surgery_date(data["surgdt"])
+    except (TypeError, ValueError):
+        errors.append(SURGDT_ERROR)
+
+    if errors:
+        raise ValidationError(errors)
     return data
 
+def parse_overrides(override_args):
+    """
+    Parse --override values (e.g. ["age=50", "dialysis=Yes"]), which take priority over anything in the .csv.
+    Output: dict of STS variable -> value
+    """
+    override_dict = {}
+    if override_args:
+        print(
+            "NOTE: Override values supplied -- these will be sent to the STS API instead of the values in your .csv"
+        )
+
+        for entry in override_args:
+            split_entry = entry.split("=")
+            assert len(split_entry) == 2, "Can't handle multiple = in override value."
+            assert split_entry[0] != "id", "Cannot override patient ID."
+            override_dict[split_entry[0]] = split_entry[1]
+
+        assert all(
+            key in STS_PARAMS_REQUIRED + STS_PARAMS_OPTIONAL
+            for key in override_dict.keys()
+        ), "Override value is not one of the defined STS keys."
+        print(f"\tOverriding: {override_dict}")
+    return override_dict
+
+
+def parse_sweep_scenarios(sweep_args):
+    """
+    Parse --sweep values: every patient is queried once per scenario.
+    Output: (scenarios, or None without --sweep, and the label columns of each result row)
+    """
+    if not sweep_args:
+        return None, ("id",)
+    scenarios = parse_sweep(sweep_args)
+    print(f"NOTE: Sweeping {len(scenarios)} scenarios per patient: {[scenario_label(s) for s in scenarios]}")
+    return scenarios, ("id", "scenario")
+
+
+def parse_sweep(sweep_args):
+    """
+    Expand --sweep arguments into the Cartesian product of scenarios.
+    Input: e.g. ["age=50,60", "dialysis=Yes,"]
+    Output: a list of override dicts, e.g. [{"age": "50", "dialysis": "Yes"}, {"age": "50", "dialysis": ""}, …]
+    """
+    fields = {}
+    for entry in sweep_args:
+        field, separator, values = entry.partition("=")
+        assert separator, f"Sweep values must look like stsvariable=value1,value2: {entry}"
+        assert field != "id", "Cannot sweep patient ID."
+        assert field in STS_PARAMS_REQUIRED, f"Sweep value is not one of the defined STS keys: {field}"
+        assert field not in fields, f"Sweep field given twice: {field}"
+        # Several STS options contain ", " themselves (e.g. "Yes, PRN"), so only
+        # a comma that isn't followed by a space separates values.
+        fields[field] = re.split(r",(?! )", values)
+    return [dict(zip(fields, combination)) for combination in itertools.product(*fields.values())]
+
+
+def scenario_label(scenario):
+    """The label of a --sweep scenario in the output, e.g. "age=50;dialysis=Yes"."""
+    return ";".join(f"{field}={value}" for field, value in scenario.items())
+
+
+async def run_mock_server(
+    host="127.0.0.1", port=0, latency=0.2, jitter=0.05, error_rate=0.0, max_connections=None, ready=None
+):
+    """
+    Run a local stand-in for the STS Shiny app, until cancelled.
+
+    It speaks the same init/update websocket protocol and answers with a text2
+    HTML risk table in the format parse_sts_html_response() expects. The
+    (fake) risks are derived from a hash of the inputs, so they're stable.
+    `latency` +/- `jitter` seconds are added to each calculation, a fraction
+    `error_rate` of updates drop the connection, and handshakes beyond
+    `max_connections` open connections are refused with HTTP 503.
+
+    If given, `ready(port)` is called once the server is listening.
+    """
+    labels = [html.escape(label) for label in STS_RESULT_LABELS]
+    open_connections = set()
+
+    def frame(message):
+        return json.dumps(message, separators=(",", ":"))
+
+    def values_frame(html):
+        return frame({"errors": {}, "values": {"text2": {"html": html, "deps": []}}, "inputMessages": []})
+
+    def risk_table(inputs):
+        digest = hashlib.sha256(json.dumps(inputs, sort_keys=True).encode("utf-8")).digest()
+        rows = "".join(
+            f"<tr><td>{label}</td><td>{int.from_bytes(digest[2 * i:2 * i + 2], 'big') / 65535 * 50:.3f}%</td></tr>"
+            for i, label in enumerate(labels)
+        )
+        return f'<table class="table">{rows}</table>'
+
+    def process_request(connection, request):
+        if max_connections is not None and len(open_connections) >= max_connections:
+            return connection.respond(http.HTTPStatus.SERVICE_UNAVAILABLE, "Too many connections\n")
+
+    async def handler(ws):
+        open_connections.add(ws)
+        inputs = None
+        try:
+            async for msg in ws:
+                message = json.loads(msg)
+                if message.get("method") == "init":
+                    inputs = dict(message["data"])
+                    await ws.send(frame({"config": {"workerId": "", "sessionId": os.urandom(16).hex()}}))
+                    await ws.send(frame({"busy": "busy"}))
+                    await ws.send(values_frame("<p>Selection Required</p>"))
+                    await ws.send(frame({"busy": "idle"}))
+                elif message.get("method") == "update" and inputs is not None:
+                    if random.random() < error_rate:
+                        await ws.close(1011, "Injected error")
+                        return
+                    updated = inputs | message["data"]
+                    if updated == inputs:
+                        # Like Shiny: nothing changed, so nothing is recalculated
+                        continue
+                    inputs = updated
+                    await ws.send(frame({"busy": "busy"}))
+                    await asyncio.sleep(max(latency + random.uniform(-jitter, jitter), 0))
+                    await ws.send(values_frame(risk_table(inputs)))
+                    await ws.send(frame({"busy": "idle"}))
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            open_connections.discard(ws)
+
+    async with websockets.serve(handler, host, port, process_request=process_request) as server:
+        if ready is not None:
+            ready(server.sockets[0].getsockname()[1])
+        await asyncio.Future()
+
+
+def mock_server_main(argv):
+    """`sts-query mock-server`: run a local stand-in for the STS server."""
+    parser = argparse.ArgumentParser(
+        prog="sts-query mock-server",
+        description="Run a local stand-in for the STS Shiny websocket server, for testing and benchmarks.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("--host", default="127.0.0.1", help="Interface to listen on.")
+    parser.add_argument("--port", type=int, default=8765, help="Port to listen on.")
+    add_mock_server_arguments(parser)
+    args = parser.parse_args(argv)
+
+    def ready(port):
+        print(f"Mock STS server listening on ws://{args.host}:{port}/ (Ctrl-C to stop)")
+        print(f"Use it with: sts-query --server-url ws://{args.host}:{port}/ …")
+
+    try:
+        asyncio.run(
+            run_mock_server(
+                args.host,
+                args.port,
+                latency=args.latency,
+                jitter=args.jitter,
+                error_rate=args.error_rate,
+                max_connections=args.max_connections,
+                ready=ready,
+            )
+        )
+    except KeyboardInterrupt:
+        pass
+
+
+def add_mock_server_arguments(parser):
+    """Mock server behaviour options, shared by `mock-server` and `bench`."""
+    parser.add_argument("--latency", type=float, default=0.2, help="Seconds per risk calculation.")
+    parser.add_argument("--jitter", type=float, default=0.05, help="Random +/- seconds added to the latency.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of updates that drop the connection.")
+    parser.add_argument(
+        "--max-connections", type=int, default=None, help="Refuse handshakes beyond this many open connections."
+    )
+
+
+def synthetic_patients(count, seed=0):
+    """Generate `count` valid, distinct STS query dicts for benchmarks."""
+    rng = random.Random(seed)
+    patients = []
+    for i in range(count):
+        row = {
+            "id": str(i),
+            "procid": rng.choice(list(PROCID_TO_PROC)),
+            "age": str(rng.randint(18, 100)),
+            "gender": rng.choice(["Male", "Female"]),
+            "surgdt": f"{rng.randint(1, 12)}/{rng.randint(1, 28)}/{rng.randint(2015, 2024)}",
+            "weightkg": f"{rng.uniform(45, 140):.1f}",
+            "heightcm": f"{rng.uniform(140, 200):.1f}",
+            "creatlst": f"{rng.uniform(0.5, 4):.2f}",
+            "dialysis": rng.choice(["Yes", ""]),
+            "diabetes": rng.choice(["Yes", ""]),
+            "hypertn": rng.choice(["Yes", ""]),
+        }
+        entry = validate_and_return_csv_data(row)
+        del entry["id"]
+        patients.append(entry)
+    return patients
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return float("nan")
+    rank = max(int(round(fraction * len(sorted_values) + 0.5)) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+async def run_benchmark(url, patients, concurrency, reuse_sessions=True):
+    """
+    Query every patient once at the given concurrency.
+    Output: (elapsed seconds, sorted per-patient latencies, error count)
+    """
+    querier = PayloadQuerier(concurrency=concurrency, reuse_sessions=reuse_sessions, url=url)
+    pending = iter(patients)
+    latencies = []
+    errors = 0
+
+    async def worker():
+        nonlocal errors
+        for entry in pending:
+            start = time.monotonic()
+            try:
+                await querier.query(*prepare_payload(entry), QueryTrace())
+            except Exception:
+                errors += 1
+                continue
+            latencies.append(time.monotonic() - start)
+
+    start = time.monotonic()
+    try:
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+    finally:
+        await querier.close()
+    return time.monotonic() - start, sorted(latencies), errors
+
+
+def microbenchmark(label, func):
+    """Time `func()` and print the mean time per call."""
+    number, elapsed = timeit.Timer(func).autorange()
+    print(f"{label:<52} {1e6 * elapsed / number:>10.2f} µs/call")
+
+
+def run_microbenchmarks():
+    """CPU cost of the per-patient client-side work, without any network."""
+    result_html = (
+        '<table class="table">'
+        + "".join(
+            f"<tr><td>{html.escape(label)}</td><td>{i + 1.5:.3f}%</td></tr>"
+            for i, label in enumerate(STS_RESULT_LABELS)
+        )
+        + "</table>"
+    )
+    # A typical sequence of frames following an update
+    frames = [
+        json.dumps({"busy": "busy"}),
+        json.dumps({"recalculating": {"name": "text2", "status": "recalculating"}}),
+        json.dumps({"progress": {"type": "binding", "message": {"id": "summary"}}}),
+        json.dumps({"errors": {}, "values": {"summary": {"html": "<div>" + "x" * 4000 + "</div>"}}, "inputMessages": []}),
+        json.dumps({"errors": {}, "values": {"text2": {"html": result_html, "deps": []}}, "inputMessages": []}),
+        json.dumps({"busy": "idle"}),
+    ]
+
+    def decode_every_frame():
+        for msg in frames:
+            json.loads(msg)
+
+    def prefiltered_frames():
+        for msg in frames:
+            if is_result_frame(msg):
+                json.loads(msg)
+
+    print(f"Microbenchmarks ({len(frames)} frames per update)")
+    microbenchmark("frames: json.loads() every frame", decode_every_frame)
+    microbenchmark("frames: is_result_frame() pre-filter, then decode", prefiltered_frames)
+    microbenchmark("parse_sts_html_response()", lambda: parse_sts_html_response(result_html))
+
+    # Encoding one patient's messages
+    patient = synthetic_patients(1)[0]
+    microbenchmark("prepare_update_data()", lambda: prepare_update_data(patient))
+    microbenchmark("prepare_websocket_messages()", lambda: prepare_websocket_messages(patient))
+    microbenchmark(
+        "update message on a reused session",
+        lambda: encode_update_message(SESSION_RESET_DATA | prepare_update_data(patient)),
+    )
+
+    # Validating a large .csv (--dry-run), row by row and by column
+    cohort_csv = io.StringIO()
+    writer = csv.DictWriter(cohort_csv, fieldnames=["id"] + STS_PARAMS_REQUIRED)
+    writer.writeheader()
+    for patient_id, patient in enumerate(synthetic_patients(10000), start=1):
+        writer.writerow({"id": str(patient_id)} | patient)
+
+    def validate(validator):
+        return validator(csv.DictReader(io.StringIO(cohort_csv.getvalue())), {}, [])
+
+    assert list(validate(validate_csv_columns)) == list(validate(iter_validated_rows))
+    microbenchmark("validate 10k rows: row by row", lambda: list(validate(iter_validated_rows)))
+    microbenchmark(
+        f"validate 10k rows: columnar ({'NumPy' if import_numpy() else 'no NumPy'})",
+        lambda: validate(validate_csv_columns),
+    )
+    microbenchmark(
+        "validate 10k rows: columnar, then build the rows",
+        lambda: list(validate(validate_csv_columns)),
+    )
+
+    # Writing 10k results, a row at a time (as before ResultWriter buffered them) and in row groups
+    import tempfile
+
+    result = dict(zip(STS_EXPECTED_RESULTS, (0.001 * (i + 1) for i in range(len(STS_EXPECTED_RESULTS)))))
+
+    def write_results(path, output_format, row_group):
+        with ResultWriter(path, output_format=output_format, row_group=row_group) as writer:
+            for index in range(10000):
+                writer.add(index, {"id": str(index)}, dict(result))
+
+    with tempfile.TemporaryDirectory() as directory:
+        for output_format in OUTPUT_SINKS:
+            if output_format == "parquet" and import_pyarrow() is None:
+                continue
+            path = os.path.join(directory, f"results.{output_format}")
+            # A row group per row would make a pathological Parquet file
+            for row_group in (1, OUTPUT_ROW_GROUP_ROWS) if output_format != "parquet" else (OUTPUT_ROW_GROUP_ROWS,):
+                microbenchmark(
+                    f"write 10k results: {output_format}, {row_group} row(s) per write",
+                    lambda: write_results(path, output_format, row_group),
+                )
+
+
+# Run by `sts-query bench --startup` in a fresh interpreter: prints which QUERY_ONLY_MODULES were loaded
+STARTUP_CHECK_CODE = """
+import sys
+import sts_query
+sys.argv = ["sts-query"] + sys.argv[1:]
+if len(sys.argv) > 1:
+    try:
+        sts_query.main()
+    except SystemExit:
+        pass
+loaded = [name for name in sts_query.QUERY_ONLY_MODULES if type(sys.modules.get(name)) is type(sys)]
+print("loaded:", " ".join(loaded))
+"""
+
+
+def run_startup_check(code, *argv):
+    """
+    Run STARTUP_CHECK_CODE under `python -X importtime`.
+    Output: (import time of sts_query in ms, list of QUERY_ONLY_MODULES that were loaded)
+    """
+    import subprocess
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    # Time the import from cached bytecode, as installed copies run
+    env = {key: value for key, value in os.environ.items() if key != "PYTHONDONTWRITEBYTECODE"}
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code, *argv],
+        cwd=here,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    # Lines look like "import time:  self [us] | cumulative | imported package"
+    import_us = next(
+        int(line.split("|")[1]) for line in result.stderr.splitlines() if line.split("|")[-1].strip() == "sts_query"
+    )
+    loaded = next(line for line in result.stdout.splitlines() if line.startswith("loaded:"))
+    return import_us / 1000, loaded.split()[1:]
+
+
+def run_startup_checks(runs=5):
+    """
+    Startup time budget: the median `import sts_query` time must be under STARTUP_BUDGET_MS, and
+    importing, --help and --dry-run must not load any of QUERY_ONLY_MODULES.
+    Output: True if all checks pass.
+    """
+    import tempfile
+
+    run_startup_check(STARTUP_CHECK_CODE)  # Warm up (writes the .pyc)
+    times = sorted(run_startup_check(STARTUP_CHECK_CODE)[0] for _ in range(runs))
+    median = times[len(times) // 2]
+    passed = median <= STARTUP_BUDGET_MS
+    print(f"{'import sts_query':<24} {median:>7.1f} ms (median of {runs}, budget {STARTUP_BUDGET_MS} ms)")
+
+    with tempfile.NamedTemporaryFile("w", suffix=".csv", newline="", delete=False) as cohort_csv:
+        writer = csv.DictWriter(cohort_csv, fieldnames=["id"] + STS_PARAMS_REQUIRED)
+        writer.writeheader()
+        for patient_id, patient in enumerate(synthetic_patients(100), start=1):
+            writer.writerow({"id": str(patient_id)} | patient)
+    try:
+        for label, argv in [
+            ("import sts_query", []),
+            ("--help", ["--help"]),
+            ("--dry-run", ["--csv", cohort_csv.name, "--dry-run"]),
+        ]:
+            loaded = run_startup_check(STARTUP_CHECK_CODE, *argv)[1]
+            passed = passed and not loaded
+            print(f"{label:<24} loads {', '.join(loaded) or 'no query-only modules'}")
+    finally:
+        os.remove(cohort_csv.name)
+    print("Startup checks passed." if passed else "Startup checks FAILED.")
+    return passed
+
+
+def bench_main(argv):
+    """`sts-query bench`: measure end-to-end throughput against a mock server."""
+    parser = argparse.ArgumentParser(
+        prog="sts-query bench",
+        description="Measure end-to-end query throughput and latency against a local mock STS server. "
+        + "(Never point this at the real STS server.)",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("--rows", type=int, default=200, help="Synthetic patients per run.")
+    parser.add_argument(
+        "--concurrency",
+        default="1,4,16",
+        help="Comma-separated concurrency settings to compare.",
+    )
+    parser.add_argument(
+        "--no-session-reuse",
+        dest="reuse_sessions",
+        action="store_false",
+        help="Open a new session for every patient.",
+    )
+    parser.add_argument(
+        "--url",
+        help="Benchmark an already running `sts-query mock-server` instead of starting one in-process.",
+    )
+    parser.add_argument(
+        "--micro",
+        action="store_true",
+        help="Only run microbenchmarks of the client-side CPU work (no network).",
+    )
+    parser.add_argument(
+        "--startup",
+        action="store_true",
+        help="Only check the startup time budget: fails if `import sts_query` takes over "
+        + f"{STARTUP_BUDGET_MS} ms (per python -X importtime), or if importing, --help or --dry-run "
+        + "loads the network or progress bar modules.",
+    )
+    add_mock_server_arguments(parser)
+    args = parser.parse_args(argv)
+    if args.micro:
+        run_microbenchmarks()
+        return
+    if args.startup:
+        if not run_startup_checks():
+            sys.exit(1)
+        return
+    concurrencies = [int(value) for value in args.concurrency.split(",")]
+    patients = synthetic_patients(args.rows)
+
+    async def run():
+        server = None
+        url = args.url
+        if url is None:
+            listening = asyncio.get_running_loop().create_future()
+            server = asyncio.ensure_future(
+                run_mock_server(
+                    latency=args.latency,
+                    jitter=args.jitter,
+                    error_rate=args.error_rate,
+                    max_connections=args.max_connections,
+                    ready=listening.set_result,
+                )
+            )
+            url = f"ws://127.0.0.1:{await listening}/"
+        print(f"Benchmarking {url} with {args.rows} patients per run")
+        print(f"{'concurrency':>11} {'rows/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>6}")
+        try:
+            for concurrency in concurrencies:
+                elapsed, latencies, errors = await run_benchmark(url, patients, concurrency, args.reuse_sessions)
+                print(
+                    f"{concurrency:>11} {len(latencies) / elapsed:>8.1f} "
+                    f"{1000 * percentile(latencies, 0.50):>8.0f} {1000 * percentile(latencies, 0.95):>8.0f} "
+                    f"{1000 * percentile(latencies, 0.99):>8.0f} {errors:>6}"
+                )
+        finally:
+            if server is not None:
+                server.cancel()
+                await asyncio.gather(server, return_exceptions=True)
+
+    asyncio.run(run())
+
+
+# Where the time goes in a profiled run: (span, functions, minus functions whose time is already in
+# another span). Functions are qualified names in this module (matched exactly, so only
+# ResultWriter.add counts as output, not every method named add), or (file name, function name)
+# in the standard library.
+PROFILE_SPANS = [
+    ("CSV parsing", [("csv.py", "__next__")], []),
+    ("validation", ["validate_and_return_csv_data", "failing_rows"], []),
+    ("translation", ["translate_csv_to_shiny"], []),
+    ("encoding", ["prepare_update_data", "encode_update_message", "payload_key"], ["translate_csv_to_shiny"]),
+    ("network wait", [("selectors.py", "select")], []),
+    ("result parsing", ["parse_sts_html_response"], []),
+    ("output", ["ResultWriter.add", "ResultWriter.close"], []),
+]
+
+
+def profile_spans(stats):
+    """
+    Split a profile into PROFILE_SPANS.
+    Input: a pstats.Stats
+    Output: [(span, seconds), …]
+    """
+
+    def code_key(qualname):
+        # pstats keys are (file, first line, function name), as in a code object
+        code = functools.reduce(getattr, qualname.split("."), sys.modules[__name__]).__code__
+        return code.co_filename, code.co_firstlineno, code.co_name
+
+    def cumulative(functions):
+        ours = {code_key(function) for function in functions if isinstance(function, str)}
+        library = {function for function in functions if not isinstance(function, str)}
+        return sum(
+            cumtime
+            for (filename, line, funcname), (_, _, _, cumtime, _) in stats.stats.items()
+            if (filename, line, funcname) in ours or (os.path.basename(filename), funcname) in library
+        )
+
+    return [(span, cumulative(functions) - cumulative(minus)) for span, functions, minus in PROFILE_SPANS]
+
+
+def run_profiled(func, profile_file, memory=False, top=20):
+    """
+    Run func() under cProfile (and tracemalloc, with `memory`), even if it exits or is interrupted.
+    Saves the profile to `profile_file`, and prints the time per span, the `top` hottest functions
+    and, with `memory`, the peak memory use and the `top` allocation sites.
+    """
+    import cProfile
+    import pstats
+    import tracemalloc
+
+    if memory:
+        tracemalloc.start()
+    profiler = cProfile.Profile()
+    start = time.perf_counter()
+    try:
+        profiler.runcall(func)
+    finally:
+        elapsed = time.perf_counter() - start
+        profiler.dump_stats(profile_file)
+        stats = pstats.Stats(profiler)
+        print(f"\nProfile saved to {profile_file} ({elapsed:.2f} s wall time)")
+        for span, seconds in profile_spans(stats):
+            print(f"\t{span:<16} {seconds:>9.3f} s {100 * seconds / elapsed:>6.1f}%")
+        print(f"\nTop {top} functions by cumulative time:")
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(top)
+        print(f"Top {top} functions by internal time:")
+        stats.sort_stats(pstats.SortKey.TIME).print_stats(top)
+        if memory:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print(f"Memory: {peak / 2**20:.1f} MiB at peak, {current / 2**20:.1f} MiB still allocated at the end")
+            print(f"Top {top} allocation sites (still allocated at the end):")
+            for statistic in snapshot.statistics("lineno")[:top]:
+                print(f"\t{statistic}")
+
+
+class ScoringService:
+    """
+    `sts-query serve`: score patients over HTTP/JSON, on one warm PayloadQuerier (session pool,
+    rate controller and result cache) shared by every request.
+
+    POST /score takes one patient dict, or a list of them, with the same columns as the .csv.
+    Each patient gets back {"id": ..., "result": {...}} or {"id": ..., "error": "..."}.
+    GET /metrics has the query metrics (see QueryStats) plus per-request latency and throughput, in
+    the Prometheus text format; GET /metrics.json has the same as JSON. GET /health is a liveness check.
+    """
+
+    def __init__(self, concurrency=4, cache=None, url=None):
+        self.stats = QueryStats()
+        self.querier = PayloadQuerier(concurrency, stats=self.stats, cache=cache, url=url)
+        self.started = time.monotonic()
+        self.requests = collections.Counter()  # (endpoint, HTTP status) -> requests
+        self.request_latency = LatencyHistogram()  # Of /score requests
+        self.patients = collections.Counter()  # "result" or "error" -> patients scored
+
+    async def close(self):
+        await self.querier.close()
+
+    async def score(self, patient):
+        """
+        Score one patient.
+        Input: a patient dict, with the same columns as the .csv
+        Output: (HTTPStatus, {"id": ..., "result": STS results dict} or {"id": ..., "error": why it failed})
+
+        The status blames the right side: 422 if the patient is invalid, 503 if the circuit breaker gave
+        up on the STS server, 502 if the STS query failed otherwise.
+        """
+        patient_id = patient.get("id")
+        try:
+            entry = validate_and_return_csv_data(patient)
+            entry.pop("id", None)
+            entry, update_data, key = prepare_payload(entry)
+            self.stats.rows += 1
+            trace = QueryTrace()
+            result = self.querier.cached(key, trace)
+            if result is None:
+                result = await self.querier.query(entry, update_data, key, trace)
+        except Exception as error:
+            self.patients["error"] += 1
+            if isinstance(error, ValidationError):
+                status = http.HTTPStatus.UNPROCESSABLE_ENTITY
+            elif isinstance(error, ServerDownError):
+                status = http.HTTPStatus.SERVICE_UNAVAILABLE
+            else:
+                status = http.HTTPStatus.BAD_GATEWAY
+            return status, {"id": patient_id, "error": str(error)}
+        self.patients["result"] += 1
+        return http.HTTPStatus.OK, {"id": patient_id, "result": result}
+
+    async def handle(self, method, path, body):
+        """
+        Answer one HTTP request.
+        Output: (HTTPStatus, content type, response body bytes)
+        """
+        if path == "/score" and method == "POST":
+            try:
+                patients = json.loads(body)
+            except ValueError as error:
+                return self.json_response(http.HTTPStatus.BAD_REQUEST, {"error": f"Invalid JSON: {error}"})
+            if isinstance(patients, dict):
+                return self.json_response(*await self.score(patients))
+            if isinstance(patients, list) and all(isinstance(patient, dict) for patient in patients):
+                # The session pool bounds how many of these query at once
+                scored = await asyncio.gather(*(self.score(patient) for patient in patients))
+                return self.json_response(http.HTTPStatus.OK, [outcome for _, outcome in scored])
+            return self.json_response(
+                http.HTTPStatus.BAD_REQUEST, {"error": "Expected a patient object, or a list of them"}
+            )
+        if path in ("/metrics", "/metrics.json", "/health") and method != "GET":
+            return self.json_response(http.HTTPStatus.METHOD_NOT_ALLOWED, {"error": "Use GET"})
+        if path == "/metrics":
+            return http.HTTPStatus.OK, "text/plain; version=0.0.4", self.prometheus_text().encode("utf-8")
+        if path == "/metrics.json":
+            return self.json_response(http.HTTPStatus.OK, self.metrics())
+        if path == "/health":
+            return self.json_response(http.HTTPStatus.OK, {"status": "ok"})
+        if path == "/score":
+            return self.json_response(http.HTTPStatus.METHOD_NOT_ALLOWED, {"error": "Use POST"})
+        return self.json_response(http.HTTPStatus.NOT_FOUND, {"error": f"Unknown path: {path}"})
+
+    @staticmethod
+    def json_response(status, content):
+        return status, "application/json", json.dumps(content).encode("utf-8")
+
+    async def serve_connection(self, reader, writer):
+        """Serve one HTTP/1.1 client connection (with keep-alive), until either side closes it."""
+        try:
+            while request_line := await reader.readline():
+                try:
+                    method, target, version = request_line.decode("latin-1").split()
+                except ValueError:
+                    break
+                headers = {}
+                while (line := await reader.readline()).strip():
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                path = target.split("?", 1)[0]
+                length = headers.get("content-length") or "0"
+                length = int(length) if length.isdigit() else None
+                start = time.monotonic()
+                if "transfer-encoding" in headers:
+                    status, content_type, content = self.json_response(
+                        http.HTTPStatus.LENGTH_REQUIRED, {"error": "Send a Content-Length"}
+                    )
+                elif length is None:
+                    status, content_type, content = self.json_response(
+                        http.HTTPStatus.BAD_REQUEST, {"error": "Invalid Content-Length"}
+                    )
+                elif length > SERVE_MAX_BODY_BYTES:
+                    status, content_type, content = self.json_response(
+                        http.HTTPStatus.REQUEST_ENTITY_TOO_LARGE, {"error": f"Over {SERVE_MAX_BODY_BYTES} bytes"}
+                    )
+                else:
+                    body = await reader.readexactly(length)
+                    status, content_type, content = await self.handle(method, path, body)
+                self.requests[path if path in SERVE_ENDPOINTS else "other", status.value] += 1
+                if path == "/score":
+                    self.request_latency.observe(time.monotonic() - start)
+                keep_alive = (
+                    version == "HTTP/1.1"
+                    and headers.get("connection", "").lower() != "close"
+                    and length is not None
+                    and status not in (http.HTTPStatus.LENGTH_REQUIRED, http.HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+                )
+                head = (
+                    f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+                    f"Content-Type: {content_type}\r\n"
+                    f"Content-Length: {len(content)}\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+                )
+                writer.write(head.encode("latin-1") + content)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    def metrics(self):
+        """Request and query metrics, as a JSON-friendly dict (GET /metrics.json)."""
+        uptime = time.monotonic() - self.started
+        return {
+            "uptime_seconds": uptime,
+            "requests": [
+                {"endpoint": endpoint, "status": status, "count": count}
+                for (endpoint, status), count in sorted(self.requests.items())
+            ],
+            "patients": dict(self.patients),
+            "patients_per_second": sum(self.patients.values()) / uptime if uptime else 0.0,
+            "single_flight": {"leaders": self.querier.in_flight.leaders, "shared": self.querier.in_flight.shared},
+            "circuit_breaker": {
+                "state": self.querier.breaker.state,
+                "trips": self.querier.breaker.trips,
+                "paused_seconds": self.querier.breaker.paused_seconds,
+            },
+            "score_request_seconds": {
+                "count": self.request_latency.count,
+                "sum_seconds": self.request_latency.sum,
+                "p50_seconds": self.request_latency.quantile(0.5),
+                "p95_seconds": self.request_latency.quantile(0.95),
+                "p99_seconds": self.request_latency.quantile(0.99),
+            },
+            "queries": self.stats.metrics(),
+        }
+
+    def prometheus_text(self):
+        """Request and query metrics, in the Prometheus text exposition format (GET /metrics)."""
+        lines = [
+            "# HELP sts_serve_uptime_seconds Seconds since `sts-query serve` started.",
+            "# TYPE sts_serve_uptime_seconds gauge",
+            f"sts_serve_uptime_seconds {time.monotonic() - self.started}",
+            "# HELP sts_serve_requests_total HTTP requests, by endpoint and status.",
+            "# TYPE sts_serve_requests_total counter",
+        ]
+        lines += [
+            f'sts_serve_requests_total{{endpoint="{endpoint}",status="{status}"}} {count}'
+            for (endpoint, status), count in sorted(self.requests.items())
+        ]
+        lines += [
+            "# HELP sts_serve_patients_total Patients scored, by outcome.",
+            "# TYPE sts_serve_patients_total counter",
+        ]
+        lines += [f'sts_serve_patients_total{{outcome="{outcome}"}} {count}' for outcome, count in self.patients.items()]
+        lines += [
+            "# HELP sts_serve_single_flight_total Server queries that went out (leader), or that shared "
+            + "the result of an identical query in flight (shared).",
+            "# TYPE sts_serve_single_flight_total counter",
+            f'sts_serve_single_flight_total{{role="leader"}} {self.querier.in_flight.leaders}',
+            f'sts_serve_single_flight_total{{role="shared"}} {self.querier.in_flight.shared}',
+        ]
+        breaker = self.querier.breaker
+        lines += [
+            "# HELP sts_serve_breaker_open Whether the circuit breaker is pausing queries (open or half-open).",
+            "# TYPE sts_serve_breaker_open gauge",
+            f"sts_serve_breaker_open {int(breaker.state != 'closed')}",
+            "# HELP sts_serve_breaker_trips_total Times the circuit breaker opened.",
+            "# TYPE sts_serve_breaker_trips_total counter",
+            f"sts_serve_breaker_trips_total {breaker.trips}",
+        ]
+        lines += [
+            "# HELP sts_serve_score_request_seconds Time to answer a POST /score request.",
+            "# TYPE sts_serve_score_request_seconds histogram",
+        ]
+        histogram = self.request_latency
+        lines += [
+            f'sts_serve_score_request_seconds_bucket{{le="{histogram.bucket_label(upper)}"}} {count}'
+            for upper, count in histogram.cumulative_counts()
+        ]
+        lines += [
+            f"sts_serve_score_request_seconds_sum {histogram.sum}",
+            f"sts_serve_score_request_seconds_count {histogram.count}",
+        ]
+        return "\n".join(lines) + "\n" + self.stats.prometheus_text()
+
+
+async def run_scoring_service(service, host="127.0.0.1", port=8780, socket_path=None, warm=True, ready=None):
+    """
+    Serve `service` (a ScoringService) on a TCP port, or a Unix socket if `socket_path` is given, until cancelled.
+    With `warm`, the session pool connects before the first request. If given, `ready(address)` is
+    called once listening.
+    """
+    try:
+        if warm:
+            await service.querier.pool.warm()
+        if socket_path is not None:
+            server = await asyncio.start_unix_server(service.serve_connection, socket_path)
+            address = socket_path
+        else:
+            server = await asyncio.start_server(service.serve_connection, host, port)
+            host, port = server.sockets[0].getsockname()[:2]
+            address = f"http://{host}:{port}/"
+        async with server:
+            if ready is not None:
+                ready(address)
+            await server.serve_forever()
+    finally:
+        await service.close()
+
+
+def serve_main(argv):
+    """`sts-query serve`: score patients over a local HTTP/JSON endpoint."""
+    parser = argparse.ArgumentParser(
+        prog="sts-query serve",
+        description="Score patients over a local HTTP/JSON endpoint, on warm STS sessions and a shared result cache. "
+        + "POST one patient (or a list of them) to /score; metrics are at /metrics and /metrics.json.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("--host", default="127.0.0.1", help="Interface to listen on.")
+    parser.add_argument("--port", type=int, default=8780, help="Port to listen on.")
+    parser.add_argument(
+        "--unix-socket",
+        dest="socket_path",
+        metavar="PATH",
+        help="Listen on this Unix socket instead of a TCP port.",
+    )
+    parser.add_argument(
+        "--concurrency",
+        metavar="N",
+        type=int,
+        default=4,
+        help="Warm STS sessions shared by all requests. Please be gentle with the STS servers.",
+    )
+    parser.add_argument(
+        "--no-warm",
+        dest="warm",
+        action="store_false",
+        help="Connect sessions on first use, instead of at startup.",
+    )
+    add_cache_arguments(parser)
+    parser.add_argument(
+        "--server-url",
+        dest="server_url",
+        metavar="wss://…",
+        default=WS_API_URL,
+        help="STS websocket endpoint, e.g. a local `sts-query mock-server` for testing.",
+    )
+    args = parser.parse_args(argv)
+    assert args.concurrency >= 1, "--concurrency must be at least 1"
+    assert args.cache_file or (
+        args.cache_ttl_days is None and args.cache_max_entries is None
+    ), "--cache-ttl and --cache-max-entries require --cache"
+
+    cache = open_result_cache(args)
+
+    def ready(address):
+        print(f"Scoring service listening on {address} (Ctrl-C to stop)")
+        print("POST patients to /score; metrics at /metrics (Prometheus) and /metrics.json")
+
+    async def serve():
+        # Built inside the running loop: on Python 3.9 the pool's asyncio.Queue binds to the
+        # loop current at construction, which asyncio.run() would not be.
+        service = ScoringService(args.concurrency, cache=cache, url=args.server_url)
+        await run_scoring_service(service, args.host, args.port, args.socket_path, warm=args.warm, ready=ready)
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if cache is not None:
+            cache.close()
+
+
+class JobQueue:
+    """
+    A SQLite job table, to split a run across processes and machines (`sts-query enqueue`, `work`
+    and `export`).
+
+    Each job is one validated row: its labels ({"id": …}, plus {"scenario": …} when sweeping)
+    and its STS query dict. Workers lease a few jobs at a time, and renew their leases while
+    querying. A lease that expires (e.g. its
+    worker died) is released, so another worker can take the job over, and a job that has had
+    `max_attempts` leases without a result is marked failed.
+
+    Leases are taken in IMMEDIATE transactions, so two workers never hold the same job. The
+    file must be on a filesystem with working locks, such as a local disk or a network
+    filesystem that supports them.
+    """
+
+    STATES = ("pending", "leased", "done", "failed")
+
+    def __init__(self, path):
+        self.path = path
+        # Transactions are explicit (BEGIN IMMEDIATE), and other workers' locks are waited for
+        self.db = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY, labels TEXT NOT NULL UNIQUE, "
+            "entry TEXT NOT NULL, state TEXT NOT NULL DEFAULT 'pending', worker TEXT, lease_expires REAL, "
+            "attempts INTEGER NOT NULL DEFAULT 0, result TEXT, error TEXT)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, id)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def label_columns(self):
+        """The label columns of the queued rows, e.g. ("id",) or ("id", "scenario"); None if empty."""
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'label_columns'").fetchone()
+        return tuple(json.loads(row[0])) if row is not None else None
+
+    def add(self, rows, label_columns=("id",)):
+        """
+        Add jobs, all in one transaction: if reading `rows` raises, none are added.
+        Input: (row labels, STS query dict) pairs, see iter_validated_rows()
+        Output: how many jobs were added.
+        Raises sqlite3.IntegrityError if row labels repeat (including rows already in the queue).
+        """
+        existing = self.label_columns()
+        assert existing in (None, tuple(label_columns)), (
+            f"{self.path} holds rows labelled {existing}, not {tuple(label_columns)} (is --sweep the same?)"
+        )
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            self.db.execute(
+                "INSERT OR IGNORE INTO meta (key, value) VALUES ('label_columns', ?)", (json.dumps(label_columns),)
+            )
+            added = self.db.executemany(
+                "INSERT INTO jobs (labels, entry) VALUES (?, ?)",
+                ((json.dumps(labels), json.dumps(entry)) for labels, entry in rows),
+            ).rowcount
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+        self.db.execute("COMMIT")
+        return added
+
+    def release_expired(self, max_attempts=QUEUE_MAX_ATTEMPTS):
+        """
+        Release expired leases: their jobs become pending again, or failed after `max_attempts` leases.
+        Call inside a transaction (see lease()). Output: how many leases were released.
+        """
+        return self.db.execute(
+            "UPDATE jobs SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+            "error = COALESCE(error, 'Lease expired'), worker = NULL, lease_expires = NULL "
+            "WHERE state = 'leased' AND lease_expires < ?",
+            (max_attempts, time.time()),
+        ).rowcount
+
+    def lease(self, worker, count, lease_seconds=QUEUE_LEASE_SECONDS, max_attempts=QUEUE_MAX_ATTEMPTS):
+        """
+        Lease up to `count` pending jobs (first releasing expired leases) for `lease_seconds`.
+        Output: (list of (job id, row labels, STS query dict), how many expired leases were released)
+        """
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            released = self.release_expired(max_attempts)
+            jobs = self.db.execute(
+                "SELECT id, labels, entry FROM jobs WHERE state = 'pending' ORDER BY id LIMIT ?", (count,)
+            ).fetchall()
+            self.db.executemany(
+                "UPDATE jobs SET state = 'leased', worker = ?, lease_expires = ?, attempts = attempts + 1 "
+                "WHERE id = ?",
+                ((worker, time.time() + lease_seconds, job_id) for job_id, _, _ in jobs),
+            )
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+        self.db.execute("COMMIT")
+        return [(job_id, json.loads(labels), json.loads(entry)) for job_id, labels, entry in jobs], released
+
+    def renew(self, worker, job_ids, lease_seconds=QUEUE_LEASE_SECONDS):
+        """
+        Extend this worker's leases on `job_ids` to `lease_seconds` from now, while they're still being queried.
+        Output: how many leases were renewed (a lease that already expired and was released isn't).
+        """
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            renewed = self.db.executemany(
+                "UPDATE jobs SET lease_expires = ? WHERE id = ? AND state = 'leased' AND worker = ?",
+                ((time.time() + lease_seconds, job_id, worker) for job_id in job_ids),
+            ).rowcount
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+        self.db.execute("COMMIT")
+        return renewed
+
+    def finish(self, worker, outcomes, max_attempts=QUEUE_MAX_ATTEMPTS):
+        """
+        Record the outcome of leased jobs, in one transaction.
+        Input: (job id, STS results dict or the exception it failed with) pairs
+
+        A result is kept even if the lease expired in the meantime (it's just as good). A failed job
+        becomes pending again for another try, or failed after `max_attempts` leases; unless this
+        worker's lease had expired, in which case the job is already someone else's.
+        """
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            for job_id, outcome in outcomes:
+                if isinstance(outcome, BaseException):
+                    self.db.execute(
+                        "UPDATE jobs SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+                        "error = ?, worker = NULL, lease_expires = NULL "
+                        "WHERE id = ? AND state = 'leased' AND worker = ?",
+                        (max_attempts, str(outcome) or type(outcome).__name__, job_id, worker),
+                    )
+                else:
+                    self.db.execute(
+                        "UPDATE jobs SET state = 'done', result = ?, error = NULL, worker = ?, lease_expires = NULL "
+                        "WHERE id = ? AND state != 'done'",
+                        (json.dumps(outcome), worker, job_id),
+                    )
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+        self.db.execute("COMMIT")
+
+    def counts(self):
+        """Jobs per state, e.g. {"pending": 10, "leased": 4, "done": 86, "failed": 0}."""
+        counts = dict.fromkeys(self.STATES, 0)
+        counts |= dict(self.db.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state"))
+        return counts
+
+    def results(self):
+        """Yield (row labels, STS query dict, STS results dict) of every finished job, in the order they were enqueued."""
+        for labels, entry, result in self.db.execute(
+            "SELECT labels, entry, result FROM jobs WHERE state = 'done' ORDER BY id"
+        ):
+            yield json.loads(labels), json.loads(entry), json.loads(result)
+
+    def failures(self):
+        """Yield (row labels, error) of every failed job, in the order they were enqueued."""
+        for labels, error in self.db.execute("SELECT labels, error FROM jobs WHERE state = 'failed' ORDER BY id"):
+            yield json.loads(labels), error
+
+    def close(self):
+        self.db.close()
+
+
+def queue_status(counts):
+    """One line summary of JobQueue.counts()."""
+    return f"Jobs: {sum(counts.values())} total, " + ", ".join(f"{count} {state}" for state, count in counts.items())
+
+
+async def work_queue(
+    queue,
+    worker,
+    concurrency=1,
+    reuse_sessions=True,
+    stats=None,
+    cache=None,
+    url=None,
+    lease_seconds=QUEUE_LEASE_SECONDS,
+    max_attempts=QUEUE_MAX_ATTEMPTS,
+    progress=None,
+    breaker=None,
+    rate=None,
+):
+    """
+    Lease jobs from a JobQueue and record their results, until no job is left to lease (`sts-query work`).
+    Output: how many jobs this worker finished (with a result or an error).
+    Raises ServerDownError if the CircuitBreaker gives up: the jobs in flight are left to their leases.
+
+    Each of the `concurrency` slots takes the next job as soon as it's free, from jobs leased up to
+    QUEUE_LEASE_BATCH per unit of `concurrency` at a time, and queries it on one PayloadQuerier (pooled
+    sessions, rate control, retries, and the optional ResultCache). Each job is recorded as soon as it
+    finishes, and the leases of this worker's jobs are renewed every QUEUE_RENEW_FRACTION of
+    `lease_seconds`, so slow queries (e.g. while the CircuitBreaker is open) aren't taken over by other
+    workers. While other workers hold the last jobs, idle slots check back every QUEUE_POLL_SECONDS, in
+    case their leases expire.
+    """
+    querier = PayloadQuerier(concurrency, reuse_sessions, stats, cache, False, rate, url, breaker=breaker)
+    leased = collections.deque()  # (job id, STS query dict) leased by this worker, not started yet
+    in_flight = set()  # job ids leased by this worker and not finished yet (including those in `leased`)
+    finished = 0
+
+    def lease_more():
+        count = QUEUE_LEASE_BATCH * concurrency - len(in_flight)
+        jobs, released = queue.lease(worker, count, lease_seconds, max_attempts)
+        if released:
+            tqdm.tqdm.write(f"Released {released} expired leases")
+        if stats is not None:
+            stats.rows += len(jobs)
+        in_flight.update(job_id for job_id, _, _ in jobs)
+        leased.extend((job_id, entry) for job_id, _, entry in jobs)
+
+    async def run(job_id, entry):
+        nonlocal finished
+        trace = QueryTrace()
+        try:
+            entry, update_data, key = prepare_payload(entry)
+            result = querier.cached(key, trace)
+            if result is None:
+                result = await querier.query(entry, update_data, key, trace)
+        except ServerDownError:
+            # Not the job's fault: stop, and let its lease expire for another worker (or a later run)
+            raise
+        except Exception as error:
+            result = error
+        queue.finish(worker, [(job_id, result)], max_attempts)
+        in_flight.discard(job_id)
+        finished += 1
+        if progress is not None:
+            progress.set_postfix(rate=f"{querier.rate.rate:.2f}/s", refresh=False)
+            progress.update()
+
+    async def slot():
+        while True:
+            if not leased:
+                lease_more()
+            if leased:
+                await run(*leased.popleft())
+            elif queue.counts()["leased"] > len(in_flight):
+                # Other workers hold the last jobs
+                await asyncio.sleep(QUEUE_POLL_SECONDS)
+            else:
+                # Whatever is left is in this worker's other slots (a job that fails goes back to pending,
+                # and the slot that ran it leases it again)
+                return
+
+    async def renew_leases():
+        while True:
+            await asyncio.sleep(lease_seconds * QUEUE_RENEW_FRACTION)
+            if not in_flight:
+                continue
+            try:
+                queue.renew(worker, list(in_flight), lease_seconds)
+            except sqlite3.Error as error:
+                # e.g. the queue stayed locked for longer than its timeout: try again next round
+                tqdm.tqdm.write(f"Couldn't renew leases, will retry: {error}")
+
+    renewer = asyncio.ensure_future(renew_leases())
+    slots = [asyncio.ensure_future(slot()) for _ in range(concurrency)]
+    try:
+        await asyncio.gather(*slots)
+    except BaseException:
+        for task in slots:
+            task.cancel()
+        await asyncio.gather(*slots, return_exceptions=True)
+        raise
+    finally:
+        renewer.cancel()
+        await querier.close()
+    return finished
+
+
+def add_queue_argument(parser):
+    """The job queue file option, shared by `enqueue`, `work` and `export`."""
+    parser.add_argument(
+        "--queue",
+        dest="queue_file",
+        metavar="jobs.sqlite",
+        required=True,
+        help="The SQLite job queue file. Every worker must be able to open it (e.g. on a shared filesystem "
+        + "with working locks).",
+    )
+
+
+def enqueue_main(argv):
+    """`sts-query enqueue`: validate a .csv, and add its rows to a job queue."""
+    parser = argparse.ArgumentParser(
+        prog="sts-query enqueue",
+        description="Validate a patient .csv and add its rows to a job queue, for `sts-query work` processes "
+        + "on any number of machines. Nothing is added if any row is invalid.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    add_queue_argument(parser)
+    parser.add_argument(
+        "--csv",
+        dest="csv_file",
+        metavar="patient-data.csv",
+        type=argparse.FileType("r", encoding="utf-8-sig"),
+        required=True,
+        help="Your input patient data .csv.",
+    )
+    parser.add_argument(
+        "--override",
+        dest="override",
+        nargs="+",
+        help="Override values sent to the STS API, e.g. make all patients the same age with --override age=50",
+        metavar="stsvariable=value",
+    )
+    parser.add_argument(
+        "--sweep",
+        dest="sweep",
+        nargs="+",
+        help="Query every patient once per combination of these values (applied on top of --override), "
+        + "e.g. --sweep age=50,60,70 dialysis=Yes, Results get an extra scenario column.",
+        metavar="stsvariable=value1,value2",
+    )
+    args = parser.parse_args(argv)
+    override_dict = parse_overrides(args.override)
+    scenarios, label_columns = parse_sweep_scenarios(args.sweep)
+
+    print("Validating CSV entries...")
+    error_lines = []
+
+    def all_valid_rows():
+        yield from iter_validated_rows(csv.DictReader(args.csv_file), override_dict, error_lines, scenarios)
+        if error_lines:
+            raise ValidationError([f"{len(error_lines)} invalid rows"])
+
+    with JobQueue(args.queue_file) as queue:
+        try:
+            added = queue.add(all_valid_rows(), label_columns)
+        except ValidationError:
+            print("Errors exist in your input .csv, nothing was enqueued.")
+            sys.exit(1)
+        except sqlite3.IntegrityError:
+            print(f"Your patient IDs were not unique, or are already in {args.queue_file}. Nothing was enqueued.")
+            sys.exit(1)
+        print(f"Valid! Enqueued {added} jobs in {args.queue_file}")
+        print(queue_status(queue.counts()))
+
+
+def work_main(argv):
+    """`sts-query work`: query jobs from a job queue, until none are left."""
+    parser = argparse.ArgumentParser(
+        prog="sts-query work",
+        description="Lease jobs from a queue filled by `sts-query enqueue`, query them, and record the results. "
+        + "Run as many workers as you like, on any machines that can open the queue file.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    add_queue_argument(parser)
+    parser.add_argument(
+        "--concurrency",
+        metavar="N",
+        type=int,
+        default=1,
+        help="Number of patients this worker queries in parallel. Please be gentle with the STS servers.",
+    )
+    parser.add_argument(
+        "--no-session-reuse",
+        dest="reuse_sessions",
+        action="store_false",
+        help="Open a new STS session for every patient, instead of reusing warm sessions.",
+    )
+    parser.add_argument(
+        "--worker-id",
+        metavar="NAME",
+        help="Name of this worker in the queue, instead of hostname:pid.",
+    )
+    parser.add_argument(
+        "--lease",
+        dest="lease_seconds",
+        metavar="SECONDS",
+        type=float,
+        default=QUEUE_LEASE_SECONDS,
+        help="How long leased jobs stay reserved for this worker (renewed while they're in flight). If it dies, "
+        + "other workers take them over after this.",
+    )
+    parser.add_argument(
+        "--max-attempts",
+        metavar="N",
+        type=int,
+        default=QUEUE_MAX_ATTEMPTS,
+        help="Leases per job before it's marked failed.",
+    )
+    add_cache_arguments(parser)
+    parser.add_argument(
+        "--server-url",
+        dest="server_url",
+        metavar="wss://…",
+        default=WS_API_URL,
+        help="STS websocket endpoint, e.g. a local `sts-query mock-server` for testing.",
+    )
+    args = parser.parse_args(argv)
+    assert args.concurrency >= 1, "--concurrency must be at least 1"
+    assert args.max_attempts >= 1, "--max-attempts must be at least 1"
+    assert args.cache_file or (
+        args.cache_ttl_days is None and args.cache_max_entries is None
+    ), "--cache-ttl and --cache-max-entries require --cache"
+    import socket
+
+    worker = args.worker_id or f"{socket.gethostname()}:{os.getpid()}"
+    stats = QueryStats()
+    breaker = CircuitBreaker(give_up=BREAKER_GIVE_UP, log=tqdm.tqdm.write)
+    rate = RateController(rate=RATE_INITIAL_PER_WORKER * args.concurrency, log=tqdm.tqdm.write)
+    cache = open_result_cache(args)
+    with JobQueue(args.queue_file) as queue:
+        counts = queue.counts()
+        print(f"Worker {worker} on {args.queue_file}. {queue_status(counts)}")
+        try:
+            with tqdm.tqdm(total=counts["pending"]) as progress:
+                finished = asyncio.run(
+                    work_queue(
+                        queue,
+                        worker,
+                        concurrency=args.concurrency,
+                        reuse_sessions=args.reuse_sessions,
+                        stats=stats,
+                        cache=cache,
+                        url=args.server_url,
+                        lease_seconds=args.lease_seconds,
+                        max_attempts=args.max_attempts,
+                        progress=progress,
+                        breaker=breaker,
+                        rate=rate,
+                    )
+                )
+        except ServerDownError as error:
+            print(f"\n{error}. Its leased jobs go back to the queue once their leases expire.")
+            sys.exit(1)
+        finally:
+            if cache is not None:
+                cache.close()
+        print(f"\nNo jobs left to lease. This worker finished {finished} jobs.")
+        print(queue_status(queue.counts()))
+    for line in stats.summary_lines() + rate.summary_lines() + breaker.summary_lines():
+        print(line)
+
+
+def export_main(argv):
+    """`sts-query export`: write the results of a job queue to a results file."""
+    parser = argparse.ArgumentParser(
+        prog="sts-query export",
+        description="Write the results recorded by `sts-query work` to a results file, in the order the rows "
+        + "were enqueued.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    add_queue_argument(parser)
+    parser.add_argument(
+        "--output",
+        dest="output_csv_file",
+        metavar="results.csv",
+        default="results.csv",
+        help="Where to store results.",
+    )
+    add_output_arguments(parser)
+    parser.add_argument(
+        "--partial",
+        action="store_true",
+        help="Export the finished jobs even if some are still pending, leased or failed.",
+    )
+    args = parser.parse_args(argv)
+    assert not os.path.exists(args.output_csv_file), f"Output file already exists: {args.output_csv_file}"
+    check_output_arguments(args)
+
+    with JobQueue(args.queue_file) as queue:
+        counts = queue.counts()
+        print(queue_status(counts))
+        for labels, error in itertools.islice(queue.failures(), 10):
+            print(f"\tFailed: {labels}: {error}")
+        if counts["done"] < sum(counts.values()) and not args.partial:
+            print("Not every job is done yet: run more `sts-query work`, or export what's done with --partial.")
+            sys.exit(1)
+        with open_result_writer(args, queue.label_columns() or ("id",)) as writer:
+            for index, (labels, entry, result) in enumerate(queue.results()):
+                writer.add(index, labels, result, entry)
+        print(f"Results written to: {args.output_csv_file} ({writer.written} rows)")
+
+
+# Extra commands, e.g. `sts-query bench`. Everything else is the classic CSV interface.
+SUBCOMMANDS = {
+    "mock-server": mock_server_main,
+    "bench": bench_main,
+    "serve": serve_main,
+    "enqueue": enqueue_main,
+    "work": work_main,
+    "export": export_main,
+}
+
+
+def iter_validated_rows(csv_dictreader, override_dict, errors, scenarios=None):
+    """
+    Validate patient rows from the input .csv, one at a time.
+    Output: yields (row labels, STS query dict) for each valid row, where the
+    labels are {"id": …}, plus {"scenario": …} when sweeping.
+
+    With `scenarios` (see parse_sweep()), every row is expanded into one query
+    per scenario. Invalid rows are reported with their .csv line number, and
+    the line number is appended to `errors`.
+    """
+    for line_num, row in enumerate(csv_dictreader, start=1):
+        for scenario in scenarios or [None]:
+            try:
+                yield validate_row(row, override_dict, scenario)
+            except ValueError as error_val:
+                report_invalid_row(line_num, row["id"], scenario, error_val)
+                errors.append(line_num)
+
+
+def validate_row(row, override_dict, scenario=None):
+    """
+    Validate one .csv row, after applying the overrides and sweep scenario.
+    Output: (row labels, STS query dict), see iter_validated_rows()
+    """
+    if not row["id"]:
+        raise ValidationError([NO_ID_ERROR])
+    validated_row = validate_and_return_csv_data(row | override_dict | (scenario or {}))
+    labels = {"id": validated_row.pop("id")}
+    if scenario is not None:
+        labels["scenario"] = scenario_label(scenario)
+    return labels, validated_row
+
+
+def report_invalid_row(line_num, row_id, scenario, error):
+    """Print why a .csv row failed validation."""
+    where = f" (scenario {scenario_label(scenario)})" if scenario is not None else ""
+    print(f"\tError in .csv line: {line_num}, patient ID: {row_id}{where}: {error}")
+
+
+NO_ID_ERROR = "No ID exists for this row. (Is it empty?)"
+
+
+def import_numpy():
+    """NumPy is optional (it speeds up --columnar): return the module, or None if it's not installed."""
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+def failing_rows(column, check, numpy=None):
+    """
+    Apply a check to a whole column (a sequence of strings) at once.
+    Output: the row indices where check(value) is False.
+
+    The check runs once per distinct value, since registry extracts repeat the same few values
+    over and over, and a column where every value passes is done at that point. Otherwise the
+    failing values are located in the column, in bulk if `numpy` is passed.
+    """
+    failing_values = [value for value in set(column) if not check(value)]
+    if not failing_values:
+        return []
+    if numpy is not None:
+        column = numpy.array(column, dtype=object)
+        return numpy.flatnonzero(numpy.isin(column, failing_values)).tolist()
+    failing_values = set(failing_values)
+    return [index for index, value in enumerate(column) if value in failing_values]
+
+
+def validate_csv_columns(csv_dictreader, override_dict, errors, scenarios=None):
+    """
+    Columnar version of iter_validated_rows(): much faster for large .csv files.
+
+    Load the whole .csv into columns, and run every rule of the validation schema over entire
+    columns at once, rather than row by row. Reports exactly the same errors as
+    iter_validated_rows() (up front), and returns an iterator over the same (row labels,
+    STS query dict). Those dicts are only built as the iterator is consumed, so a --dry-run
+    never builds them.
+
+    Rows with the wrong number of cells are rare, and are validated one at a time.
+    """
+    numpy = import_numpy()
+    fieldnames = csv_dictreader.fieldnames or []
+    rows = [cells for cells in csv_dictreader.reader if cells]
+    # Rows with too few or too many cells: kept as DictReader would parse them, and padded here
+    ragged = {}
+    for index, cells in enumerate(rows):
+        if len(cells) != len(fieldnames):
+            ragged[index] = csv_row_dict(fieldnames, cells)
+            rows[index] = (cells + [""] * len(fieldnames))[: len(fieldnames)]
+    columns = dict(zip(fieldnames, zip(*rows))) if rows else dict.fromkeys(fieldnames, ())
+
+    # Expand every row into one record per scenario, in the same order as iter_validated_rows()
+    scenario_list = scenarios or [None]
+    repeat = len(scenario_list)
+    record_count = len(rows) * repeat
+
+    def record_column(field):
+        if scenarios and field in scenarios[0]:
+            return [scenario[field] for _ in rows for scenario in scenarios]
+        if field in override_dict:
+            return [override_dict[field]] * record_count
+        column = columns.get(field)
+        if column is None:
+            return [STS_QUERY_STUB.get(field, "")] * record_count
+        if repeat == 1:
+            return column
+        return [value for value in column for _ in scenario_list]
+
+    record_columns = {field: record_column(field) for field in STS_PARAMS_REQUIRED}
+    ids = record_column("id")
+
+    record_errors = collections.defaultdict(list)
+    for field, check, message in STS_FIELD_CHECKS:
+        for index in failing_rows(record_columns[field], check, numpy):
+            record_errors[index].append(message)
+    for fields, required_field, message in STS_DEPENDENT_FIELD_RULES:
+        dependents_set = set().union(
+            *(
+                failing_rows(record_columns[field], lambda value: value == "", numpy)
+                for field in fields
+            )
+        )
+        required_column = record_columns[required_field]
+        for index in sorted(dependents_set):
+            if required_column[index] == "":
+                record_errors[index].append(message)
+    surgery_dates = {}
+
+    def check_surgery_date(value):
+        try:
+            surgery_dates[value] = normalize_surgery_date(value)
+        except ValueError:
+            return False
+        return True
+
+    for index in failing_rows(record_columns["surgdt"], check_surgery_date, numpy):
+        record_errors[index].append(SURGDT_ERROR)
+
+    # Columns that aren't STS keys invalidate every row (same check, and message, as the row validator)
+    key_difference = (dict.fromkeys(fieldnames) | override_dict).keys() - STS_VALID_KEYS
+    if key_difference:
+        unknown_columns = [
+            f"You have one or more columns that are not defined STS keys: {key_difference}"
+        ]
+        record_errors = collections.defaultdict(
+            list, {index: unknown_columns for index in range(record_count)}
+        )
+    for index in failing_rows(ids, bool, numpy):
+        record_errors[index] = [NO_ID_ERROR]
+
+    # Report the errors in .csv order, validating ragged rows along the way
+    ragged_records = {
+        line_index * repeat + scenario_index
+        for line_index in ragged
+        for scenario_index in range(repeat)
+    }
+    ragged_results = {}
+    for index in sorted(record_errors.keys() | ragged_records):
+        line_index, scenario_index = divmod(index, repeat)
+        scenario = scenario_list[scenario_index]
+        try:
+            if index in ragged_records:
+                ragged_results[index] = validate_row(ragged[line_index], override_dict, scenario)
+                continue
+            raise ValidationError(record_errors[index])
+        except ValueError as error_val:
+            report_invalid_row(line_index + 1, ids[index], scenario, error_val)
+            errors.append(line_index + 1)
+
+    def valid_rows():
+        for index, values in enumerate(zip(*record_columns.values())):
+            if index in ragged_results:
+                yield ragged_results[index]
+            elif index not in record_errors and index not in ragged_records:
+                validated_row = dict(zip(record_columns, values))
+                validated_row["surgdt"] = surgery_dates[validated_row["surgdt"]]
+                labels = {"id": ids[index]}
+                if scenario_list[index % repeat] is not None:
+                    labels["scenario"] = scenario_label(scenario_list[index % repeat])
+                yield labels, validated_row
+
+    return valid_rows()
+
+
+def csv_row_dict(fieldnames, cells):
+    """A row of .csv cells as a dict, exactly like csv.DictReader makes it."""
+    row = dict(zip(fieldnames, cells))
+    if len(cells) > len(fieldnames):
+        row[None] = cells[len(fieldnames) :]
+    elif len(cells) < len(fieldnames):
+        row.update(dict.fromkeys(fieldnames[len(cells) :]))
+    return row
+
+
+def prepare_csv_chunk(fieldnames, first_line_num, chunk, override_dict, scenarios=None):
+    """
+    Validate and prepare a chunk of .csv rows, in a --workers process.
+    Input: the .csv header, the line number of the first row, and the rows (lists of cells)
+    Output: ([(row labels, PreparedPayload), …], [(line number, patient ID, scenario, error), …])
+    """
+    prepared = []
+    invalid = []
+    for line_num, cells in enumerate(chunk, start=first_line_num):
+        row = csv_row_dict(fieldnames, cells)
+        for scenario in scenarios or [None]:
+            try:
+                labels, entry = validate_row(row, override_dict, scenario)
+            except ValueError as error_val:
+                invalid.append((line_num, row["id"], scenario, str(error_val)))
+                continue
+            prepared.append((labels, prepare_payload(entry)))
+    return prepared, invalid
+
+
+def iter_prepared_rows(csv_dictreader, override_dict, errors, scenarios=None, workers=2):
+    """
+    Parallel version of iter_validated_rows() (--workers): validate rows and prepare their
+    payloads in `workers` processes, on chunks of PREPARE_CHUNK_ROWS rows.
+    Output: yields (row labels, PreparedPayload) in .csv order, reporting invalid rows (with
+    their .csv line numbers) along the way.
+
+    Only a few chunks per worker are read ahead, so this streams, like iter_validated_rows().
+    """
+    fieldnames = csv_dictreader.fieldnames or []
+    rows = (cells for cells in csv_dictreader.reader if cells)
+    chunks = iter(lambda: list(itertools.islice(rows, PREPARE_CHUNK_ROWS)), [])
+    import concurrent.futures
+
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+    pending = collections.deque()
+    line_num = 1
+    try:
+        for chunk in itertools.chain(chunks, [None]):
+            if chunk is not None:
+                pending.append(
+                    executor.submit(prepare_csv_chunk, fieldnames, line_num, chunk, override_dict, scenarios)
+                )
+                line_num += len(chunk)
+            # Keep the workers busy, but hand back results in order
+            while pending and (chunk is None or len(pending) > 2 * workers or pending[0].done()):
+                prepared, invalid = pending.popleft().result()
+                for invalid_line_num, row_id, scenario, error in invalid:
+                    report_invalid_row(invalid_line_num, row_id, scenario, error)
+                    errors.append(invalid_line_num)
+                yield from prepared
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+
+def add_cache_arguments(parser):
+    """Result cache options, shared by the main command and `serve`."""
+    parser.add_argument(
+        "--cache",
+        dest="cache_file",
+        metavar="cache.sqlite",
+        type=str,
+        help="Cache STS results in this SQLite file, and reuse them on later runs against the same --server-url.",
+    )
+
+    parser.add_argument(
+        "--cache-ttl",
+        dest="cache_ttl_days",
+        metavar="DAYS",
+        type=float,
+        help="Ignore and evict cached results older than this. STS periodically updates their models.",
+    )
+
+    parser.add_argument(
+        "--cache-max-entries",
+        dest="cache_max_entries",
+        metavar="N",
+        type=int,
+        help="Keep at most this many (most recent) results in the cache.",
+    )
+
+
+def add_output_arguments(parser):
+    """Output file options, shared by the main command and `export`."""
+    parser.add_argument(
+        "--output-format",
+        dest="output_format",
+        choices=list(OUTPUT_SINKS),
+        help="Write results as .csv, JSON lines (one object per patient), or Parquet (needs pyarrow). "
+        + "By default, it's picked from the --output file extension (.jsonl, .parquet), or else csv.",
+    )
+
+    parser.add_argument(
+        "--carry-columns",
+        dest="carry_columns",
+        metavar="stsvariable",
+        nargs="+",
+        help="Copy these input columns into the results, next to the id, "
+        + "with the values that were sent to STS (after --override and --sweep), e.g. --carry-columns age gender",
+    )
+
+
+def check_output_arguments(args):
+    """Check the output options, and settle --output-format."""
+    if args.output_format is None:
+        extension = os.path.splitext(args.output_csv_file)[1].lstrip(".").lower()
+        args.output_format = extension if extension in OUTPUT_SINKS else "csv"
+    assert args.output_format != "parquet" or import_pyarrow() is not None, (
+        "--output-format parquet needs pyarrow: pip install pyarrow"
+    )
+    args.carry_columns = args.carry_columns or []
+    unknown_columns = set(args.carry_columns) - set(STS_PARAMS_REQUIRED)
+    assert not unknown_columns, f"--carry-columns must be STS input variables, not: {', '.join(sorted(unknown_columns))}"
+
+
+def open_result_cache(args):
+    """Open the --cache result cache for the --server-url endpoint, if one was requested."""
+    if not args.cache_file:
+        return None
+    return ResultCache(
+        args.cache_file,
+        ttl=args.cache_ttl_days * 86400 if args.cache_ttl_days is not None else None,
+        max_entries=args.cache_max_entries,
+        endpoint=args.server_url,
+    )
+
+
+def open_rate_controller(args, concurrency):
+    """The RateController for `concurrency` workers (--max-rate, --latency-target), logging above the progress bar."""
+    return RateController(
+        rate=RATE_INITIAL_PER_WORKER * concurrency,
+        max_rate=args.max_rate,
+        latency_target=args.latency_target,
+        log=tqdm.tqdm.write,
+    )
+
+
+def open_circuit_breaker(args):
+    """
+    The CircuitBreaker for this run (--breaker-failures, --breaker-cooldown, --breaker-give-up), logging above
+    the progress bar.
+    """
+    return CircuitBreaker(
+        failures=args.breaker_failures,
+        cooldown=args.breaker_cooldown,
+        give_up=args.breaker_give_up,
+        log=tqdm.tqdm.write,
+    )
+
+
+def open_result_writer(args, label_columns=("id",), append=False):
+    """The ResultWriter for --output, in --output-format, with the --carry-columns."""
+    return ResultWriter(
+        args.output_csv_file,
+        append=append,
+        label_columns=label_columns,
+        carry_columns=args.carry_columns,
+        output_format=args.output_format,
+    )
+
+
+def open_trace_log(args, append=False):
+    """Open the --trace log, if one was requested."""
+    if not args.trace_file:
+        return None
+    return TraceLog(args.trace_file, append=append)
+
+
+def open_dead_letters(args, label_columns=("id",)):
+    """The DeadLetters for --keep-going (None without it), written to --failures or next to the output."""
+    if not args.keep_going:
+        return None
+    path = args.failures_file or os.path.splitext(args.output_csv_file)[0] + ".failures.csv"
+    return DeadLetters(path, label_columns)
+
+
+def retry_dead_letters(args, dead_letters, writer, cache, breaker, trace_log, stats):
+    """
+    The final pass of --keep-going: query the failed patients once more, at --retry-concurrency,
+    and append those that succeed to the output. Those that fail again stay in `dead_letters`.
+    Their attempts, errors and phase times add to the run's QueryStats.
+    """
+    failed = dead_letters.rows
+    first_index = writer.next_index  # Every earlier row is written (or skipped) by now
+    still_failed = {}  # index -> FailedRow
+    print(f"\n{len(failed)} patients failed. Retrying them at concurrency {args.retry_concurrency}.")
+
+    def on_error(index, error, trace):
+        writer.add(first_index + index, failed[index].labels, None)
+        still_failed[index] = dead_letters.failure(
+            failed[index].labels, failed[index].entry, error, trace, failed[index].attempts
+        )
+
+    rate = open_rate_controller(args, args.retry_concurrency)
+    # These patients were counted as rows (and payloads) in the first pass already
+    rows, unique_payloads = stats.rows, stats.unique_payloads
+    try:
+        with tqdm.tqdm(total=len(failed)) as progress:
+            asyncio.run(
+                query_sts_api_batch_async(
+                    [row.entry for row in failed],
+                    concurrency=args.retry_concurrency,
+                    progress=progress,
+                    reuse_sessions=args.reuse_sessions,
+                    stats=stats,
+                    cache=cache,
+                    cache_only=args.cache_only,
+                    on_result=lambda index, result: writer.add(
+                        first_index + index, failed[index].labels, result, failed[index].entry
+                    ),
+                    rate=rate,
+                    url=args.server_url,
+                    on_trace=(lambda index, trace: trace_log.write(failed[index].labels, trace))
+                    if trace_log is not None
+                    else None,
+                    breaker=breaker,
+                    on_error=on_error,
+                )
+            )
+    finally:
+        stats.rows, stats.unique_payloads = rows, unique_payloads
+    # Until now, an interruption leaves every failed patient in the failures CSV
+    dead_letters.rows = [still_failed[index] for index in sorted(still_failed)]
+    print(f"Retry pass: {len(failed) - len(dead_letters.rows)} of {len(failed)} patients recovered.")
+
+
+def report_dead_letters(dead_letters):
+    """Print where the patients that still failed after --keep-going's retry pass went. Output: True if there are any."""
+    if dead_letters is None or not dead_letters.rows:
+        return False
+    print(
+        f"{len(dead_letters.rows)} patients still failed, and are listed in {dead_letters.path}. "
+        + "Re-run with --resume to retry just those."
+    )
+    return True
+
+
+def batch_query_and_write(args, validated_rows, label_columns=("id",)):
+    """
+    Query the STS API for a validated cohort, and write the results CSV.
+    Input: a list of (row labels, STS query dict), see iter_validated_rows().
+    """
+    row_keys = [tuple(labels.values()) for labels, _ in validated_rows]
+    assert len(set(row_keys)) == len(row_keys), "Your patient IDs were not unique!"
+
+    # Skip rows that a previous (interrupted) run already wrote out
+    completed_rows = set()
+    if args.resume and os.path.exists(args.output_csv_file):
+        completed_rows = read_completed_rows(
+            args.output_csv_file, label_columns, args.carry_columns, args.output_format
+        )
+        print(f"Resuming: {len(completed_rows)} rows already in {args.output_csv_file}")
+        validated_rows = [
+            (labels, entry)
+            for labels, entry in validated_rows
+            if tuple(labels.values()) not in completed_rows
+        ]
+    row_labels = [labels for labels, _ in validated_rows]
+    validated_patient_data = [entry for _, entry in validated_rows]
+
+    cache = open_result_cache(args)
+    if args.cache_only:
+        # Fail fast, before anything is queried
+        missing = [
+            labels["id"]
+            for labels, entry in zip(row_labels, validated_patient_data)
+            if cache.get(prepare_payload(entry).key) is None
+        ]
+        if missing:
+            print(f"{len(missing)} patients are not in the cache (--cache-only), e.g. IDs: {missing[:10]}")
+            cache.close()
+            sys.exit(1)
+
+    stats = QueryStats()
+    rate = open_rate_controller(args, args.concurrency)
+    breaker = open_circuit_breaker(args)
+    dead_letters = open_dead_letters(args, label_columns)
+
+    def on_error(index, error, trace):
+        writer.add(index, row_labels[index], None)
+        dead_letters.add(row_labels[index], validated_patient_data[index], error, trace)
+
+    print("Querying STS API.")
+    # Query the API for all CSV entries. Requests are paced adaptively to avoid
+    # hammering the Shiny backend and to back off when it shows transient
+    # handshake-timeout failures. Results are written out as they arrive.
+    writer = open_result_writer(args, label_columns, append=bool(completed_rows))
+    trace_log = open_trace_log(args, append=bool(completed_rows))
+    try:
+        with tqdm.tqdm(total=len(validated_patient_data)) as progress:
+            asyncio.run(
+                query_sts_api_batch_async(
+                    validated_patient_data,
+                    concurrency=args.concurrency,
+                    progress=progress,
+                    reuse_sessions=args.reuse_sessions,
+                    stats=stats,
+                    cache=cache,
+                    cache_only=args.cache_only,
+                    on_result=lambda index, result: writer.add(
+                        index, row_labels[index], result, validated_patient_data[index]
+                    ),
+                    rate=rate,
+                    url=args.server_url,
+                    on_trace=(lambda index, trace: trace_log.write(row_labels[index], trace))
+                    if trace_log is not None
+                    else None,
+                    breaker=breaker,
+                    on_error=on_error if dead_letters is not None else None,
+                )
+            )
+        if dead_letters is not None and dead_letters.rows and not breaker.gave_up:
+            retry_dead_letters(args, dead_letters, writer, cache, breaker, trace_log, stats)
+    except BaseException:
+        print(
+            f"\nInterrupted: {writer.written} new results were saved to {args.output_csv_file}. "
+            + "Re-run with --resume to continue."
+        )
+        raise
+    finally:
+        writer.close()
+        if cache is not None:
+            cache.close()
+        if trace_log is not None:
+            trace_log.close()
+        if dead_letters is not None:
+            dead_letters.write()
+        if args.metrics_file:
+            stats.write_metrics(args.metrics_file)
+
+    print(f"\nDone!\nResults written to: {args.output_csv_file}")
+    for line in stats.summary_lines() + rate.summary_lines() + breaker.summary_lines():
+        print(line)
+    if report_dead_letters(dead_letters):
+        sys.exit(1)
+
+
+def stream_query_and_write(args, csv_dictreader, override_dict, scenarios=None, label_columns=("id",)):
+    """
+    Validate, query and write patients one by one as they are read (--stream).
+
+    Invalid rows are reported and skipped rather than stopping the run, since
+    in this mode querying starts before the whole .csv has been validated.
+    So are repeated patient IDs, but to keep memory flat, only the last
+    STREAM_RECENT_IDS rows are checked (--resume also keeps the IDs already written).
+    """
+    completed_rows = set()
+    if args.resume and os.path.exists(args.output_csv_file):
+        completed_rows = read_completed_rows(
+            args.output_csv_file, label_columns, args.carry_columns, args.output_format
+        )
+        print(f"Resuming: {len(completed_rows)} rows already in {args.output_csv_file}")
+
+    validation_errors = []
+    seen_rows = collections.OrderedDict()  # The last STREAM_RECENT_IDS row keys, oldest first
+    pending_rows = collections.deque()  # (labels, STS query dict) of rows read but not yet written
+
+    if args.workers > 1:
+        validated_rows = iter_prepared_rows(
+            csv_dictreader, override_dict, validation_errors, scenarios, args.workers
+        )
+    else:
+        validated_rows = iter_validated_rows(csv_dictreader, override_dict, validation_errors, scenarios)
+
+    def entries():
+        for labels, entry in validated_rows:
+            row_key = tuple(labels.values())
+            if row_key in seen_rows:
+                print(f"\tError: patient ID {labels['id']} is not unique, skipping it.")
+                validation_errors.append(labels["id"])
+                continue
+            seen_rows[row_key] = None
+            if len(seen_rows) > STREAM_RECENT_IDS:
+                seen_rows.popitem(last=False)
+            if row_key in completed_rows:
+                continue
+            pending_rows.append((labels, entry))
+            yield entry
+
+    def on_error(index, error, trace):
+        # The row about to be yielded is next in line
+        labels, entry = pending_rows[0]
+        dead_letters.add(labels, entry, error, trace)
+
+    async def run():
+        stream = query_sts_api_stream_async(
+            entries(),
+            concurrency=args.concurrency,
+            progress=progress,
+            reuse_sessions=args.reuse_sessions,
+            stats=stats,
+            cache=cache,
+            cache_only=args.cache_only,
+            rate=rate,
+            url=args.server_url,
+            # The labels of the row about to be yielded are next in line
+            on_trace=(lambda index, trace: trace_log.write(pending_rows[0][0], trace))
+            if trace_log is not None
+            else None,
+            breaker=breaker,
+            on_error=on_error if dead_letters is not None else None,
+        )
+        async for index, result in stream:
+            labels, entry = pending_rows.popleft()
+            writer.add(index, labels, result, entry)
+
+    cache = open_result_cache(args)
+    stats = QueryStats()
+    rate = open_rate_controller(args, args.concurrency)
+    breaker = open_circuit_breaker(args)
+    dead_letters = open_dead_letters(args, label_columns)
+    print("Streaming: validating and querying STS API as the .csv is read.")
+    writer = open_result_writer(args, label_columns, append=bool(completed_rows))
+    trace_log = open_trace_log(args, append=bool(completed_rows))
+    try:
+        with tqdm.tqdm() as progress:
+            asyncio.run(run())
+        if dead_letters is not None and dead_letters.rows and not breaker.gave_up:
+            retry_dead_letters(args, dead_letters, writer, cache, breaker, trace_log, stats)
+    except BaseException:
+        print(
+            f"\nInterrupted: {writer.written} new results were saved to {args.output_csv_file}. "
+            + "Re-run with --resume to continue."
+        )
+        raise
+    finally:
+        validated_rows.close()
+        writer.close()
+        if cache is not None:
+            cache.close()
+        if trace_log is not None:
+            trace_log.close()
+        if dead_letters is not None:
+            dead_letters.write()
+        if args.metrics_file:
+            stats.write_metrics(args.metrics_file)
+
+    print(f"\nDone!\nResults written to: {args.output_csv_file}")
+    for line in stats.summary_lines() + rate.summary_lines() + breaker.summary_lines():
+        print(line)
+    failed = report_dead_letters(dead_letters)
+    if validation_errors:
+        print(f"{len(validation_errors)} rows of your input .csv had errors, and were skipped.")
+    if failed or validation_errors:
+        sys.exit(1)
+
 
 def main():
     """
@@ -1117,6 +4760,9 @@ def main():
 
     If you use this code, please consider citing me and this repository.
     """
+    if len(sys.argv) > 1 and sys.argv[1] in SUBCOMMANDS:
+        return SUBCOMMANDS[sys.argv[1]](sys.argv[2:])
+
     parser = argparse.ArgumentParser(
         description="Query the STS Short-Term Risk Calculator (v4.2) via a CSV."
         + "\nPlease cite this repository if you're using in a publication.",
@@ -1141,6 +4787,23 @@ def main():
         help="Only validate data, do not query the STS API.",
     )
 
+    parser.add_argument(
+        "--columnar",
+        dest="columnar",
+        action="store_true",
+        help="Validate the .csv column by column, which is much faster for large files "
+        + "(and faster still if NumPy is installed).",
+    )
+
+    parser.add_argument(
+        "--workers",
+        dest="workers",
+        metavar="N",
+        type=int,
+        help="Validate and prepare patients in N parallel processes, for very large .csv files.",
+        default=1,
+    )
+
     parser.add_argument(
         "--output",
         dest="output_csv_file",
@@ -1150,6 +4813,8 @@ def main():
         default="results.csv",
     )
 
+    add_output_arguments(parser)
+
     parser.add_argument(
         "--override",
         dest="override",
@@ -1159,53 +4824,243 @@ def main():
         metavar="stsvariable=value",
     )
 
+    parser.add_argument(
+        "--concurrency",
+        dest="concurrency",
+        metavar="N",
+        type=int,
+        help="Number of patients to query in parallel. Please be gentle with the STS servers.",
+        default=1,
+    )
+
+    parser.add_argument(
+        "--no-session-reuse",
+        dest="reuse_sessions",
+        action="store_false",
+        help="Open a new STS session for every patient, instead of reusing warm sessions.",
+    )
+
+    add_cache_arguments(parser)
+
+    parser.add_argument(
+        "--cache-only",
+        dest="cache_only",
+        action="store_true",
+        help="Offline mode: only use cached results, and fail if any patient is not cached.",
+    )
+
+    parser.add_argument(
+        "--resume",
+        dest="resume",
+        action="store_true",
+        help="Continue a partial run: keep the results already in --output and only query the remaining patients.",
+    )
+
+    parser.add_argument(
+        "--stream",
+        dest="stream",
+        action="store_true",
+        help="Validate, query and write patients as the .csv is read, with flat memory use. "
+        + f"Invalid rows, and IDs repeated within {STREAM_RECENT_IDS:,} rows, are reported and skipped.",
+    )
+
+    parser.add_argument(
+        "--sweep",
+        dest="sweep",
+        nargs="+",
+        help="Query every patient once per combination of these values (applied on top of --override), "
+        + "e.g. --sweep age=50,60,70 dialysis=Yes, "
+        + "Results get an extra scenario column.",
+        metavar="stsvariable=value1,value2",
+    )
+
+    parser.add_argument(
+        "--max-rate",
+        dest="max_rate",
+        metavar="REQ/S",
+        type=float,
+        help="Upper limit for the adaptive request rate (requests per second, across all workers). "
+        + "By default only --concurrency limits it.",
+    )
+
+    parser.add_argument(
+        "--latency-target",
+        dest="latency_target",
+        metavar="SECONDS",
+        type=float,
+        help="Slow down when STS requests take longer than this.",
+        default=LATENCY_TARGET,
+    )
+
+    parser.add_argument(
+        "--breaker-failures",
+        dest="breaker_failures",
+        metavar="N",
+        type=int,
+        help="Pause all queries after this many network errors in a row (the STS server looks down), "
+        + "then probe it with one query until it answers again. 0 disables this.",
+        default=BREAKER_FAILURES,
+    )
+
+    parser.add_argument(
+        "--breaker-cooldown",
+        dest="breaker_cooldown",
+        metavar="SECONDS",
+        type=float,
+        help=f"How long to pause before the first probe. Doubles after each failed probe, up to {BREAKER_COOLDOWN_MAX:g} s.",
+        default=BREAKER_COOLDOWN,
+    )
+
+    parser.add_argument(
+        "--breaker-give-up",
+        dest="breaker_give_up",
+        metavar="SECONDS",
+        type=float,
+        help="Give up once queries have been paused (the STS server looks down) for this long in total: stop, "
+        + "or with --keep-going, list the remaining patients as failures. 0 never gives up.",
+        default=BREAKER_GIVE_UP,
+    )
+
+    parser.add_argument(
+        "--keep-going",
+        dest="keep_going",
+        action="store_true",
+        help="Don't stop when a patient still fails after retries: set it aside, retry it once more at the end "
+        + "(at --retry-concurrency), and list those that still fail in a failures .csv.",
+    )
+
+    parser.add_argument(
+        "--failures",
+        dest="failures_file",
+        metavar="failures.csv",
+        type=str,
+        help="With --keep-going, where to list the patients that failed, with the error and number of attempts. "
+        + "By default, next to --output (e.g. results.failures.csv).",
+    )
+
+    parser.add_argument(
+        "--retry-concurrency",
+        dest="retry_concurrency",
+        metavar="N",
+        type=int,
+        help="With --keep-going, the concurrency of the final retry pass over the failed patients.",
+        default=1,
+    )
+
+    parser.add_argument(
+        "--trace",
+        dest="trace_file",
+        metavar="trace.jsonl",
+        type=str,
+        help="Log how every row's result was obtained: one line of JSON per row, "
+        + "with the time spent in each phase of its query, its attempts and errors.",
+    )
+
+    parser.add_argument(
+        "--metrics",
+        dest="metrics_file",
+        metavar="metrics.prom",
+        type=str,
+        help="At the end of the run, write latency histograms per query phase and error counts: "
+        + "in the Prometheus text format, or as JSON if the file name ends in .json.",
+    )
+
+    parser.add_argument(
+        "--profile",
+        dest="profile_file",
+        metavar="run.prof",
+        type=str,
+        help="Profile the run with cProfile: save the stats to this file (e.g. for snakeviz), "
+        + "and print where the time went. Only covers the main process (not --workers).",
+    )
+
+    parser.add_argument(
+        "--profile-memory",
+        dest="profile_memory",
+        action="store_true",
+        help="With --profile, also trace memory allocations (slower), and report the top allocation sites.",
+    )
+
+    parser.add_argument(
+        "--profile-top",
+        dest="profile_top",
+        metavar="N",
+        type=int,
+        help="With --profile, how many functions (and allocation sites) to report.",
+        default=20,
+    )
+
+    parser.add_argument(
+        "--server-url",
+        dest="server_url",
+        metavar="wss://…",
+        type=str,
+        help="STS websocket endpoint, e.g. a local `sts-query mock-server` for testing.",
+        default=WS_API_URL,
+    )
+
     if len(sys.argv) == 1:
         parser.print_help(sys.stderr)
         sys.exit(1)
     args = parser.parse_args()
+    try:
+        if args.profile_file:
+            run_profiled(lambda: run_csv_query(args), args.profile_file, args.profile_memory, args.profile_top)
+        else:
+            run_csv_query(args)
+    except ServerDownError as error:
+        print(error)
+        sys.exit(1)
 
-    assert not os.path.exists(
+
+def run_csv_query(args):
+    """Validate the patient .csv, then (unless it's a dry run) query the STS API and write the results."""
+    assert args.concurrency >= 1, "--concurrency must be at least 1"
+    assert args.max_rate is None or args.max_rate > 0, "--max-rate must be positive"
+    assert args.latency_target > 0, "--latency-target must be positive"
+    assert args.breaker_failures >= 0, "--breaker-failures can't be negative"
+    assert args.breaker_cooldown > 0, "--breaker-cooldown must be positive"
+    assert args.breaker_give_up >= 0, "--breaker-give-up can't be negative"
+    assert args.retry_concurrency >= 1, "--retry-concurrency must be at least 1"
+    assert args.keep_going or not args.failures_file, "--failures requires --keep-going"
+    assert not (args.columnar and args.stream), "--columnar reads the whole .csv, and can't be used with --stream"
+    assert args.workers >= 1, "--workers must be at least 1"
+    assert not (args.columnar and args.workers > 1), "--columnar and --workers can't be combined"
+    assert args.cache_file or not (
+        args.cache_only or args.cache_ttl_days is not None or args.cache_max_entries is not None
+    ), "--cache-only, --cache-ttl and --cache-max-entries require --cache"
+    assert args.resume or not os.path.exists(
         args.output_csv_file
-    ), f"Output file already exists: {args.output_csv_file}"
+    ), f"Output file already exists: {args.output_csv_file} (use --resume to continue a partial run)"
+    check_output_arguments(args)
+    assert not (args.resume and args.output_format == "parquet"), "Parquet output can't be appended to with --resume"
 
     ## Parse potential override values, which will take priority over anything passed in the .csv
-    override_dict = {}
-    if args.override:
-        print(
-            "NOTE: Override values supplied -- these will be sent to the STS API instead of the values in your .csv"
-        )
+    override_dict = parse_overrides(args.override)
 
-        for entry in args.override:
-            split_entry = entry.split("=")
-            assert len(split_entry) == 2, "Can't handle multiple = in override value."
-            assert split_entry[0] != "id", "Cannot override patient ID."
-            override_dict[split_entry[0]] = split_entry[1]
+    ## Parse potential sweep values: every patient is queried once per scenario
+    scenarios, label_columns = parse_sweep_scenarios(args.sweep)
 
-        assert all(
-            key in STS_PARAMS_REQUIRED + STS_PARAMS_OPTIONAL
-            for key in override_dict.keys()
-        ), "Override value is not one of the defined STS keys."
-        print(f"\tOverriding: {override_dict}")
+    csv_dictreader = csv.DictReader(args.csv_file)
+
+    if args.stream and not args.dryrun:
+        stream_query_and_write(args, csv_dictreader, override_dict, scenarios, label_columns)
+        return
 
     print("Validating CSV entries...")
     # NOTE: Other than an "ID" column your CSV header must be the same as the STS API parameters,
     # and your CSV entries must *exactly* match the STS query parameters.
-
-    validated_patient_data = []
-
-    csv_dictreader = csv.DictReader(args.csv_file)
-    errors_exist = False
-    for line_num, row in enumerate(csv_dictreader, start=1):
-        overriden_row = row | override_dict
-        try:
-            assert (row["id"]) != "", "No ID exists for this row. (Is it empty?)"
-            validated_patient_data.append(validate_and_return_csv_data(overriden_row))
-        except (AssertionError, ValueError) as error_val:
-            print(
-                f"\tError in .csv line: {line_num}, patient ID: {row['id']}: {error_val}"
-            )
-            errors_exist = True
-    if errors_exist:
+    error_lines = []
+    if args.columnar:
+        # Errors are reported right away, while the valid rows are only built if they're queried
+        validated_rows = validate_csv_columns(csv_dictreader, override_dict, error_lines, scenarios)
+    elif args.workers > 1:
+        validated_rows = list(
+            iter_prepared_rows(csv_dictreader, override_dict, error_lines, scenarios, args.workers)
+        )
+    else:
+        validated_rows = list(iter_validated_rows(csv_dictreader, override_dict, error_lines, scenarios))
+    if error_lines:
         print("Errors exist in your input .csv, unable to query STS API.")
         sys.exit()
     else:
@@ -1213,33 +5068,7 @@ def main():
 
     ## Actually query the STS API (if not a dry run)
     if not args.dryrun:
-        # A dict of patient_id to the STS risk values
-        # e.g. '1': {pred6d: 0.37929, pred14d: 0.04021 …}
-        sts_results = {}
-
-        print("Querying STS API.")
-        # Query the API for all CSV entries
-        for i, entry in enumerate(tqdm.tqdm(validated_patient_data)):
-            patient_id = entry["id"]
-            del entry["id"]
-            assert patient_id not in sts_results, "Your patient IDs were not unique!"
-            if i > 0:
-                # Small inter-request sleep to avoid hammering the Shiny backend
-                # and reduce transient handshake-timeout failures on large batches.
-                time.sleep(0.3)
-            sts_results[patient_id] = query_sts_api(entry)
-
-        with open(args.output_csv_file, "w") as csv_output:
-            writer = csv.DictWriter(
-                csv_output, fieldnames=["id"] + STS_EXPECTED_RESULTS
-            )
-            writer.writeheader()
-            for patient_id, patient_results in sts_results.items():
-                # Shove the ID back in for DictWriter
-                patient_results["id"] = patient_id
-                writer.writerow(patient_results)
-
-        print(f"\nDone!\nResults written to: {args.output_csv_file}")
+        batch_query_and_write(args, list(validated_rows), label_columns)
     else:
         print(f"(Dry run requested, STS API not queried.)")
 
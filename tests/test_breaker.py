@@ -0,0 +1,181 @@
+"""
+CircuitBreaker: closed -> open after `failures` transient errors in a row -> half-open (one probe) ->
+closed if the probe gets through, or open again for twice as long. Real (short) cooldowns keep the
+event loop's clock honest.
+"""
+import asyncio
+import time
+
+import pytest
+
+import sts_query
+
+COOLDOWN = 0.02
+
+
+def trip(breaker):
+    for _ in range(breaker.failures):
+        breaker.record_failure()
+
+
+def test_opens_after_failures_in_a_row():
+    breaker = sts_query.CircuitBreaker(failures=3, cooldown=COOLDOWN)
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.record_success()  # Resets the count
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.state == "closed"
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert breaker.trips == 1
+
+
+def test_disabled_never_opens():
+    breaker = sts_query.CircuitBreaker(failures=0, cooldown=COOLDOWN)
+    for _ in range(100):
+        breaker.record_failure()
+    assert breaker.state == "closed"
+
+
+def test_probe_success_closes():
+    async def run():
+        breaker = sts_query.CircuitBreaker(failures=2, cooldown=COOLDOWN)
+        assert await breaker.wait() is False
+        trip(breaker)
+        start = time.monotonic()
+        assert await breaker.wait() is True
+        assert time.monotonic() - start >= COOLDOWN * 0.9
+        assert breaker.state == "half_open"
+        breaker.record_success()
+        return breaker
+
+    breaker = asyncio.run(run())
+    assert breaker.state == "closed"
+    assert breaker.cooldown == COOLDOWN
+    assert breaker.paused_seconds >= COOLDOWN * 0.9
+    assert breaker.summary_lines()[0].startswith("Circuit breaker: opened 1 times")
+
+
+def test_probe_failure_reopens_for_twice_as_long():
+    async def run():
+        breaker = sts_query.CircuitBreaker(failures=1, cooldown=COOLDOWN, max_cooldown=3 * COOLDOWN)
+        breaker.record_failure()
+        for cooldown in [2 * COOLDOWN, 3 * COOLDOWN, 3 * COOLDOWN]:
+            assert await breaker.wait() is True
+            breaker.record_failure()
+            assert (breaker.state, breaker.cooldown) == ("open", cooldown)
+        return breaker
+
+    breaker = asyncio.run(run())
+    assert breaker.trips == 1
+
+
+def test_only_one_probe_while_half_open():
+    async def run():
+        breaker = sts_query.CircuitBreaker(failures=1, cooldown=COOLDOWN)
+        breaker.record_failure()
+        waiters = [asyncio.ensure_future(breaker.wait()) for _ in range(3)]
+        await asyncio.sleep(2 * COOLDOWN)
+        assert [waiter.result() for waiter in waiters if waiter.done()] == [True]
+        breaker.record_success()
+        return await asyncio.gather(*waiters)
+
+    assert sorted(asyncio.run(run())) == [False, False, True]
+
+
+def test_attempt_records_outcomes():
+    async def run():
+        breaker = sts_query.CircuitBreaker(failures=2, cooldown=COOLDOWN)
+        for _ in range(2):
+            with pytest.raises(ConnectionRefusedError):
+                async with breaker.attempt():
+                    raise ConnectionRefusedError()
+        assert breaker.state == "open"
+        # Any other error shows the server is answering
+        with pytest.raises(ValueError):
+            async with breaker.attempt() as probe:
+                assert probe
+                raise ValueError()
+        return breaker
+
+    assert asyncio.run(run()).state == "closed"
+
+
+def test_cancelled_probe_lets_the_next_attempt_probe():
+    async def run():
+        breaker = sts_query.CircuitBreaker(failures=1, cooldown=COOLDOWN)
+        breaker.record_failure()
+
+        async def probe():
+            async with breaker.attempt():
+                await asyncio.sleep(10)
+
+        task = asyncio.ensure_future(probe())
+        await asyncio.sleep(2 * COOLDOWN)
+        assert breaker.state == "half_open"
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        return await asyncio.wait_for(breaker.wait(), 1)
+
+    assert asyncio.run(run()) is True
+
+
+def test_gives_up_once_the_budget_is_spent():
+    async def run():
+        breaker = sts_query.CircuitBreaker(failures=1, cooldown=COOLDOWN, give_up=5 * COOLDOWN)
+        breaker.record_failure()
+        start = time.monotonic()
+        with pytest.raises(sts_query.ServerDownError):
+            while True:
+                with pytest.raises(ConnectionRefusedError):
+                    async with breaker.attempt():
+                        raise ConnectionRefusedError()
+        return breaker, time.monotonic() - start
+
+    breaker, elapsed = asyncio.run(run())
+    assert 5 * COOLDOWN * 0.9 <= elapsed < 1
+    assert breaker.gave_up
+    assert breaker.summary_lines()[0].endswith("then gave up")
+
+
+def test_gives_up_while_the_probe_hangs():
+    async def run():
+        breaker = sts_query.CircuitBreaker(failures=1, cooldown=COOLDOWN, give_up=3 * COOLDOWN)
+        breaker.record_failure()
+        assert await breaker.wait() is True  # The probe, which never comes back
+        with pytest.raises(sts_query.ServerDownError):
+            await asyncio.wait_for(breaker.wait(), 1)
+
+    asyncio.run(run())
+
+
+def test_giving_up_is_for_good():
+    async def run():
+        breaker = sts_query.CircuitBreaker(failures=1, cooldown=COOLDOWN, give_up=COOLDOWN)
+        breaker.record_failure()
+        with pytest.raises(sts_query.ServerDownError):
+            await asyncio.wait_for(breaker.wait(), 1)
+        breaker.record_success()
+        with pytest.raises(sts_query.ServerDownError):
+            await breaker.wait()
+
+    asyncio.run(run())
+
+
+def test_querier_fails_fast_once_the_breaker_gave_up():
+    async def run():
+        breaker = sts_query.CircuitBreaker(failures=1, cooldown=COOLDOWN, give_up=COOLDOWN)
+        breaker.record_failure()
+        with pytest.raises(sts_query.ServerDownError):
+            await asyncio.wait_for(breaker.wait(), 1)
+        # A crawling request rate would make every remaining patient wait its turn to fail
+        rate = sts_query.RateController(rate=0.1, max_rate=0.1)
+        querier = sts_query.PayloadQuerier(1, reuse_sessions=False, rate=rate, breaker=breaker)
+        payload = sts_query.prepare_payload({})
+        for _ in range(3):
+            with pytest.raises(sts_query.ServerDownError):
+                await asyncio.wait_for(querier.query(*payload, sts_query.QueryTrace()), 1)
+
+    asyncio.run(run())
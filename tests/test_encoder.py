@@ -0,0 +1,38 @@
+"""
+Golden test for the payload encoder: the init and update messages must stay byte-identical.
+
+tests/data/encoder_golden.json was recorded with the original encoder, before the init message
+was cached and the update data built from a compiled plan. It holds the sample_data.csv patients
+(validated) and a few synthetic_patients(), and the exact messages for each.
+"""
+import csv
+import json
+import pathlib
+
+import pytest
+
+import sts_query
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+GOLDEN = json.loads((ROOT / "tests" / "data" / "encoder_golden.json").read_text())
+
+
+def test_init_message():
+    assert sts_query.init_message() == GOLDEN["init_message"]
+
+
+@pytest.mark.parametrize("case", GOLDEN["cases"], ids=lambda case: case["name"])
+def test_update_messages(case):
+    init_msg, update_msg = sts_query.prepare_websocket_messages(case["patient"])
+    assert init_msg == GOLDEN["init_message"]
+    assert update_msg == case["update_message"]
+    reset_and_update = sts_query.SESSION_RESET_DATA | sts_query.prepare_update_data(case["patient"])
+    assert sts_query.encode_update_message(reset_and_update) == case["reused_session_update_message"]
+
+
+def test_golden_patients_are_the_sample_data():
+    with open(ROOT / "sample_data.csv", encoding="utf-8-sig", newline="") as f:
+        for row in csv.DictReader(f):
+            entry = sts_query.validate_and_return_csv_data(row)
+            name = "sample_data.csv id " + entry.pop("id")
+            assert entry == next(case["patient"] for case in GOLDEN["cases"] if case["name"] == name)
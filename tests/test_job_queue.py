@@ -0,0 +1,159 @@
+"""
+JobQueue (`sts-query enqueue`, `work` and `export`): pending -> leased -> done, back to pending on an error
+or an expired lease, failed after `max_attempts` leases. And work_queue() on top of it.
+"""
+import asyncio
+import sqlite3
+import time
+
+import pytest
+
+import sts_query
+
+
+def jobs(count, **entry):
+    return [({"id": str(i)}, {"age": "50"} | entry | {"job": i}) for i in range(count)]
+
+
+def states(queue):
+    return dict(queue.db.execute("SELECT labels, state FROM jobs"))
+
+
+@pytest.fixture
+def queue(tmp_path):
+    with sts_query.JobQueue(str(tmp_path / "jobs.sqlite")) as queue:
+        yield queue
+
+
+@pytest.fixture
+def other(queue):
+    """Another worker's connection to the same queue."""
+    with sts_query.JobQueue(queue.path) as other:
+        yield other
+
+
+def test_add_rejects_repeated_labels(queue):
+    assert queue.add(jobs(3)) == 3
+    with pytest.raises(sqlite3.IntegrityError):
+        queue.add(jobs(5))
+    assert queue.counts() == {"pending": 3, "leased": 0, "done": 0, "failed": 0}
+
+
+def test_lease_hands_each_job_to_one_worker(queue, other):
+    queue.add(jobs(5))
+    leased_a, _ = queue.lease("a", 3)
+    leased_b, _ = other.lease("b", 3)
+    assert [job_id for job_id, _, _ in leased_a] == [1, 2, 3]
+    assert [job_id for job_id, _, _ in leased_b] == [4, 5]
+    assert leased_a[0][1:] == ({"id": "0"}, {"age": "50", "job": 0})
+    assert queue.lease("a", 3) == ([], 0)
+    assert queue.counts()["leased"] == 5
+
+
+def test_finish_records_results_in_order(queue):
+    queue.add(jobs(3))
+    leased, _ = queue.lease("a", 3)
+    queue.finish("a", [(3, {"predmort": 0.3}), (1, {"predmort": 0.1})])
+    queue.finish("a", [(2, {"predmort": 0.2})])
+    assert [(labels["id"], result["predmort"]) for labels, _, result in queue.results()] == [
+        ("0", 0.1),
+        ("1", 0.2),
+        ("2", 0.3),
+    ]
+    assert queue.counts()["done"] == 3
+
+
+def test_failed_job_is_retried_then_marked_failed(queue):
+    queue.add(jobs(1))
+    for attempt in range(2):
+        (job_id, _, _), = queue.lease("a", 1, max_attempts=2)[0]
+        queue.finish("a", [(job_id, Exception("boom"))], max_attempts=2)
+    assert queue.counts()["failed"] == 1
+    assert queue.lease("a", 1, max_attempts=2) == ([], 0)
+    assert list(queue.failures()) == [({"id": "0"}, "boom")]
+
+
+def test_expired_lease_is_released(queue, other):
+    queue.add(jobs(2))
+    queue.lease("a", 2, lease_seconds=-1)
+    leased, released = other.lease("b", 1)
+    assert released == 2
+    assert [job_id for job_id, _, _ in leased] == [1]
+    # The job is b's now: a's error doesn't send it back to pending, but a's (late) result is kept
+    queue.finish("a", [(1, Exception("too late"))])
+    assert states(queue)['{"id": "0"}'] == "leased"
+    queue.finish("a", [(2, {"predmort": 0.2})])
+    assert states(queue)['{"id": "1"}'] == "done"
+
+
+def test_expired_lease_counts_as_an_attempt(queue, other):
+    queue.add(jobs(1))
+    queue.lease("a", 1, lease_seconds=-1, max_attempts=1)
+    assert other.lease("b", 1, max_attempts=1) == ([], 1)
+    assert list(queue.failures()) == [({"id": "0"}, "Lease expired")]
+
+
+def test_renew_extends_only_own_leases(queue, other):
+    queue.add(jobs(2))
+    queue.lease("a", 1, lease_seconds=0.05)
+    other.lease("b", 1, lease_seconds=0.05)
+    assert queue.renew("a", [1, 2], lease_seconds=60) == 1
+    time.sleep(0.1)
+    leased, released = other.lease("b", 2)
+    assert (leased, released) == ([(2, {"id": "1"}, {"age": "50", "job": 1})], 1)
+
+
+def test_expired_lease_isnt_renewed(queue, other):
+    queue.add(jobs(1))
+    queue.lease("a", 1, lease_seconds=-1)
+    other.lease("b", 1)
+    assert queue.renew("a", [1]) == 0
+
+
+@pytest.fixture
+def fake_queries(monkeypatch):
+    """Replace STS queries by a sleep of the job's `delay`. Yields the jobs' numbers, in the order they finished."""
+    done = []
+
+    async def query(self, entry, update_data, key, trace):
+        await asyncio.sleep(entry.get("delay", 0.01))
+        done.append(entry["job"])
+        return {"job": entry["job"]}
+
+    monkeypatch.setattr(sts_query.PayloadQuerier, "query", query)
+    monkeypatch.setattr(sts_query, "QUEUE_POLL_SECONDS", 0.02)
+    yield done
+
+
+def work(queue, worker="a", **kwargs):
+    return sts_query.work_queue(queue, worker, breaker=sts_query.CircuitBreaker(failures=0), **kwargs)
+
+
+def test_slow_job_doesnt_hold_up_the_other_slots(queue, fake_queries):
+    queue.add([({"id": "slow"}, {"job": "slow", "delay": 0.5})] + jobs(8))
+    assert asyncio.run(work(queue, concurrency=2)) == 9
+    assert fake_queries[-1] == "slow"
+    assert queue.counts()["done"] == 9
+
+
+def test_leases_are_renewed_while_jobs_run(queue, other, fake_queries):
+    queue.add(jobs(2, delay=0.6))
+
+    async def run():
+        # b starts once a leased every job, and keeps checking for expired leases
+        a = asyncio.ensure_future(work(queue, "a", concurrency=2, lease_seconds=0.2))
+        await asyncio.sleep(0.05)
+        return await asyncio.gather(a, work(other, "b", lease_seconds=0.2))
+
+    assert asyncio.run(run()) == [2, 0]
+    assert queue.db.execute("SELECT DISTINCT attempts, worker FROM jobs").fetchall() == [(1, "a")]
+
+
+def test_renewal_errors_are_logged(queue, fake_queries, monkeypatch, capsys):
+    def renew(worker, job_ids, lease_seconds):
+        raise sqlite3.OperationalError("database is locked")
+
+    monkeypatch.setattr(queue, "renew", renew)
+    queue.add(jobs(1, delay=0.2))
+    assert asyncio.run(work(queue, lease_seconds=0.15)) == 1
+    assert "Couldn't renew leases, will retry: database is locked" in capsys.readouterr().out
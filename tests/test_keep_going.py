@@ -0,0 +1,91 @@
+"""
+--keep-going: patients that fail are set aside, retried at the end, and the retry pass counts towards
+the run's metrics.
+"""
+import asyncio
+import csv
+import html
+import json
+import pathlib
+import sys
+import threading
+
+import pytest
+import websockets
+
+import sts_query
+
+SAMPLE_CSV = pathlib.Path(__file__).resolve().parent.parent / "sample_data.csv"
+FLAKY_AGE = 56  # The first patient of sample_data.csv
+FLAKY_UPDATES = 4  # More than a patient's retries in the first pass
+
+
+@pytest.fixture
+def flaky_server():
+    """
+    A stand-in for the STS app that drops the connection on the first FLAKY_UPDATES updates of the patient
+    aged FLAKY_AGE. Yields its websocket URL.
+    """
+    table = "".join(f"<tr><td>{html.escape(label)}</td><td>1.5%</td></tr>" for label in sts_query.STS_RESULT_LABELS)
+    updates = []
+
+    async def send_values(ws, body):
+        await ws.send(json.dumps({"busy": "busy"}))
+        await ws.send(json.dumps({"errors": {}, "values": {"text2": {"html": body}}, "inputMessages": []}))
+        await ws.send(json.dumps({"busy": "idle"}))
+
+    async def handler(ws):
+        async for message in ws:
+            message = json.loads(message)
+            if message["method"] == "init":
+                await ws.send(json.dumps({"config": {"sessionId": "test"}}))
+                await send_values(ws, "<p>Selection Required</p>")
+                continue
+            updates.append(message["data"].get("ageN:shiny.number"))
+            if updates[-1] == FLAKY_AGE and updates.count(FLAKY_AGE) <= FLAKY_UPDATES:
+                await ws.close(1011, "Injected error")
+                return
+            await send_values(ws, f'<table class="table">{table}</table>')
+
+    async def serve():
+        async with websockets.serve(handler, "127.0.0.1", 0) as server:
+            started.put_nowait(server.sockets[0].getsockname()[1])
+            await stop.wait()
+
+    loop = asyncio.new_event_loop()
+    started = asyncio.Queue()
+    stop = asyncio.Event()
+    thread = threading.Thread(target=loop.run_until_complete, args=(serve(),))
+    thread.start()
+    port = asyncio.run_coroutine_threadsafe(started.get(), loop).result(timeout=5)
+    yield f"ws://127.0.0.1:{port}/"
+    loop.call_soon_threadsafe(stop.set)
+    thread.join()
+    loop.close()
+
+
+def test_retry_pass_counts_in_the_metrics(flaky_server, tmp_path, monkeypatch, capsys):
+    patients = tmp_path / "patients.csv"
+    with open(SAMPLE_CSV, newline="") as sample, open(patients, "w", newline="") as f:
+        reader = csv.DictReader(sample)
+        writer = csv.DictWriter(f, fieldnames=reader.fieldnames)
+        writer.writeheader()
+        writer.writerows(row for row, _ in zip(reader, range(3)))
+    output, metrics = tmp_path / "results.csv", tmp_path / "metrics.json"
+    monkeypatch.setattr(
+        sys,
+        "argv",
+        ["sts_query", "--csv", str(patients), "--output", str(output), "--keep-going", "--breaker-failures", "0"]
+        + ["--server-url", flaky_server, "--metrics", str(metrics)],
+    )
+    sts_query.main()
+
+    assert "Retry pass: 1 of 1 patients recovered." in capsys.readouterr().out
+    with open(output, newline="") as f:
+        assert [row["id"] for row in csv.DictReader(f)] == ["2", "3", "1"]
+    metrics = json.loads(metrics.read_text())
+    assert metrics["rows"] == 3
+    # First pass: 2 patients at the first attempt, and 3 failed attempts. Retry pass: 1 failed, then 1 good
+    assert metrics["attempts"] == {"1": 2, "2": 1, "3": 1}
+    assert sum(metrics["errors"].values()) == FLAKY_UPDATES
+    assert metrics["sources"] == {"server": 4}
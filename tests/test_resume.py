@@ -0,0 +1,145 @@
+"""
+ResultWriter and --resume: results are written in input order, buffered until a row group is full, and an
+interrupted run's partial output (down to a line cut off mid-write) is picked up without repeating a row.
+"""
+import csv
+import json
+import pathlib
+import sys
+
+import pytest
+
+import sts_query
+
+SAMPLE_CSV = pathlib.Path(__file__).resolve().parent.parent / "sample_data.csv"
+RESULT = {label: 0.01 for label in sts_query.STS_EXPECTED_RESULTS}
+
+
+def read_output(path, output_format="csv"):
+    with open(path, newline="") as f:
+        if output_format == "jsonl":
+            return [json.loads(line) for line in f]
+        return list(csv.DictReader(f))
+
+
+def write_results(path, ids, output_format="csv", **kwargs):
+    with sts_query.ResultWriter(str(path), output_format=output_format, **kwargs) as writer:
+        for index, row_id in enumerate(ids):
+            writer.add(index, {"id": row_id}, RESULT)
+
+
+def test_results_are_written_in_input_order(tmp_path):
+    path = tmp_path / "results.csv"
+    with sts_query.ResultWriter(str(path)) as writer:
+        writer.add(2, {"id": "c"}, RESULT)
+        writer.add(0, {"id": "a"}, RESULT)
+        assert (writer.next_index, writer.written) == (1, 1)
+        writer.add(3, {"id": "d"}, None)  # Skipped, e.g. a failed patient
+        writer.add(1, {"id": "b"}, RESULT)
+        assert (writer.next_index, writer.written) == (4, 3)
+    assert [row["id"] for row in read_output(path)] == ["a", "b", "c"]
+
+
+def test_carried_columns_come_from_the_entry(tmp_path):
+    path = tmp_path / "results.jsonl"
+    with sts_query.ResultWriter(str(path), carry_columns=["age"], output_format="jsonl") as writer:
+        writer.add(0, {"id": "a"}, RESULT, {"age": "50"})
+        writer.add(1, {"id": "b"}, RESULT, sts_query.prepare_payload({"age": "60"}))
+    rows = read_output(path, "jsonl")
+    assert [(row["id"], row["age"], row["predmort"]) for row in rows] == [("a", "50", 0.01), ("b", "60", 0.01)]
+
+
+@pytest.mark.parametrize("output_format", ["csv", "jsonl"])
+def test_rows_are_buffered_until_a_row_group_is_full(tmp_path, monkeypatch, output_format):
+    monkeypatch.setattr(sts_query.OUTPUT_SINKS[output_format], "flush_seconds", 3600)
+    path = tmp_path / f"results.{output_format}"
+    with sts_query.ResultWriter(str(path), output_format=output_format, row_group=3) as writer:
+        for index in range(4):
+            writer.add(index, {"id": str(index)}, RESULT)
+            assert len(read_output(path, output_format)) == (3 if index >= 2 else 0)
+        assert writer.written == 4
+    assert len(read_output(path, output_format)) == 4
+
+
+def test_buffered_rows_are_flushed_after_a_while(tmp_path, monkeypatch):
+    monkeypatch.setattr(sts_query.CsvSink, "flush_seconds", 0)
+    path = tmp_path / "results.csv"
+    with sts_query.ResultWriter(str(path), row_group=1000) as writer:
+        writer.add(0, {"id": "a"}, RESULT)
+        assert [row["id"] for row in read_output(path)] == ["a"]
+        writer.add(2, {"id": "c"}, RESULT)  # Nothing new to flush
+        assert len(writer.buffer) == 0
+
+
+@pytest.mark.parametrize("output_format", ["csv", "jsonl"])
+def test_cut_off_last_line_is_removed(tmp_path, output_format):
+    path = tmp_path / f"results.{output_format}"
+    write_results(path, ["1", "2", "3"], output_format)
+    with open(path, "rb+") as f:
+        f.truncate(f.seek(0, 2) - 5)
+
+    assert sts_query.read_completed_rows(str(path), output_format=output_format) == {("1",), ("2",)}
+    assert path.read_bytes().endswith(b"\n")
+    # Appending after the cut leaves a well-formed file
+    with sts_query.ResultWriter(str(path), append=True, output_format=output_format) as writer:
+        writer.add(0, {"id": "3"}, RESULT)
+    assert [row["id"] for row in read_output(path, output_format)] == ["1", "2", "3"]
+
+
+@pytest.mark.parametrize("output_format", ["csv", "jsonl"])
+def test_complete_file_is_left_alone(tmp_path, output_format):
+    path = tmp_path / f"results.{output_format}"
+    write_results(path, ["1", "2"], output_format)
+    before = path.read_bytes()
+    assert sts_query.read_completed_rows(str(path), output_format=output_format) == {("1",), ("2",)}
+    assert path.read_bytes() == before
+
+
+@pytest.mark.parametrize("contents", [b"", b"id,scen", b"id,scenario,"])
+def test_cut_off_header_leaves_nothing_to_resume(tmp_path, contents):
+    path = tmp_path / "results.csv"
+    path.write_bytes(contents)
+    assert sts_query.read_completed_rows(str(path), ("id", "scenario")) == set()
+    assert path.read_bytes() == b""
+
+
+def test_rows_are_keyed_by_every_label_column(tmp_path):
+    path = tmp_path / "results.csv"
+    with sts_query.ResultWriter(str(path), label_columns=("id", "scenario")) as writer:
+        writer.add(0, {"id": "1", "scenario": "a"}, RESULT)
+        writer.add(1, {"id": "1", "scenario": "b"}, RESULT)
+    assert sts_query.read_completed_rows(str(path), ("id", "scenario")) == {("1", "a"), ("1", "b")}
+
+
+def test_other_results_file_isnt_resumed(tmp_path):
+    path = tmp_path / "results.csv"
+    write_results(path, ["1"])
+    with pytest.raises(AssertionError, match="Can't resume"):
+        sts_query.read_completed_rows(str(path), carry_columns=["age"])
+
+
+@pytest.mark.parametrize("output_format", ["csv", "jsonl"])
+def test_resume_queries_only_missing_patients(tmp_path, monkeypatch, output_format):
+    queried = []
+
+    async def query(self, entry, update_data, key, trace):
+        queried.append(entry["age"])
+        return RESULT
+
+    monkeypatch.setattr(sts_query.PayloadQuerier, "query", query)
+    output = tmp_path / f"results.{output_format}"
+    argv = ["sts_query", "--csv", str(SAMPLE_CSV), "--output", str(output), "--output-format", output_format]
+    monkeypatch.setattr(sys, "argv", argv)
+    sts_query.main()
+    ids = [row["id"] for row in read_output(output, output_format)]
+    assert len(queried) == len(ids) == 3
+
+    # An interrupted run: one row written, and the next cut off mid-write
+    lines = output.read_bytes().splitlines(keepends=True)
+    kept = 2 if output_format == "csv" else 1  # The .csv header, then the first row
+    output.write_bytes(b"".join(lines[:kept]) + lines[kept][:10])
+    queried.clear()
+    monkeypatch.setattr(sys, "argv", argv + ["--resume"])
+    sts_query.main()
+    assert len(queried) == 2
+    assert [row["id"] for row in read_output(output, output_format)] == ids
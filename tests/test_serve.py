@@ -0,0 +1,68 @@
+"""`sts-query serve`: HTTP status codes of ScoringService."""
+import asyncio
+import json
+
+import pytest
+
+import sts_query
+
+PATIENT = {"id": "1", "procid": "1", "age": "50", "gender": "Male", "surgdt": "01/01/2020"}
+
+
+def post_score(patients, monkeypatch, error=None):
+    """Status and decoded body of POST /score, with queries that return a result, or raise `error`."""
+
+    async def query(self, entry, update_data, key, trace):
+        if error is not None:
+            raise error
+        return {"predmort": 0.01}
+
+    monkeypatch.setattr(sts_query.PayloadQuerier, "query", query)
+
+    async def run():
+        service = sts_query.ScoringService()
+        try:
+            return await service.handle("POST", "/score", json.dumps(patients).encode("utf-8"))
+        finally:
+            await service.close()
+
+    status, _, content = asyncio.run(run())
+    return status, json.loads(content)
+
+
+@pytest.mark.parametrize(
+    "patient, error, status",
+    [
+        (PATIENT, None, 200),
+        (PATIENT | {"age": "x"}, None, 422),
+        (PATIENT, Exception("STS websocket request failed after 3 attempts"), 502),
+        (PATIENT, sts_query.ServerDownError("Gave up"), 503),
+    ],
+    ids=["ok", "invalid", "query failed", "server down"],
+)
+def test_single_patient_status(patient, error, status, monkeypatch):
+    assert post_score(patient, monkeypatch, error)[0] == status
+
+
+def test_batch_is_ok_with_an_outcome_per_patient(monkeypatch):
+    status, scored = post_score([PATIENT, PATIENT | {"id": "2", "age": "x"}], monkeypatch)
+    assert status == 200
+    assert [sorted(outcome) for outcome in scored] == [["id", "result"], ["error", "id"]]
+
+
+@pytest.mark.parametrize("length", ["abc", "-1", "1.5"])
+def test_malformed_content_length_is_a_bad_request(length):
+    async def run():
+        service = sts_query.ScoringService()
+        server = await asyncio.start_server(service.serve_connection, "127.0.0.1", 0)
+        async with server:
+            reader, writer = await asyncio.open_connection(*server.sockets[0].getsockname()[:2])
+            writer.write(f"POST /score HTTP/1.1\r\nContent-Length: {length}\r\n\r\n{{}}".encode("latin-1"))
+            response = await asyncio.wait_for(reader.read(), 5)
+            writer.close()
+        await service.close()
+        return response.decode("latin-1")
+
+    response = asyncio.run(run())
+    assert response.startswith("HTTP/1.1 400 Bad Request\r\n")
+    assert "Connection: close" in response
@@ -0,0 +1,180 @@
+"""
+SingleFlight: identical queries in flight share the leader's result or error. A cancelled leader
+doesn't strand its followers: they try again, and one of them leads.
+"""
+import asyncio
+import threading
+
+import pytest
+
+import sts_query
+
+TIMEOUT = 5  # Seconds before a stuck follower fails the test, rather than hanging it
+
+
+async def started(flight, key, count):
+    """Wait until `count` queries for `key` (the leader included) have joined the flight."""
+    while flight.leaders + flight.shared < count or key not in flight.in_flight:
+        await asyncio.sleep(0.001)
+
+
+def test_followers_share_the_leaders_result():
+    async def run():
+        flight = sts_query.SingleFlight()
+        release = asyncio.Event()
+        calls = []
+
+        async def query():
+            calls.append(1)
+            await release.wait()
+            return {"predmort": 0.01}
+
+        tasks = [asyncio.ensure_future(flight.run("key", query)) for _ in range(3)]
+        await started(flight, "key", 3)
+        release.set()
+        results = await asyncio.wait_for(asyncio.gather(*tasks), TIMEOUT)
+        return flight, calls, results
+
+    flight, calls, results = asyncio.run(run())
+    assert len(calls) == 1
+    assert sorted(shared for _, shared in results) == [False, True, True]
+    assert all(result == {"predmort": 0.01} for result, _ in results)
+    assert (flight.leaders, flight.shared, flight.in_flight) == (1, 2, {})
+
+
+def test_followers_get_the_leaders_error():
+    async def run():
+        flight = sts_query.SingleFlight()
+        release = asyncio.Event()
+        error = ConnectionResetError("STS websocket closed")
+        calls = []
+
+        async def query():
+            calls.append(1)
+            await release.wait()
+            raise error
+
+        tasks = [asyncio.ensure_future(flight.run("key", query)) for _ in range(3)]
+        await started(flight, "key", 3)
+        release.set()
+        outcomes = await asyncio.wait_for(asyncio.gather(*tasks, return_exceptions=True), TIMEOUT)
+        return flight, error, calls, outcomes
+
+    flight, error, calls, outcomes = asyncio.run(run())
+    assert len(calls) == 1
+    assert all(outcome is error for outcome in outcomes)
+    assert flight.in_flight == {}
+
+
+def test_next_query_after_an_error_goes_to_the_server():
+    async def run():
+        flight = sts_query.SingleFlight()
+
+        async def fail():
+            raise ValueError("boom")
+
+        async def succeed():
+            return {"predmort": 0.01}
+
+        with pytest.raises(ValueError):
+            await flight.run("key", fail)
+        return await flight.run("key", succeed)
+
+    assert asyncio.run(run()) == ({"predmort": 0.01}, False)
+
+
+def test_cancelled_leader_hands_over_to_a_follower():
+    async def run():
+        flight = sts_query.SingleFlight()
+        calls = []
+
+        async def query():
+            calls.append(1)
+            # The first leader is cancelled below; the next one takes long enough for the other to join it
+            await asyncio.sleep(3600 if len(calls) == 1 else 0.05)
+            return {"predmort": 0.01}
+
+        leader = asyncio.ensure_future(flight.run("key", query))
+        await started(flight, "key", 1)
+        followers = [asyncio.ensure_future(flight.run("key", query)) for _ in range(2)]
+        await started(flight, "key", 3)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        results = await asyncio.wait_for(asyncio.gather(*followers), TIMEOUT)
+        return flight, calls, results
+
+    flight, calls, results = asyncio.run(run())
+    assert len(calls) == 2
+    assert sorted(shared for _, shared in results) == [False, True]
+    assert flight.leaders == 2
+    assert flight.in_flight == {}
+
+
+def test_cancelled_follower_doesnt_cancel_the_leader():
+    async def run():
+        flight = sts_query.SingleFlight()
+        release = asyncio.Event()
+
+        async def query():
+            await release.wait()
+            return {"predmort": 0.01}
+
+        leader = asyncio.ensure_future(flight.run("key", query))
+        follower = asyncio.ensure_future(flight.run("key", query))
+        await started(flight, "key", 2)
+        follower.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await follower
+        release.set()
+        return await asyncio.wait_for(leader, TIMEOUT)
+
+    assert asyncio.run(run()) == ({"predmort": 0.01}, False)
+
+
+@pytest.mark.parametrize("cancel", [False, True], ids=["error", "cancelled"])
+def test_follower_in_another_thread_doesnt_hang(cancel):
+    """A leader and a follower in two threads, each running its own event loop."""
+    flight = sts_query.SingleFlight()
+    joined = threading.Event()
+    leader_outcome = []
+
+    async def lead():
+        async def query():
+            while not joined.is_set():
+                await asyncio.sleep(0.001)
+            if cancel:
+                asyncio.current_task().cancel()
+                await asyncio.sleep(0)
+            raise ValueError("boom")
+
+        try:
+            await flight.run("key", query)
+        except BaseException as error:
+            leader_outcome.append(type(error))
+
+    async def follow():
+        while "key" not in flight.in_flight:
+            await asyncio.sleep(0.001)
+
+        async def query():
+            return {"predmort": 0.01}
+
+        waiter = asyncio.ensure_future(flight.run("key", query))
+        await started(flight, "key", 2)
+        joined.set()
+        return await asyncio.wait_for(waiter, TIMEOUT)
+
+    thread = threading.Thread(target=asyncio.run, args=(lead(),))
+    thread.start()
+    try:
+        if cancel:
+            assert asyncio.run(follow()) == ({"predmort": 0.01}, False)
+        else:
+            with pytest.raises(ValueError, match="boom"):
+                asyncio.run(follow())
+    finally:
+        joined.set()
+        thread.join(TIMEOUT)
+    assert not thread.is_alive()
+    assert leader_outcome == [asyncio.CancelledError if cancel else ValueError]
@@ -0,0 +1,29 @@
+"""
+Startup budget (see `sts-query bench --startup`): importing sts_query, --help and --dry-run must stay fast,
+and must not load the network, progress bar or cache modules, which only a query needs.
+"""
+import pathlib
+
+import pytest
+
+import sts_query
+
+SAMPLE_CSV = str(pathlib.Path(__file__).resolve().parent.parent / "sample_data.csv")
+
+
+@pytest.mark.parametrize(
+    "argv",
+    [[], ["--help"], ["--csv", SAMPLE_CSV, "--dry-run"]],
+    ids=["import", "--help", "--dry-run"],
+)
+def test_query_only_modules_stay_unloaded(argv):
+    _, loaded = sts_query.run_startup_check(sts_query.STARTUP_CHECK_CODE, *argv)
+    assert not {"websockets", "tqdm", "sqlite3"} & set(loaded)
+    assert loaded == []
+
+
+@pytest.mark.perf
+def test_import_time_budget():
+    sts_query.run_startup_check(sts_query.STARTUP_CHECK_CODE)  # Warm up (writes the .pyc)
+    times = sorted(sts_query.run_startup_check(sts_query.STARTUP_CHECK_CODE)[0] for _ in range(5))
+    assert times[2] <= sts_query.STARTUP_BUDGET_MS
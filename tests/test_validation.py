@@ -0,0 +1,31 @@
+import csv
+import io
+
+import pytest
+
+import sts_query
+
+PATIENT = {"id": "1", "procid": "1", "age": "50", "gender": "Male", "surgdt": "01/01/2020"}
+
+
+def csv_reader(rows):
+    text = io.StringIO()
+    writer = csv.DictWriter(text, fieldnames=list(dict.fromkeys(key for row in rows for key in row)))
+    writer.writeheader()
+    writer.writerows(rows)
+    return csv.DictReader(io.StringIO(text.getvalue()))
+
+
+@pytest.mark.parametrize("value", ["inf", "-inf", "1e400", "nan", "x", "6"])
+def test_invalid_number_is_a_validation_error(value):
+    with pytest.raises(sts_query.ValidationError):
+        sts_query.validate_and_return_csv_data(PATIENT | {"medadpidis": value})
+
+
+@pytest.mark.parametrize("validator", [sts_query.iter_validated_rows, sts_query.validate_csv_columns])
+def test_validators_report_overflowing_numbers(validator):
+    rows = [PATIENT, PATIENT | {"id": "2", "medadpidis": "inf"}, PATIENT | {"id": "3", "medadpidis": "2"}]
+    errors = []
+    valid = list(validator(csv_reader(rows), {}, errors))
+    assert errors == [2]
+    assert [labels["id"] for labels, _ in valid] == ["1", "3"]